@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Measures what synchro adds to ``django.setup()``.
+
+Every measurement runs in a fresh interpreter, with and without synchro in INSTALLED_APPS.
+Resolving SYNCHRO_MODELS (done when the app is ready) is included.
+
+    $ python benchmark_import.py [repeat]
+"""
+import subprocess
+import sys
+
+SETUP = '''
+import time
+start = time.time()
+import django
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+               'remote_db': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=('django.contrib.admin', 'django.contrib.auth', 'django.contrib.contenttypes',
+                    'django.contrib.sites', 'django.contrib.sessions', 'dbsettings') + %(apps)r,
+    SITE_ID=1,
+    SYNCHRO_REMOTE='remote_db',
+    SYNCHRO_MODELS=('auth', 'sites'),
+)
+django.setup()
+print('%%f' %% (time.time() - start))
+'''
+
+
+def measure(apps):
+    out = subprocess.check_output([sys.executable, '-c', SETUP % {'apps': apps}])
+    return float(out)
+
+
+def main(repeat):
+    base = min(measure(()) for _ in range(repeat))
+    setup = min(measure(('synchro',)) for _ in range(repeat))
+    print('django.setup() without synchro: %8.2f ms' % (base * 1000))
+    print('django.setup() with synchro:    %8.2f ms (+%.2f ms)' % (setup * 1000,
+                                                                 (setup - base) * 1000))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10)
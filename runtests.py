@@ -26,7 +26,14 @@ if not settings.configured:
             'synchro',
         ),
         SITE_ID = 1,
+        # Test models are defined in synchro app, so its tables are created without migrations
+        # (they are tested separately, see MigrationTests).
+        MIGRATION_MODULES = {
+            'synchro': None if django.VERSION >= (1, 9) else 'synchro.no_migrations',
+        },
         SYNCHRO_REMOTE = 'remote_db',
+        # Leases are taken inside transactions of test cases (see LeaseTests)
+        SYNCHRO_LEASE_DATABASE = 'default',
         # ROOT_URLCONF ommited, because in Django 1.11 it need to be a valid module
         USE_I18N = True,
         MIDDLEWARE_CLASSES=(
@@ -0,0 +1,46 @@
+"""
+Synchronization for asyncio applications (Python 3 only).
+
+``acall_synchronize`` runs ``call_synchronize`` in an executor thread, so the event loop is not
+blocked while synchronization is performed.
+"""
+import asyncio
+from threading import Event
+
+from django.db import connections
+
+from synchro.management.commands.synchronize import call_synchronize
+
+
+def _synchronize(cancel, progress, kwargs):
+    try:
+        return call_synchronize(cancel=cancel, progress=progress, **kwargs)
+    finally:
+        # Connections opened in the executor thread would be left open otherwise
+        connections.close_all()
+
+
+def acall_synchronize(progress=None, executor=None, loop=None, **kwargs):
+    """
+    Returns awaitable future of call_synchronize(**kwargs) result.
+
+    progress may be an asyncio.Queue or a callable; progress events (dicts with channel, batch
+    and count keys) are put into it (or passed to it) in the event loop after every batch.
+    Cancelling the future stops synchronization before the next batch; changes of the channel
+    being synchronized are rolled back.
+    """
+    loop = loop or asyncio.get_event_loop()
+    cancel = Event()
+    report = None
+    if progress is not None:
+        callback = getattr(progress, 'put_nowait', progress)
+
+        def report(event):
+            loop.call_soon_threadsafe(callback, event)
+    future = loop.run_in_executor(executor, _synchronize, cancel, report, kwargs)
+
+    def cancelled(future):
+        if future.cancelled():
+            cancel.set()
+    future.add_done_callback(cancelled)
+    return future
@@ -6,5 +6,8 @@ class SynchroConfig(AppConfig):
     verbose_name = 'Synchro'
 
     def ready(self):
-        from signals import synchro_connect
+        from synchro import settings
+        from synchro.signals import synchro_connect
+        # Invalid SYNCHRO_MODELS or SYNCHRO_CHANNELS are reported at startup, not on first capture
+        settings.load()
         synchro_connect()
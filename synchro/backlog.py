@@ -0,0 +1,81 @@
+"""
+Inspection of changes awaiting synchronization (admin ``backlog`` view).
+
+Rows are listed with keyset pagination (after the (date, pk) of the last row shown), so a page
+costs the same no matter how long the backlog is. Objects of a page are fetched with one query per
+content type and counts per model come from one grouped aggregate.
+"""
+from collections import defaultdict
+from functools import reduce
+import operator
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Count, F, Q
+from django.utils.encoding import force_text
+
+from synchro import settings
+from synchro.management.commands.synchronize import get_channel_filter, get_checkpoint
+from synchro.models import ACTION_FLAGS, ACTIONS, ChangeLog, PendingChange
+
+PAGE_SIZE = 50
+
+
+def get_backlog():
+    """Returns queryset of ChangeLogs (or PendingChanges) awaiting synchronization."""
+    if settings.CAPTURE == 'state':
+        return PendingChange.objects.all()
+    pending = []
+    for channel in settings.CHANNELS:
+        since, since_id = get_checkpoint(channel, create=False)
+        pending.append(get_channel_filter(channel) &
+                       (Q(date__gt=since) | Q(date=since, pk__gt=since_id)))
+    return ChangeLog.objects.filter(reduce(operator.or_, pending))
+
+
+def filter_action(qs, action):
+    if qs.model is PendingChange:
+        return qs.annotate(has_action=F('actions').bitand(ACTION_FLAGS[action])).filter(
+            has_action__gt=0)
+    return qs.filter(action=action)
+
+
+def count_models(qs):
+    """Returns list of (ContentType, count) of rows of qs, with one query."""
+    counts = qs.order_by().values_list('content_type').annotate(Count('pk'))
+    res = [(ContentType.objects.get_for_id(ct_id), count) for ct_id, count in counts]
+    return sorted(res, key=lambda item: (item[0].app_label, item[0].model))
+
+
+def get_page(qs, after=None, size=None):
+    """
+    Returns (rows, pk of the last row if there are more of them) of rows following the row
+    of pk after. Rows are annotated with ``instance`` (None if object doesn't exist anymore).
+    """
+    size = size or PAGE_SIZE
+    qs = qs.order_by('date', 'pk')
+    if after is not None:
+        last = qs.model.objects.filter(pk=after).values_list('date', flat=True).first()
+        if last is not None:
+            qs = qs.filter(Q(date__gt=last) | Q(date=last, pk__gt=after))
+    rows = list(qs[:size + 1])
+    more = len(rows) > size
+    rows = rows[:size]
+    ids = defaultdict(set)
+    for row in rows:
+        ids[row.content_type_id].add(row.object_id)
+    instances = {}
+    for ct_id, object_ids in ids.items():
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        if model is None:
+            continue
+        pk = model._meta.pk
+        for obj in model._base_manager.filter(pk__in=[pk.to_python(i) for i in object_ids]):
+            instances[(ct_id, force_text(obj.pk))] = obj
+    for row in rows:
+        row.instance = instances.get((row.content_type_id, row.object_id))
+        row.model = ContentType.objects.get_for_id(row.content_type_id).model_class()
+        if isinstance(row, PendingChange):
+            row.action_labels = [label for action, label in ACTIONS if row.has_action(action)]
+        else:
+            row.action_labels = [row.get_action_display()]
+    return rows, rows[-1].pk if more else None
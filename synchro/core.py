@@ -1,3 +1,5 @@
-from utility import NaturalManager, reset_synchro
-from management.commands.synchronize import call_synchronize
-from signals import DisableSynchroLog, disable_synchro_log
+from synchro.utility import NaturalManager, reset_synchro
+from synchro.management.commands.synchronize import (call_synchronize, LeaseLost,
+                                                     SynchronizationCancelled)
+from synchro.lease import LeaseUnavailable
+from synchro.signals import DisableSynchroLog, disable_synchro_log
@@ -0,0 +1,171 @@
+"""
+Synchronization of files of FileFields (and ImageFields) to ``SYNCHRO_REMOTE_STORAGE``.
+
+Files of objects saved on REMOTE are copied from the storage of their field, by a bounded pool of
+worker threads. Files are streamed chunk by chunk; a file already present on the remote storage is
+skipped if its size matches and it was stored after the local file was last modified (storages
+not reporting modification times compare SHA-256 hashes instead). A changed file is replaced, never
+deleted first. Files are never deleted from the remote storage.
+"""
+import hashlib
+import os
+import sys
+from threading import Lock, Thread
+
+from django.core.files.storage import get_storage_class
+from django.db.models import FileField
+from django.utils import six
+from django.utils.six.moves.queue import Queue
+
+from synchro import settings
+
+FILE_FIELDS = {}
+
+
+def get_file_fields(model):
+    """Returns FileFields of model which are synchronized."""
+    if model not in FILE_FIELDS:
+        skip = getattr(model, 'SYNCHRO_SKIP', ())
+        FILE_FIELDS[model] = [f for f in model._meta.fields
+                              if isinstance(f, FileField) and f.name not in skip]
+    return FILE_FIELDS[model]
+
+
+def get_remote_storage():
+    """Returns storage configured by SYNCHRO_REMOTE_STORAGE (or None)."""
+    if not settings.REMOTE_STORAGE:
+        return None
+    return get_storage_class(settings.REMOTE_STORAGE)(**settings.REMOTE_STORAGE_OPTIONS)
+
+
+def get_hash(storage, name):
+    digest = hashlib.sha256()
+    f = storage.open(name, 'rb')
+    try:
+        for chunk in f.chunks():
+            digest.update(chunk)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def get_modified_time(storage, name):
+    """Returns modification time of file, or None if storage doesn't report it."""
+    try:
+        if hasattr(storage, 'get_modified_time'):
+            return storage.get_modified_time(name)
+        return storage.modified_time(name)
+    except (NotImplementedError, AttributeError):
+        return None
+
+
+def is_same(local, remote, name):
+    """Returns whether file is present on remote storage with the same content."""
+    if not remote.exists(name) or remote.size(name) != local.size(name):
+        return False
+    local_time, remote_time = get_modified_time(local, name), get_modified_time(remote, name)
+    if local_time is not None and remote_time is not None:
+        try:
+            # Remote file stored after the last change of the local one is its copy
+            return remote_time >= local_time
+        except TypeError:
+            # Naive and aware datetimes
+            pass
+    return get_hash(remote, name) == get_hash(local, name)
+
+
+class FileSync(object):
+    """Copies files of objects to remote storage in worker threads, until finish() is called."""
+
+    def __init__(self, storage, workers):
+        self.storage = storage
+        self.queue = Queue(workers * 2)
+        self.seen = set()
+        self.copied = self.skipped = 0
+        self.lock = Lock()
+        self.error = None
+        self.threads = [Thread(target=self.work, name='synchro-files') for _ in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def add(self, obj, fields=None):
+        """Queues files of obj (only of given fields, if specified). Blocks if queue is full."""
+        for f in get_file_fields(obj.__class__):
+            if fields is not None and f.name not in fields:
+                continue
+            name = getattr(obj, f.attname).name
+            if name and (f.storage, name) not in self.seen:
+                self.seen.add((f.storage, name))
+                self.queue.put((f.storage, name))
+
+    def copy(self, local, name):
+        if is_same(local, self.storage, name):
+            return False
+        f = local.open(name, 'rb')
+        try:
+            if self.storage.exists(name):
+                saved = self.replace(name, f)
+            else:
+                saved = self.storage.save(name, f)
+        finally:
+            f.close()
+        if saved != name:
+            raise IOError('File %s was saved as %s on remote storage.' % (name, saved))
+        return True
+
+    def replace(self, name, f):
+        """
+        Replaces remote file by content of f. Storages which overwrite files (e.g. S3) save it in
+        place; otherwise it's saved under another name and moved over the old file.
+        """
+        if self.storage.get_available_name(name) == name:
+            return self.storage.save(name, f)
+        temp = self.storage.save(name, f)
+        try:
+            getattr(os, 'replace', os.rename)(self.storage.path(temp), self.storage.path(name))
+        except NotImplementedError:
+            # Not a local storage; the old file is missing only while the new one is copied over
+            self.storage.delete(name)
+            content = self.storage.open(temp, 'rb')
+            try:
+                name = self.storage.save(name, content)
+            finally:
+                content.close()
+            self.storage.delete(temp)
+        return name
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            try:
+                copied = self.copy(*item)
+            except Exception:
+                self.error = sys.exc_info()
+                continue
+            with self.lock:
+                if copied:
+                    self.copied += 1
+                else:
+                    self.skipped += 1
+
+    def finish(self):
+        """Waits for queued files to be copied. Raises error of the first failed copy."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            six.reraise(*self.error)
+
+
+def get_file_sync():
+    """Returns FileSync to SYNCHRO_REMOTE_STORAGE, or None if it is not configured."""
+    storage = get_remote_storage()
+    if storage is None:
+        return None
+    return FileSync(storage, settings.FILE_WORKERS)
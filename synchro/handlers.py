@@ -1,6 +1,15 @@
-import settings
-settings.prepare()
-from models import ChangeLog, DeleteKey, ADDITION, CHANGE, DELETION, M2M_CHANGE
+from copy import deepcopy
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import six
+from django.utils.timezone import now
+
+from synchro import settings
+from synchro.utility import encode_key
+from synchro.models import ChangeLog, PendingChange, ACTION_FLAGS, merge_fields
+from synchro.models import ADDITION, CHANGE, DELETION, M2M_CHANGE
 
 
 def delete_redundant_change(cl):
@@ -10,39 +19,114 @@ def delete_redundant_change(cl):
     It ensures that if several object's changes were made one-by-one, only one ChangeLog is stored
     afterwards.
     """
-    cls = (ChangeLog.objects.filter(content_type=cl.content_type, object_id=cl.object_id)
-           .exclude(pk=cl.pk).order_by('-date', '-pk'))
-    if len(cls) > 0 and cls[0].action == cl.action:
-        cls[0].delete()
+    prev = (ChangeLog.objects.filter(content_type=cl.content_type, object_id=cl.object_id)
+            .exclude(pk=cl.pk).order_by('-date', '-pk').first())
+    if prev is not None and prev.action == cl.action:
+        fields = merge_fields(prev.fields, cl.fields)
+        if fields != cl.fields:
+            cl.fields = fields
+            cl.save(update_fields=['fields'])
+        prev.delete()
+
+
+def get_state(instance):
+    """Returns {attname: value} of instance loaded fields."""
+    res = {}
+    for f in instance._meta.concrete_fields:
+        if f.attname in instance.__dict__:
+            value = instance.__dict__[f.attname]
+            # Mutable values can be modified in place
+            res[f.attname] = deepcopy(value) if isinstance(value, (list, dict)) else value
+    return res
+
+
+def save_initial_state(sender, instance, **kwargs):
+    if sender in settings.MODELS:
+        instance._synchro_state = get_state(instance)
+
+
+def get_changed_fields(instance, update_fields):
+    """
+    Returns comma separated names of fields changed since the instance was loaded or saved,
+    or None if they are unknown.
+    """
+    names = dict((f.attname, f.name) for f in instance._meta.concrete_fields)
+    if update_fields is not None:
+        return ','.join(sorted(set(names.get(f, f) for f in update_fields)))
+    initial = getattr(instance, '_synchro_state', None)
+    if initial is None:
+        return None
+    current = get_state(instance)
+    return ','.join(sorted(names[attname] for attname, value in six.iteritems(current)
+                           if attname not in initial or initial[attname] != value))
 
 
-def save_changelog_add_chg(sender, instance, created, using, **kwargs):
+def save_pending(instance, action, key=None, fields=None):
+    """
+    Merges action into the PendingChange of the instance (creating it if necessary).
+    Deletion supersedes every action recorded before.
+    """
+    ct = ContentType.objects.get_for_model(instance)
+    lookup = {'content_type': ct, 'object_id': instance.pk}
+    flag = ACTION_FLAGS[action]
+    if action == DELETION:
+        values = {'actions': flag, 'key': key, 'fields': None}
+    else:
+        values = {'actions': F('actions').bitor(flag)}
+    if action == CHANGE:
+        values['fields'] = fields
+        if fields is not None:
+            current = PendingChange.objects.filter(**lookup).values_list('actions', 'fields').first()
+            if current is not None and current[0] & flag:
+                values['fields'] = merge_fields(current[1], fields)
+    values['date'] = now()
+    if PendingChange.objects.filter(**lookup).update(**values):
+        return
+    try:
+        with transaction.atomic(using=settings.LOCAL):
+            PendingChange.objects.create(actions=flag, key=key, fields=values.get('fields'),
+                                         date=values['date'], **lookup)
+    except IntegrityError:
+        # Created concurrently in the meantime
+        PendingChange.objects.filter(**lookup).update(**values)
+
+
+def save_change(instance, action, key=None, fields=None):
+    """Records action performed on the instance, according to SYNCHRO_CAPTURE mode."""
+    if settings.CAPTURE == 'state':
+        return save_pending(instance, action, key, fields)
+    cl = ChangeLog.objects.create(object=instance, action=action, key=key, fields=fields)
+    if action in (CHANGE, M2M_CHANGE):
+        delete_redundant_change(cl)
+
+
+def save_changelog_add_chg(sender, instance, created, using, update_fields=None, **kwargs):
     if sender in settings.MODELS and using == settings.LOCAL:
         if created:
-            ChangeLog.objects.create(object=instance, action=ADDITION)
+            save_change(instance, ADDITION)
+        elif settings.TRACK_FIELDS:
+            save_change(instance, CHANGE, fields=get_changed_fields(instance, update_fields))
         else:
-            cl = ChangeLog.objects.create(object=instance, action=CHANGE)
-            delete_redundant_change(cl)
+            save_change(instance, CHANGE)
+        if hasattr(instance, '_synchro_state'):
+            instance._synchro_state = get_state(instance)
     elif sender in settings.INTER_MODELS and using == settings.LOCAL:
         rel = settings.INTER_MODELS[sender]
         # It doesn't matter if we select forward or reverse object here; arbitrary choose forward
         real_instance = getattr(instance, rel.field.m2m_field_name())
-        cl = ChangeLog.objects.create(object=real_instance, action=M2M_CHANGE)
-        delete_redundant_change(cl)
+        save_change(real_instance, M2M_CHANGE)
 
 
 def save_changelog_del(sender, instance, using, **kwargs):
     if sender in settings.MODELS and using == settings.LOCAL:
-        cl = ChangeLog.objects.create(object=instance, action=DELETION)
         try:
-            k = repr(instance.natural_key())
-            DeleteKey.objects.create(changelog=cl, key=k)
-        except AttributeError:
-            pass
+            key = encode_key(instance.natural_key())
+        except (AttributeError, TypeError):
+            key = None
+        save_change(instance, DELETION, key)
 
 
 def save_changelog_m2m(sender, instance, model, using, action, **kwargs):
     if ((model in settings.MODELS or instance.__class__ in settings.MODELS)
             and action.startswith('post') and using == settings.LOCAL):
-        cl = ChangeLog.objects.create(object=instance, action=M2M_CHANGE)
-        delete_redundant_change(cl)
+        save_change(instance, M2M_CHANGE)
@@ -0,0 +1,136 @@
+"""
+Leases preventing synchronization runs from overlapping (SyncLease model).
+
+A lease is held for ``ttl`` seconds and renewed by a heartbeat thread every ``ttl / 3`` seconds.
+When its holder dies, the lease expires and can be taken over by another process.
+A lease may conflict with other ones (e.g. of a full run with leases of shards): it is refused if
+any of them is held, so that only one kind of runs proceeds at a time.
+
+Leases are stored through a separate connection to LOCAL (unless SYNCHRO_LEASE_DATABASE names
+another alias) in autocommit mode, so that they are seen by other processes at once, even when
+synchronization is called inside a transaction (e.g. by a view with ATOMIC_REQUESTS).
+"""
+from datetime import timedelta
+import os
+import socket
+from threading import Event, Thread
+from uuid import uuid4
+
+from django.db import DatabaseError, IntegrityError, connections, transaction
+from django.db.models import Q
+from django.utils.timezone import now
+
+from synchro import settings
+from synchro.models import SyncLease
+
+# Alias of the separate connection to LOCAL (see get_lease_database)
+LEASE_ALIAS = 'synchro_lease'
+
+
+class LeaseUnavailable(Exception):
+    """Raised when the lease is held by somebody else."""
+
+
+def get_owner():
+    """Returns identifier of the lease owner, unique across nodes and processes."""
+    return u'%s:%d:%s' % (socket.gethostname(), os.getpid(), uuid4().hex[:8])
+
+
+def get_lease_database():
+    """Returns alias of database leases are stored in, registering the separate one if needed."""
+    if settings.LEASE_DATABASE is not None:
+        return settings.LEASE_DATABASE
+    if LEASE_ALIAS not in connections.databases:
+        connections.databases[LEASE_ALIAS] = dict(connections[settings.LOCAL].settings_dict,
+                                                  ATOMIC_REQUESTS=False, AUTOCOMMIT=True)
+    return LEASE_ALIAS
+
+
+class Lease(object):
+    """
+    Context manager holding lease of given name for the block.
+    conflicts is Q of SyncLeases which must not be held at the same time.
+    """
+
+    def __init__(self, name, ttl, owner=None, conflicts=None, using=None):
+        self.name = name
+        self.ttl = ttl
+        self.owner = owner or get_owner()
+        self.conflicts = conflicts
+        self.using = using or get_lease_database()
+        self.leases = SyncLease.objects.db_manager(self.using)
+        # Set if the lease could not be renewed (and may be taken over)
+        self.lost = Event()
+        self.stopped = Event()
+
+    def acquire(self):
+        """Takes the lease if it is free, expired or already ours. Raises LeaseUnavailable."""
+        start = now()
+        if not self.take(start):
+            try:
+                with transaction.atomic(using=self.using):
+                    self.leases.get_or_create(name=self.name, defaults={'expires': start})
+            except IntegrityError:
+                # Created concurrently in the meantime
+                pass
+            if not self.take(start):
+                holder = (self.leases.filter(name=self.name)
+                          .values_list('owner', flat=True).first())
+                raise LeaseUnavailable('Synchronization (%s) is already run by %s.'
+                                       % (self.name, holder))
+        if self.conflicts is not None:
+            # Checked after taking the lease, as conflicting runs do; at most one of them goes on
+            held = (self.leases.filter(self.conflicts, expires__gte=start)
+                    .exclude(owner='').exclude(owner=self.owner))
+            holder = held.values_list('owner', flat=True).first()
+            if holder is not None:
+                self.free()
+                raise LeaseUnavailable('Synchronization (%s) conflicts with a run by %s.'
+                                       % (self.name, holder))
+        self.lost.clear()
+        self.stopped.clear()
+        self.thread = Thread(target=self.heartbeat, name='synchro-lease')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def take(self, start):
+        free = Q(owner='') | Q(owner=self.owner) | Q(expires__lt=start)
+        return bool(self.leases.filter(free, name=self.name).update(
+            owner=self.owner, acquired=start, expires=start + timedelta(seconds=self.ttl)))
+
+    def renew(self):
+        """Extends the lease. Returns False if it was taken over."""
+        return bool(self.leases.filter(name=self.name, owner=self.owner).update(
+            expires=now() + timedelta(seconds=self.ttl)))
+
+    def free(self):
+        self.leases.filter(name=self.name, owner=self.owner).update(owner='', expires=now())
+
+    def release(self):
+        self.stopped.set()
+        self.thread.join()
+        try:
+            self.free()
+        except DatabaseError:
+            # Database of leases is unusable; the lease expires by itself
+            pass
+
+    def heartbeat(self):
+        try:
+            while not self.stopped.wait(self.ttl / 3.0):
+                try:
+                    if not self.renew():
+                        self.lost.set()
+                        return
+                except DatabaseError:
+                    # Try again later; the lease is lost only after it is taken over
+                    pass
+        finally:
+            connections.close_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
@@ -0,0 +1,47 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from synchro.models import ChangeLog, DeleteKey
+from synchro.settings import LOCAL
+from synchro.utility import chunked, decode_legacy_key, encode_key
+
+
+def has_column(using, model, column):
+    connection = connections[using]
+    with connection.cursor() as cursor:
+        description = connection.introspection.get_table_description(cursor, model._meta.db_table)
+    return column in [c.name for c in description]
+
+
+class Command(BaseCommand):
+    help = '''Move delete keys stored by older versions (DeleteKey) into ChangeLog.key.
+Migration 0002 does so as well; keys it could not decode are kept in DeleteKey.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, dest='chunk_size',
+                            help='Number of keys converted at once.')
+        parser.add_argument('--database', default=LOCAL, dest='database',
+                            help='Database to convert keys in. Defaults to the "default" one.')
+
+    def handle(self, **options):
+        using = options['database']
+        if not has_column(using, ChangeLog, 'key'):
+            raise CommandError('ChangeLog.key column does not exist; run "migrate synchro" first.')
+        converted = failed = 0
+        with transaction.atomic(using=using):
+            keys = DeleteKey.objects.using(using).values_list('pk', 'changelog', 'key').order_by('pk')
+            for chunk in chunked(keys.iterator(), options['chunk_size']):
+                done = []
+                for pk, changelog_id, raw in chunk:
+                    try:
+                        key = encode_key(decode_legacy_key(raw))
+                    except (ValueError, TypeError):
+                        # Kept, ChangeLog.get_delete_key reports it when used
+                        failed += 1
+                        continue
+                    ChangeLog.objects.using(using).filter(pk=changelog_id).update(key=key)
+                    done.append(pk)
+                DeleteKey.objects.using(using).filter(pk__in=done).delete()
+                converted += len(done)
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d keys converted, %d kept.\n' % (converted, failed))
@@ -0,0 +1,38 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from synchro import settings
+from synchro.models import REFERENCE_CACHE, Reference, get_reference_model
+from synchro.settings import LOCAL
+from synchro.utility import chunked
+
+
+class Command(BaseCommand):
+    help = '''Move References of objects with integer or UUID primary keys to typed tables.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000, dest='chunk_size',
+                            help='Number of References converted at once.')
+
+    def handle(self, **options):
+        if not settings.TYPED_REFERENCES:
+            raise CommandError('SYNCHRO_TYPED_REFERENCES is not enabled.')
+        converted = 0
+        with transaction.atomic(using=LOCAL):
+            for ct_id in Reference.objects.values_list('content_type', flat=True).distinct():
+                ct = ContentType.objects.get_for_id(ct_id)
+                model = get_reference_model(ct)
+                if model is Reference:
+                    continue
+                refs = Reference.objects.filter(content_type=ct).order_by('pk').values_list(
+                    'pk', 'local_object_id', 'remote_object_id')
+                for chunk in chunked(refs.iterator(), options['chunk_size']):
+                    model.objects.bulk_create(
+                        model(content_type=ct, local_object_id=local_id, remote_object_id=remote_id)
+                        for _, local_id, remote_id in chunk)
+                    Reference.objects.filter(pk__in=[row[0] for row in chunk]).delete()
+                    converted += len(chunk)
+        REFERENCE_CACHE.clear()
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d references converted.\n' % converted)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from synchro import settings
+from synchro.management.commands.synchronize import (
+    clear_pending, compact, get_pending_changes, get_pending_logs, set_checkpoint)
+from synchro.transfer import write_changeset
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = '''Export changes awaiting synchronization to a changeset file.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path of the gzipped changeset file to create.')
+        parser.add_argument('--chunk-size', type=int, default=500, dest='chunk_size',
+                            help='Number of records stored in one chunk.')
+        parser.add_argument('--keep-checkpoint', action='store_true', dest='keep_checkpoint',
+                            help="Don't mark exported changes as synchronized.")
+
+    @transaction.atomic
+    def handle(self, path, **options):
+        if settings.CAPTURE == 'state':
+            changes = [get_pending_changes(channel) for channel in settings.CHANNELS]
+            exported = []
+
+            def get_actions(change):
+                exported.append((change.pk, change.date))
+                return change.get_actions()
+            actions = ((action, change) for qs in changes
+                       for change in qs.select_related().order_by('date', 'pk').iterator()
+                       for action in get_actions(change))
+            count = write_changeset(path, actions, options['chunk_size'])
+            if not options['keep_checkpoint']:
+                clear_pending(exported)
+        else:
+            pending = [(channel,) + get_pending_logs(channel) for channel in settings.CHANNELS]
+            actions = ((log.action, log) for _, logs, _ in pending for log in compact(logs))
+            count = write_changeset(path, actions, options['chunk_size'])
+            if not options['keep_checkpoint']:
+                for channel, _, last in pending:
+                    if last is not None:
+                        set_checkpoint(last, channel)
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d records exported.\n' % count)
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, transaction
+
+from synchro.transfer import Importer, read_changeset
+
+
+class Command(BaseCommand):
+    args = '<path>'
+    help = '''Apply changeset file created with synchro_export.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Path of the gzipped changeset file.')
+        parser.add_argument('--database', default=DEFAULT_DB_ALIAS, dest='database',
+                            help='Database to apply changes to. Defaults to the "default" one.')
+
+    def handle(self, path, **options):
+        importer = Importer(options['database'])
+        count = 0
+        try:
+            with transaction.atomic(using=options['database']):
+                for records in read_changeset(path):
+                    importer.apply(records)
+                    count += len(records)
+        except ValueError as e:
+            raise CommandError(e)
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d records imported.\n' % count)
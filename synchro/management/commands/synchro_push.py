@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from synchro import settings
+from synchro.lease import Lease, LeaseUnavailable
+from synchro.transport import Pusher, TransportError
+
+
+class Command(BaseCommand):
+    help = '''Push changes awaiting synchronization to a remote site over HTTP.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', dest='url', default=None,
+                            help='URL of the receiving view. Defaults to SYNCHRO_REMOTE_URL.')
+        parser.add_argument('--chunk-size', type=int, default=None, dest='chunk_size',
+                            help='Number of changes sent in one request. Defaults to batch size '
+                                 'of the channel.')
+
+    def handle(self, **options):
+        url = options['url'] or settings.REMOTE_URL
+        if not url:
+            raise CommandError('No SYNCHRO_REMOTE_URL specified in settings.')
+        if not settings.TRANSPORT_KEY:
+            raise CommandError('No SYNCHRO_TRANSPORT_KEY specified in settings.')
+        pusher = Pusher(url, settings.TRANSPORT_KEY)
+        try:
+            if settings.LEASE_TTL:
+                # Pushing advances the same checkpoint as synchronize
+                with Lease('synchronize', settings.LEASE_TTL):
+                    count = pusher.push_all(options['chunk_size'])
+            else:
+                count = pusher.push_all(options['chunk_size'])
+        except (LeaseUnavailable, TransportError) as e:
+            raise CommandError(e)
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d records pushed.\n' % count)
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from synchro import settings
+from synchro.lease import Lease, LeaseUnavailable
+from synchro.management.commands.synchronize import retry_quarantined
+
+
+class Command(BaseCommand):
+    help = '''Retry synchronization of quarantined changes.'''
+
+    def handle(self, **options):
+        if settings.REMOTE is None:
+            raise CommandError('No REMOTE database specified in settings.')
+        try:
+            if settings.LEASE_TTL:
+                with Lease('synchronize', settings.LEASE_TTL):
+                    retried, failed = retry_quarantined()
+            else:
+                retried, failed = retry_quarantined()
+        except LeaseUnavailable as e:
+            raise CommandError(e)
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d changes retried, %d still failing.\n' % (retried, failed))
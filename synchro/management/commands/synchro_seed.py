@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from synchro import settings
+from synchro.seeding import Seeder
+from synchro.settings import REMOTE
+
+
+class Command(BaseCommand):
+    help = '''Copy all synchronized objects to REMOTE in bulk and set the checkpoint.'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.BATCH_SIZE,
+                            dest='chunk_size', help='Number of objects copied at once.')
+
+    def handle(self, **options):
+        if REMOTE is None:
+            raise CommandError('No REMOTE database specified in settings.')
+        seeder = Seeder(options['chunk_size'])
+        seeder.seed()
+        if options['verbosity'] > 0:
+            self.stdout.write(u'%d objects copied, %d matched by natural key, %d m2m links copied.\n'
+                              % (seeder.copied, seeder.matched, seeder.links))
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from synchro import settings
+from synchro.settings import LOCAL, REMOTE
+from synchro.verification import Verifier
+
+
+class Command(BaseCommand):
+    help = '''Compare synchronized objects of LOCAL and REMOTE (and optionally repair differences).'''
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=settings.BATCH_SIZE,
+                            dest='chunk_size', help='Number of objects compared at once.')
+        parser.add_argument('--repair', action='store_true', dest='repair',
+                            help='Synchronize differing objects and delete the extra ones.')
+
+    def handle(self, **options):
+        if REMOTE is None:
+            raise CommandError('No REMOTE database specified in settings.')
+        verifier = Verifier(options['chunk_size'], options['repair'])
+        with transaction.atomic(using=LOCAL), transaction.atomic(using=REMOTE):
+            results = verifier.verify()
+        if options['verbosity'] > 0:
+            for model, checked, differing, missing, extra in results:
+                if differing or missing or extra or options['verbosity'] > 1:
+                    self.stdout.write(u'%s.%s: %d checked, %d differing, %d missing, %d extra.\n'
+                                      % (model._meta.app_label, model._meta.model_name,
+                                         checked, differing, missing, extra))
+            drift = sum(sum(r[2:]) for r in results)
+            self.stdout.write(u'%d objects %s.\n' % (drift, 'repaired' if options['repair']
+                                                     else 'differ'))
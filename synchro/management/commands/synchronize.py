@@ -1,15 +1,37 @@
+from contextlib import contextmanager
 from datetime import datetime
+from functools import reduce
+from itertools import groupby
+import operator
+import sys
+from threading import Event, Thread
+import traceback
+from time import time
+from uuid import UUID
+import zlib
 
 from django import VERSION
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ObjectDoesNotExist
 from django.core.management.base import BaseCommand, CommandError
-from django.db import transaction
+from django.db import (DatabaseError, IntegrityError, InterfaceError, OperationalError, connections,
+                       transaction)
+from django.db.transaction import TransactionManagementError
+from django.db.models import Q
+from django.utils import six
+from django.utils.six.moves.queue import Full, Queue
+from django.utils.timezone import now
 from django.utils.translation import ugettext_lazy as _t
 
-from synchro.models import Reference, ChangeLog, DeleteKey, options as app_options
+from synchro import settings
+from synchro.files import get_file_sync
+from synchro.lease import Lease, LeaseUnavailable
+from synchro.models import ChangeLog, ChannelState, PendingChange, QuarantinedChange
+from synchro.models import REFERENCE_CACHE, get_reference_model
+from synchro.models import options as app_options
 from synchro.models import ADDITION, CHANGE, DELETION, M2M_CHANGE
 from synchro.settings import REMOTE, LOCAL
+from synchro.utility import chunked, normalize_key
 
 
 if not hasattr(transaction, 'atomic'):
@@ -17,27 +39,188 @@ if not hasattr(transaction, 'atomic'):
     transaction.atomic = transaction.commit_on_success
 
 
-def get_object_for_this_type_using(self, using, **kwargs):
-    return self.model_class()._default_manager.using(using).get(**kwargs)
-ContentType.get_object_for_this_type_using = get_object_for_this_type_using
+# Alias LOCAL objects and logs are read from during synchronization (see get_read_alias)
+local_read = LOCAL
+# (index, count) of the shard being synchronized, if any
+shard = None
+# Whether objects may have been synchronized by shards (so REMOTE may be ahead of the checkpoint)
+sharded = False
+# FileSync copying files of objects saved on REMOTE, if configured (see syncing_files)
+file_sync = None
+
+
+def get_read_alias():
+    """
+    Returns SYNCHRO_LOCAL_READ alias, or LOCAL if the newest log on it is older than
+    the newest log on LOCAL by more than SYNCHRO_LOCAL_READ_MAX_LAG seconds.
+    """
+    if settings.LOCAL_READ == LOCAL or settings.LOCAL_READ_MAX_LAG is None:
+        return settings.LOCAL_READ
+    newest = ChangeLog.objects.order_by('-date', '-pk').values_list('date', flat=True)
+    primary = newest.using(LOCAL).first()
+    if primary is None:
+        return settings.LOCAL_READ
+    replica = newest.using(settings.LOCAL_READ).first()
+    if replica is not None and (primary - replica).total_seconds() <= settings.LOCAL_READ_MAX_LAG:
+        return settings.LOCAL_READ
+    return LOCAL
+
+
+class Prefetched(object):
+    """LOCAL objects and their m2m relations read in advance by pipelined synchronization."""
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.objects = {}  # (content type id, unicode pk): object
+        self.m2m = {}  # (content type id, unicode pk): result of read_m2m
+
+    def get(self, ct, id, pop=True):
+        key = (ct.pk, six.text_type(id))
+        return self.objects.pop(key, None) if pop else self.objects.get(key)
+
+    def pop_m2m(self, ct, id):
+        return self.m2m.pop((ct.pk, six.text_type(id)), None)
+
+PREFETCHED = Prefetched()
+
+
+def get_local(ct, id):
+    """Returns LOCAL object of given type."""
+    obj = PREFETCHED.get(ct, id)
+    if obj is not None:
+        return obj
+    return ct.model_class()._base_manager.using(local_read).get(pk=id)
+
+
+def get_remote(ct, id):
+    try:
+        return ct.model_class()._default_manager.using(REMOTE).get(pk=id)
+    except ObjectDoesNotExist:
+        return None
+
+
+def get_placeholder(model):
+    """Returns remote id of placeholder References (see claim_ref) of given Reference model."""
+    return {'BigIntegerField': 0, 'UUIDField': UUID(int=0)}.get(
+        model._meta.get_field('remote_object_id').get_internal_type(), '')
 
 
 def find_ref(ct, id):
     """
-    Retrieves referenced remote object. Also deletes invalid reference.
+    Retrieves referenced remote object (using REFERENCE_CACHE). Also deletes invalid reference.
+    Placeholder Reference of object being created by this shard (see claim_ref) is skipped.
 
-    Returns (remote, reference) or (None, None).
+    Returns (remote, remote id) or (None, None).
     """
+    remote_id = REFERENCE_CACHE.get(ct, id)
+    if remote_id is not None:
+        rem = get_remote(ct, remote_id)
+        if rem is not None:
+            return rem, remote_id
+        # Stale entry; the Reference might have been changed by another process
+        REFERENCE_CACHE.forget(ct, id)
+    model = get_reference_model(ct)
+    refs = model.objects.filter(content_type=ct, local_object_id=id)
+    remote_id = refs.values_list('remote_object_id', flat=True).first()
+    if remote_id is None or remote_id == get_placeholder(model):
+        return None, None
+    rem = get_remote(ct, remote_id)
+    if rem is None:
+        refs.delete()
+        return None, None
+    REFERENCE_CACHE.set(ct, id, remote_id)
+    return rem, remote_id
+
+
+def claim_ref(ct, id):
+    """
+    Stores placeholder Reference of local object about to be created on REMOTE, so that shards
+    synchronized concurrently don't create it twice: as References are unique, a concurrent claim
+    waits until this transaction ends and then fails.
+    Returns (remote, remote id) of the object created by the other shard or (None, None) if the
+    claim succeeded (save_ref replaces the placeholder then).
+    """
+    model = get_reference_model(ct)
+    placeholder = get_placeholder(model)
     try:
-        ref = Reference.objects.get(content_type=ct, local_object_id=id)
-        try:
-            rem = ct.get_object_for_this_type_using(REMOTE, pk=ref.remote_object_id)
-            return rem, ref
-        except ObjectDoesNotExist:
-            ref.delete()
+        with transaction.atomic():
+            model.objects.create(content_type=ct, local_object_id=id,
+                                 remote_object_id=placeholder)
+    except IntegrityError:
+        # Locking read, so that the Reference committed by the other shard is seen
+        remote_id = (model.objects.select_for_update().filter(content_type=ct, local_object_id=id)
+                     .values_list('remote_object_id', flat=True).first())
+        if remote_id == placeholder:
+            # Claimed by this shard already
             return None, None
-    except Reference.DoesNotExist:
-        return None, None
+        rem = get_remote(ct, remote_id) if remote_id is not None else None
+        if rem is not None:
+            REFERENCE_CACHE.set(ct, id, remote_id)
+            return rem, remote_id
+    return None, None
+
+
+def save_ref(ct, id, remote_id):
+    """Stores Reference of local object to remote one."""
+    ref, created = get_reference_model(ct).objects.get_or_create(
+        content_type=ct, local_object_id=id, defaults={'remote_object_id': remote_id})
+    if not created and six.text_type(ref.remote_object_id) != six.text_type(remote_id):
+        ref.remote_object_id = remote_id
+        ref.save()
+    REFERENCE_CACHE.set(ct, id, remote_id)
+
+
+class NaturalCache(object):
+    """
+    Remote objects found in advance by natural keys, for a batch of logs.
+    Missing objects are remembered as None.
+    """
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.objects = {}  # (model, normalized key): remote object or None
+        self.keys = {}  # (model, remote pk): normalized key
+        self.models = set()
+
+    def prime(self, model, keys):
+        """Finds remote objects for all keys with as few queries as possible."""
+        manager = model.objects.db_manager(REMOTE)
+        try:
+            keys = dict((normalize_key(key), key) for key in keys)
+        except TypeError:
+            # Unhashable key; leave it to find_natural
+            return
+        keys = [key for k, key in six.iteritems(keys) if (model, k) not in self.objects]
+        if not keys:
+            return
+        found = dict((normalize_key(k), obj) for k, obj in
+                     six.iteritems(manager.get_many_by_natural_keys(keys, settings.BATCH_SIZE)))
+        self.models.add(model)
+        for key in keys:
+            key = normalize_key(key)
+            obj = found.get(key)
+            self.objects[(model, key)] = obj
+            if obj is not None:
+                self.keys[(model, obj.pk)] = key
+
+    def get(self, model, key):
+        """Returns remote object or None. Raises KeyError if key was not primed."""
+        return self.objects[(model, normalize_key(key))]
+
+    def forget(self, model, pk, obj=None):
+        """Drops entries of remote object being saved or deleted (and of obj natural key)."""
+        if model not in self.models:
+            return
+        key = self.keys.pop((model, pk), None)
+        self.objects.pop((model, key), None)
+        try:
+            self.objects.pop((model, normalize_key(obj.natural_key())), None)
+        except (AttributeError, TypeError):
+            pass
+
+NATURAL_CACHE = NaturalCache()
 
 
 def find_natural(ct, loc, key=None):
@@ -45,17 +228,46 @@ def find_natural(ct, loc, key=None):
     try:
         key = key or loc.natural_key()
         model = ct.model_class()
-        return model.objects.db_manager(REMOTE).get_by_natural_key(*key)
+        try:
+            return NATURAL_CACHE.get(model, key)
+        except (KeyError, TypeError):
+            return model.objects.db_manager(REMOTE).get_by_natural_key(*key)
     except (AttributeError, ObjectDoesNotExist):
         return None
 
 
+def prime_natural(logs):
+    """Resolves natural keys of objects to be added or deleted in logs in bulk."""
+    to_add, to_del = {}, {}
+    for log in logs:
+        actions = log.get_actions()
+        if ADDITION in actions:
+            to_add.setdefault(log.content_type, []).append(log.object_id)
+        if DELETION in actions:
+            key = log.get_delete_key()
+            if key is not None:
+                to_del.setdefault(log.content_type, []).append(key)
+    for ct in set(to_add) | set(to_del):
+        model = ct.model_class()
+        if not hasattr(getattr(model, 'objects', None), 'get_many_by_natural_keys'):
+            continue
+        keys = to_del.get(ct, [])
+        if ct in to_add and hasattr(model, 'natural_key'):
+            objects = [PREFETCHED.get(ct, id, pop=False) for id in to_add[ct]]
+            missing = [id for id, obj in zip(to_add[ct], objects) if obj is None]
+            objects = [obj for obj in objects if obj is not None]
+            if missing:
+                objects.extend(model._base_manager.using(local_read).in_bulk(missing).values())
+            keys.extend(obj.natural_key() for obj in objects)
+        NATURAL_CACHE.prime(model, keys)
+
+
 def is_remote_newer(loc, rem):
     try:
         loc_ct = ContentType.objects.get_for_model(loc)
         rem_ct = ContentType.objects.db_manager(REMOTE).get_for_model(rem)
         loc_time = (ChangeLog.objects.filter(content_type=loc_ct, object_id=loc.pk)
-                    .order_by('-date')[0].date)
+                    .order_by('-date').using(local_read)[0].date)
         rem_time = (ChangeLog.objects.filter(content_type=rem_ct, object_id=rem.pk)
                     .order_by('-date').using(REMOTE)[0].date)
         return rem_time >= loc_time
@@ -63,15 +275,17 @@ def is_remote_newer(loc, rem):
         return False
 
 
-def save_with_fks(ct, obj, new_pk):
+def save_with_fks(ct, obj, new_pk, fields=None):
     """
     Saves object in REMOTE, ensuring that every of it fk is present in REMOTE.
     Many-to-many relations are handled separately.
+    If fields are specified, only they are updated.
     """
     old_id = obj.pk
+    NATURAL_CACHE.forget(obj.__class__, new_pk, obj)
     obj._state.db = REMOTE
 
-    fks = (f for f in obj._meta.fields if f.rel)
+    fks = (f for f in obj._meta.fields if f.rel and (fields is None or f.name in fields))
     for f in fks:
         fk_id = f.value_from_object(obj)
         if fk_id is not None:
@@ -80,31 +294,57 @@ def save_with_fks(ct, obj, new_pk):
             f.save_form_data(obj, rem)
 
     obj.pk = new_pk
-    obj.save(using=REMOTE)
-    r, n = Reference.objects.get_or_create(content_type=ct, local_object_id=old_id,
-                                           defaults={'remote_object_id': obj.pk})
-    if not n and r.remote_object_id != obj.pk:
-        r.remote_object_id = obj.pk
-        r.save()
+    obj.save(using=REMOTE, update_fields=fields)
+    save_ref(ct, old_id, obj.pk)
+    queue_files(obj, fields)
 
-M2M_CACHE = {}
 
+def queue_files(obj, fields=None):
+    """Queues files of obj saved on REMOTE to be copied to the remote storage."""
+    if file_sync is not None:
+        file_sync.add(obj, fields)
 
-def save_m2m(ct, obj, remote):
-    """Synchronize m2m fields from obj to remote."""
-    model_name = obj.__class__
 
-    if model_name not in M2M_CACHE:
-        # collect m2m fields information: both direct and reverse
+@contextmanager
+def syncing_files():
+    """Copies files of objects saved on REMOTE in the block; they are all copied on exit."""
+    global file_sync
+    files = file_sync = get_file_sync()
+    try:
+        yield
+    except Exception:
+        exc_info = sys.exc_info()
+        if files is not None:
+            try:
+                files.finish()
+            except Exception:
+                # Keep the original error
+                pass
+        six.reraise(*exc_info)
+    else:
+        if files is not None:
+            files.finish()
+    finally:
+        file_sync = None
+
+M2M_CACHE = {}
+
+
+def get_m2m_fields(model):
+    """
+    Returns information about model m2m fields, both direct and reverse:
+    {accessor name: (related model, through model, my field name, his field attname)}.
+    """
+    if model not in M2M_CACHE:
         res = {}
-        for f in obj._meta.many_to_many:
+        for f in model._meta.many_to_many:
             me = f.m2m_field_name()
             he_id = '%s_id' % f.m2m_reverse_field_name()
             res[f.attname] = (f.rel.to, f.rel.through, me, he_id)
         if VERSION < (1, 8):
-            m2m = obj._meta.get_all_related_many_to_many_objects()
+            m2m = model._meta.get_all_related_many_to_many_objects()
         else:
-            m2m = [f for f in obj._meta.get_fields(include_hidden=True)
+            m2m = [f for f in model._meta.get_fields(include_hidden=True)
                    if f.many_to_many and f.auto_created]
         for rel in m2m:
             f = rel.field
@@ -115,27 +355,47 @@ def save_m2m(ct, obj, remote):
             he_id = '%s_id' % f.m2m_field_name()
             related_model = rel.model if VERSION < (1, 8) else rel.related_model
             res[rel.get_accessor_name()] = (related_model, f.rel.through, me, he_id)
-        M2M_CACHE[model_name] = res
+        M2M_CACHE[model] = res
+    return M2M_CACHE[model]
+
 
+def read_m2m(obj, using):
+    """
+    Returns {field: related objects pks} of obj m2m fields
+    (or {field: intermediary objects} if intermediate model is used).
+    """
+    res = {}
+    for f, (to, through, me, he_id) in six.iteritems(get_m2m_fields(obj.__class__)):
+        if through._meta.auto_created:
+            res[f] = list(getattr(obj, f).using(using).values_list('pk', flat=True))
+        else:
+            res[f] = list(through.objects.filter(**{me: obj}).using(using))
+    return res
+
+
+def save_m2m(ct, obj, remote):
+    """Synchronize m2m fields from obj to remote."""
     _m2m = {}
+    links = PREFETCHED.pop_m2m(ct, obj.pk)
+    if links is None:
+        links = read_m2m(obj, local_read)
 
     # handle m2m fields
-    for f, (to, through, me, he_id) in M2M_CACHE[model_name].iteritems():
+    for f, (to, through, me, he_id) in six.iteritems(get_m2m_fields(obj.__class__)):
         fk_ct = ContentType.objects.get_for_model(to)
         out = []
         if through._meta.auto_created:
-            for fk_id in getattr(obj, f).using(LOCAL).values_list('pk', flat=True):
+            for fk_id in links[f]:
                 rem, _ = ensure_exist(fk_ct, fk_id)
                 out.append(rem)
         else:
             # some intermediate model is used for this m2m
-            inters = through.objects.filter(**{me: obj}).using(LOCAL)
-            for inter in inters:
+            for inter in links[f]:
                 ensure_exist(fk_ct, getattr(inter, he_id))
                 out.append(inter)
         _m2m[f] = not through._meta.auto_created, out
 
-    for f, (intermediary, out) in _m2m.iteritems():
+    for f, (intermediary, out) in six.iteritems(_m2m):
         if not intermediary:
             setattr(remote, f, out)
         else:
@@ -155,32 +415,48 @@ def create_with_fks(ct, obj, pk):
     return save_with_fks(ct, obj, pk)
 
 
-def change_with_fks(ct, obj, rem):
-    """Performs change, but firstly disables synchro of some user defined fields (if any)"""
+def change_with_fks(ct, obj, rem, fields=None):
+    """
+    Performs change, but firstly disables synchro of some user defined fields (if any).
+    If changed fields are known, only they are updated.
+    """
     skip = getattr(obj, 'SYNCHRO_SKIP', ())
     for f in skip:
         setattr(obj, f, getattr(rem, f))
-    return save_with_fks(ct, obj, rem.pk)
+    if fields is not None:
+        fields = [f for f in fields if f not in skip]
+    return save_with_fks(ct, obj, rem.pk, fields)
 
 
 def ensure_exist(ct, id):
     """
     Ensures that remote object exists for specified ct/id. If not, create it.
-    Returns remote object and reference.
+    Returns remote object and its id.
     """
-    obj = ct.get_object_for_this_type(pk=id)
-    rem, ref = find_ref(ct, obj.pk)
+    obj = get_local(ct, id)
+    rem, remote_id = find_ref(ct, obj.pk)
     if rem is not None:
-        return rem, ref
+        return rem, remote_id
     rem = find_natural(ct, obj)
     if rem is not None:
-        ref = Reference.objects.create(content_type=ct, local_object_id=id, remote_object_id=rem.pk)
-        return rem, ref
+        save_ref(ct, id, rem.pk)
+        return rem, rem.pk
     return perform_add(ct, id)
 
 
 def perform_add(ct, id, log=None):
-    obj = ct.get_object_for_this_type(pk=id)
+    obj = get_local(ct, id)
+    if len(settings.CHANNELS) > 1 or sharded or settings.CAPTURE == 'state':
+        # Object may have been created as a foreign key target by another channel (or shard),
+        # or by a shard ahead of the checkpoint of a full run, or, in 'state' mode, its
+        # PendingChange (still flagged as added) may have been kept because it was updated
+        # during the previous synchronization.
+        rem, remote_id = find_ref(ct, obj.pk)
+        if rem is None and shard is not None:
+            rem, remote_id = claim_ref(ct, obj.pk)
+        if rem is not None:
+            change_with_fks(ct, obj, rem)
+            return obj, remote_id
     rem = find_natural(ct, obj)
     if rem is not None:
         if not is_remote_newer(obj, rem):
@@ -190,39 +466,70 @@ def perform_add(ct, id, log=None):
         new_pk = None if obj._meta.has_auto_field else obj.pk
         create_with_fks(ct, obj, new_pk)
         rem = obj
-    ref, _ = Reference.objects.get_or_create(content_type=ct, local_object_id=id,
-                                             remote_object_id=rem.pk)
-    return rem, ref
+    save_ref(ct, id, rem.pk)
+    return rem, rem.pk
 
 
 def perform_chg(ct, id, log=None):
-    obj = ct.get_object_for_this_type(pk=id)
-    rem, ref = find_ref(ct, obj.pk)
+    obj = get_local(ct, id)
+    fields = log.get_changed_fields() if log is not None else None
+    rem, _ = find_ref(ct, obj.pk)
     if rem is not None:
-        return change_with_fks(ct, obj, rem)
+        return change_with_fks(ct, obj, rem, fields)
     rem = find_natural(ct, obj)
     if rem is not None:
-        return change_with_fks(ct, obj, rem)
+        return change_with_fks(ct, obj, rem, fields)
     perform_add(ct, id)
 
 
 def perform_del(ct, id, log):
-    rem, ref = find_ref(ct, id)
+    rem, _ = find_ref(ct, id)
+    if rem is None:
+        key = log.get_delete_key()
+        if key is not None:
+            rem = find_natural(ct, None, key)
     if rem is not None:
-        return rem.delete()
-    try:
-        raw_key = log.deletekey.key
-        key = eval(raw_key)
-        rem = find_natural(ct, None, key)
-        if rem is not None:
-            rem.delete()
-    except DeleteKey.DoesNotExist:
-        pass
+        NATURAL_CACHE.forget(rem.__class__, rem.pk)
+        rem.delete()
+
+
+def perform_del_many(ct, logs):
+    """
+    Deletes remote objects of several logs of the same content type at once.
+    Remote objects are found by References (or natural keys) in bulk and removed with
+    one queryset delete; their References are removed as well.
+    """
+    model = ct.model_class()
+    ids = [log.object_id for log in logs]
+    refs = get_reference_model(ct).objects.filter(content_type=ct, local_object_id__in=ids)
+    remote_ids = dict((six.text_type(local_id), six.text_type(remote_id)) for local_id, remote_id
+                      in refs.values_list('local_object_id', 'remote_object_id'))
+    manager = model._base_manager.db_manager(REMOTE)
+    existing = set(six.text_type(pk) for pk in manager.filter(pk__in=remote_ids.values())
+                   .values_list('pk', flat=True))
+    pks = []
+    for log in logs:
+        remote_id = remote_ids.get(log.object_id)
+        if remote_id in existing:
+            pks.append(remote_id)
+            continue
+        key = log.get_delete_key()
+        if key is not None:
+            rem = find_natural(ct, None, key)
+            if rem is not None:
+                pks.append(rem.pk)
+    for pk in pks:
+        NATURAL_CACHE.forget(model, pk)
+    for chunk in chunked(pks, settings.BATCH_SIZE):
+        manager.filter(pk__in=chunk).delete()
+    refs.delete()
+    for id in ids:
+        REFERENCE_CACHE.forget(ct, id)
 
 
 def perform_m2m(ct, id, log=None):
-    obj = ct.get_object_for_this_type(pk=id)
-    rem, ref = find_ref(ct, obj.pk)
+    obj = get_local(ct, id)
+    rem, _ = find_ref(ct, obj.pk)
     if rem is not None:
         return save_m2m(ct, obj, rem)
     rem = find_natural(ct, obj)
@@ -240,6 +547,424 @@ ACTIONS = {
 }
 
 
+def get_channel_filter(channel):
+    """Returns Q limiting ChangeLogs (or PendingChanges) to channel models."""
+    if channel.name != settings.DEFAULT_CHANNEL:
+        cts = ContentType.objects.get_for_models(*channel.models).values()
+        return Q(content_type__in=cts)
+    others = [m for c in settings.CHANNELS for m in c.models]
+    if not others:
+        return Q()
+    return ~Q(content_type__in=ContentType.objects.get_for_models(*others).values())
+
+
+def parse_shard(spec):
+    """Returns (index, count) of shard given as "i/N". Raises ValueError."""
+    index, count = [int(n) for n in spec.split('/')]
+    if not 0 <= index < count:
+        raise ValueError(spec)
+    return index, count
+
+
+def get_shard_name(channel, shard):
+    return '%s@%d/%d' % (channel.name, shard[0], shard[1])
+
+
+def has_shard_states():
+    """Returns whether any shard was ever synchronized separately."""
+    return ChannelState.objects.filter(name__contains='@').exists()
+
+
+def in_shard(log, shard):
+    """Returns whether object of the log belongs to the shard (stable across processes)."""
+    key = '%s:%s' % (log.content_type_id, log.object_id)
+    return (zlib.crc32(key.encode('utf-8')) & 0xffffffff) % shard[1] == shard[0]
+
+
+def get_checkpoint(channel, shard=None, create=True):
+    """
+    Returns (date, pk) of the last log synchronized in channel (or its shard).
+    Unless create is False (for read-only inspection), state of a new channel (or shard) is stored.
+    """
+    since, since_id = app_options.last_check, app_options.last_check_id or 0
+    names = []
+    if channel.name != settings.DEFAULT_CHANNEL:
+        names.append(channel.name)
+    if shard is not None:
+        names.append(get_shard_name(channel, shard))
+    for name in names:
+        # New channel (or shard) starts at the checkpoint of the whole
+        if create:
+            state, _ = ChannelState.objects.get_or_create(
+                name=name, defaults={'last_check': since, 'last_check_id': since_id})
+            since, since_id = state.last_check, state.last_check_id
+        else:
+            state = ChannelState.objects.filter(name=name).values_list(
+                'last_check', 'last_check_id').first()
+            if state is not None:
+                since, since_id = state
+    return since, since_id
+
+
+def get_pending_logs(channel, shard=None, create=True):
+    """
+    Returns ordered logs of channel awaiting synchronization and the last of them
+    (that is, new checkpoint). See get_checkpoint for create.
+    Logs saved later are not included, even if they are saved while the result is processed.
+    """
+    since, since_id = get_checkpoint(channel, shard, create)
+    # Keyset conditions: logs sharing date with the checkpoint are told apart by pk.
+    logs = ChangeLog.objects.using(local_read).filter(get_channel_filter(channel),
+                                    Q(date__gt=since) | Q(date=since, pk__gt=since_id))
+    last = logs.order_by('-date', '-pk').first()
+    if last is None:
+        return logs.none(), None
+    logs = logs.filter(Q(date__lt=last.date) | Q(date=last.date, pk__lte=last.pk))
+    return logs.select_related().order_by('date', 'pk'), last
+
+
+def get_pending_changes(channel):
+    """
+    Returns PendingChanges of channel awaiting synchronization.
+    Changes recorded later (for example during synchronization) are not included.
+    """
+    return PendingChange.objects.filter(get_channel_filter(channel), date__lt=now())
+
+
+def clear_pending(performed):
+    """
+    Deletes performed PendingChanges, given as (pk, date), unless they were updated since.
+    Rows are matched by date too, since the date of an update is set before it is committed.
+    """
+    # Short OR chains, so that no database limit of expression depth is reached
+    for chunk in chunked(performed, 100):
+        done = reduce(operator.or_, (Q(pk=pk, date=date) for pk, date in chunk))
+        PendingChange.objects.filter(done).delete()
+
+
+def store_checkpoint(channel, date, pk):
+    if channel.name == settings.DEFAULT_CHANNEL:
+        app_options.last_check = date
+        app_options.last_check_id = pk
+    else:
+        ChannelState.objects.filter(name=channel.name).update(last_check=date, last_check_id=pk)
+
+
+def set_checkpoint(last, channel, shard=None):
+    if shard is None:
+        store_checkpoint(channel, last.date, last.pk)
+        return
+    ChannelState.objects.filter(name=get_shard_name(channel, shard)).update(
+        last_check=last.date, last_check_id=last.pk)
+    # Channel is synchronized up to the least advanced of its shards
+    names = [get_shard_name(channel, (i, shard[1])) for i in range(shard[1])]
+    states = ChannelState.objects.filter(name__in=names).values_list('last_check', 'last_check_id')
+    if len(states) == shard[1]:
+        store_checkpoint(channel, *min(states))
+
+
+def compact(logs):
+    """
+    Yields logs which should be performed.
+    Don't synchronize if object should be added/changed and later deleted.
+    """
+    to_del = dict(((ct_id, id), date) for ct_id, id, date in
+                  logs.filter(action=DELETION).values_list('content_type', 'object_id', 'date'))
+    for log in logs.iterator():
+        key = (log.content_type_id, log.object_id)
+        del_time = to_del.get(key)
+        if log.date == del_time and log.action == DELETION:
+            # delete record so that next actions with the same time can be performed
+            del to_del[key]
+            yield log
+        elif del_time is None or log.date > del_time:
+            yield log
+
+
+def prefetch(batch, using):
+    """Reads LOCAL objects (and m2m relations) needed to perform batch of logs."""
+    ids = {}
+    for log in batch:
+        if log.get_actions() != [DELETION]:
+            ids.setdefault(log.content_type, []).append(log.object_id)
+    objects = {}
+    for ct, pks in six.iteritems(ids):
+        for pk, obj in six.iteritems(ct.model_class()._base_manager.using(using).in_bulk(pks)):
+            objects[(ct.pk, six.text_type(pk))] = obj
+    m2m = {}
+    for log in batch:
+        key = (log.content_type_id, log.object_id)
+        if M2M_CHANGE in log.get_actions() and key in objects and key not in m2m:
+            m2m[key] = read_m2m(objects[key], using)
+    return objects, m2m
+
+
+# Statements making transaction see a consistent snapshot of the database
+SNAPSHOT_ISOLATION = {
+    'postgresql': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+    'mysql': 'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+}
+
+
+@contextmanager
+def read_snapshot(using):
+    """
+    Runs the block in one transaction on using, which reads a consistent snapshot of the database
+    (REPEATABLE READ on PostgreSQL and MySQL; SQLite transactions are isolated anyway).
+    Yields PostgreSQL snapshot id (to be imported by other connections) or None.
+    """
+    connection = connections[using]
+    statement = SNAPSHOT_ISOLATION.get(connection.vendor)
+    if statement is not None and connection.in_atomic_block:
+        raise TransactionManagementError(
+            'Cannot read a snapshot of %s database inside a transaction.' % using)
+    with transaction.atomic(using=using):
+        snapshot_id = None
+        if statement is not None:
+            with connection.cursor() as cursor:
+                cursor.execute(statement)
+                if connection.vendor == 'postgresql':
+                    cursor.execute('SELECT pg_export_snapshot()')
+                    snapshot_id = cursor.fetchone()[0]
+        yield snapshot_id
+
+
+@contextmanager
+def import_snapshot(using, snapshot_id):
+    """Runs the block in a transaction on using, which reads PostgreSQL snapshot of given id."""
+    with transaction.atomic(using=using):
+        with connections[using].cursor() as cursor:
+            cursor.execute(SNAPSHOT_ISOLATION['postgresql'])
+            cursor.execute('SET TRANSACTION SNAPSHOT %s', [snapshot_id])
+        yield
+
+
+def is_in_memory(connection):
+    """In-memory SQLite database cannot be opened by another connection (and thread)."""
+    return connection.vendor == 'sqlite' and connection.is_in_memory_db()
+
+
+def produce(batches, using, queue, stop, shared=None, snapshot_id=None):
+    """
+    Puts batches, along with their prefetched LOCAL data, into queue (run in a thread).
+    Shared connection is used instead of opening a new one. If snapshot_id is given,
+    data is read from that PostgreSQL snapshot.
+    """
+    def put(item):
+        while not stop.is_set():
+            try:
+                return queue.put(item, timeout=0.1)
+            except Full:
+                pass
+
+    def run():
+        for batch in batches:
+            put((batch, prefetch(batch, using), None))
+        put(None)
+
+    if shared is not None:
+        connections[using] = shared
+    try:
+        if snapshot_id is not None:
+            with import_snapshot(using, snapshot_id):
+                run()
+        else:
+            run()
+    except Exception:
+        put((None, None, sys.exc_info()))
+    finally:
+        # Connections opened by this thread
+        for connection in connections.all():
+            if connection is not shared:
+                connection.close()
+
+
+def share_connection(connection, share):
+    if VERSION < (2, 2):
+        connection.allow_thread_sharing = share
+    elif share:
+        connection.inc_thread_sharing()
+    else:
+        connection.dec_thread_sharing()
+
+
+def pipelined(batches, using, snapshot_id=None):
+    """
+    Yields batches, reading them and prefetching their LOCAL data in a separate thread
+    while the previous batch is performed. Prefetched data is used by get_local and save_m2m.
+    """
+    queue = Queue(settings.PIPELINE_DEPTH)
+    stop = Event()
+    shared = connections[using]
+    if is_in_memory(shared):
+        share_connection(shared, True)
+    else:
+        shared = None
+    producer = Thread(target=produce, args=(batches, using, queue, stop, shared, snapshot_id),
+                      name='synchro-producer')
+    producer.daemon = True
+    producer.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            batch, prefetched, exc_info = item
+            if exc_info is not None:
+                six.reraise(*exc_info)
+            PREFETCHED.objects, PREFETCHED.m2m = prefetched
+            yield batch
+    finally:
+        stop.set()
+        PREFETCHED.clear()
+        producer.join()
+        if shared is not None:
+            share_connection(shared, False)
+
+
+def perform_actions(log):
+    """Performs all actions of ChangeLog or PendingChange."""
+    for action in log.get_actions():
+        ACTIONS[action](log.content_type, log.object_id, log)
+
+
+def perform_batch(logs):
+    """
+    Performs actions of logs in order.
+    Consecutive deletions of objects of the same content type are performed together.
+    """
+    def deletion_ct(log):
+        return log.get_actions() == [DELETION] and log.content_type_id
+    for ct_id, group in groupby(logs, deletion_ct):
+        group = list(group)
+        if ct_id and len(group) > 1:
+            perform_del_many(group[0].content_type, group)
+        else:
+            for log in group:
+                perform_actions(log)
+
+
+# Errors of the database rather than of the change (e.g. lost connection); never quarantined
+TRANSIENT_ERRORS = (InterfaceError, OperationalError)
+
+
+def get_quarantined(logs):
+    """Returns {(ct id, object id): QuarantinedChange} of objects of logs, which are quarantined."""
+    keys = set((log.content_type_id, log.object_id) for log in logs)
+    res = {}
+    for chunk in chunked(set(id for _, id in keys), settings.BATCH_SIZE):
+        for q in QuarantinedChange.objects.filter(object_id__in=chunk):
+            if (q.content_type_id, q.object_id) in keys:
+                res[(q.content_type_id, q.object_id)] = q
+    return res
+
+
+def quarantine(log, error, quarantined):
+    """
+    Records actions of log which failed (or whose object is quarantined already) in
+    QuarantinedChange. quarantined is a dict returned by get_quarantined, updated in place.
+    """
+    key = (log.content_type_id, log.object_id)
+    q = quarantined.get(key)
+    if q is None:
+        q = quarantined[key] = QuarantinedChange(content_type_id=log.content_type_id,
+                                                 object_id=log.object_id, attempts=0)
+    for action in log.get_actions():
+        q.merge(action, log.key, log.fields)
+    q.date = log.date
+    if error is not None:
+        q.error = u'%s: %s' % (error.__class__.__name__, error)
+        q.traceback = traceback.format_exc()
+        q.attempts += 1
+    q.save()
+
+
+def forget_caches():
+    """Clears caches which may refer to objects rolled back on REMOTE."""
+    NATURAL_CACHE.clear()
+    REFERENCE_CACHE.clear()
+
+
+def perform_isolated(logs):
+    """
+    Performs batch of logs; if it fails, performs logs one by one, each in its own savepoint.
+    Failing logs (and the following ones of the same objects) are quarantined.
+    Returns number of quarantined logs.
+    """
+    quarantined = get_quarantined(logs)
+    count = 0
+    pending = []
+    for log in logs:
+        if (log.content_type_id, log.object_id) in quarantined:
+            # Keep order of changes of the object
+            quarantine(log, None, quarantined)
+            count += 1
+        else:
+            pending.append(log)
+    try:
+        with transaction.atomic(using=LOCAL), transaction.atomic(using=REMOTE):
+            perform_batch(pending)
+        return count
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception:
+        forget_caches()
+    for log in pending:
+        if (log.content_type_id, log.object_id) in quarantined:
+            quarantine(log, None, quarantined)
+            count += 1
+            continue
+        try:
+            with transaction.atomic(using=LOCAL), transaction.atomic(using=REMOTE):
+                perform_actions(log)
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            forget_caches()
+            quarantine(log, e, quarantined)
+            count += 1
+    return count
+
+
+def retry_quarantined():
+    """Retries quarantined changes, deleting successful ones. Returns (retried, still failing)."""
+    failed = 0
+    changes = list(QuarantinedChange.objects.select_related('content_type').order_by('date', 'pk'))
+    for q in changes:
+        try:
+            with transaction.atomic(using=LOCAL), transaction.atomic(using=REMOTE):
+                perform_actions(q)
+                q.delete()
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            forget_caches()
+            q.error = u'%s: %s' % (e.__class__.__name__, e)
+            q.traceback = traceback.format_exc()
+            q.attempts += 1
+            q.save()
+            failed += 1
+        finally:
+            NATURAL_CACHE.clear()
+    return len(changes), failed
+
+
+class SynchronizationCancelled(Exception):
+    """Raised when synchronization is cancelled (see cancel option of call_synchronize)."""
+
+
+class LeaseLost(SynchronizationCancelled):
+    """Raised when the lease of synchronization run could not be renewed."""
+
+
+def record_run(start, count, error=None):
+    """Stores statistics of synchronization run (see synchro.metrics)."""
+    app_options.last_run = datetime.now()
+    app_options.last_run_duration = time() - start
+    app_options.last_run_count = count
+    app_options.last_error = u'%s: %s' % (error.__class__.__name__, error) if error else u''
+
+
 class Command(BaseCommand):
     args = ''
     help = '''Perform synchronization.'''
@@ -247,45 +972,220 @@ class Command(BaseCommand):
     def handle(self, *args, **options):
         # ``synchronize`` is extracted from ``handle`` since call_command has
         # no easy way of returning a result
-        ret = self.synchronize(*args, **options)
+        try:
+            ret = self.synchronize(*args, **options)
+        except LeaseUnavailable as e:
+            raise CommandError(e)
         if options['verbosity'] > 0:
             self.stdout.write(u'%s\n' % ret)
 
-    @transaction.atomic
-    @transaction.atomic(using=REMOTE)
+    def add_arguments(self, parser):
+        parser.add_argument('--channel', action='append', dest='channels',
+                            help='Synchronize only given channel (may be repeated).')
+        parser.add_argument('--profile', dest='profile', metavar='PREFIX',
+                            help='Profile synchronization; write PREFIX.prof and PREFIX.sql.jsonl '
+                                 'and report the most expensive queries.')
+        parser.add_argument('--pipeline', action='store_true', dest='pipeline',
+                            help='Read LOCAL data in a separate thread, while writing to REMOTE.')
+        parser.add_argument('--snapshot', action='store_true', dest='snapshot',
+                            help='Read LOCAL data from a consistent snapshot, in one transaction.')
+        parser.add_argument('--quarantine', action='store_true', dest='quarantine',
+                            help='Record failing changes in QuarantinedChange and go on.')
+        parser.add_argument('--shard', dest='shard', metavar='I/N',
+                            help='Synchronize only I-th of N shards of objects (counted from 0).')
+
     def synchronize(self, *args, **options):
+        self.count = 0
+        self.pipeline = options.get('pipeline') or settings.PIPELINE
+        self.quarantine = options.get('quarantine') or settings.QUARANTINE
+        self.quarantined = 0
+        # Hooks for calling code (see synchro.aio): progress(event) is called after every batch;
+        # synchronization is cancelled before the next batch once cancel.is_set().
+        self.progress = options.get('progress')
+        self.cancel = options.get('cancel')
+        self.shard = self.get_shard(**options)
+        self.lease = None
+        ttl = options.get('lease_ttl', settings.LEASE_TTL)
+        if ttl:
+            # Shards hold separate leases, but none of them can be held during a full run
+            if self.shard is None:
+                self.lease = Lease('synchronize', ttl, conflicts=Q(name__startswith='synchronize@'))
+            else:
+                self.lease = Lease('synchronize@%d/%d' % self.shard, ttl,
+                                   conflicts=Q(name='synchronize'))
+            # Raises LeaseUnavailable, before the run is recorded
+            self.lease.acquire()
+        try:
+            return self.run(start=time(), **options)
+        finally:
+            if self.lease is not None:
+                self.lease.release()
+
+    def run(self, start, **options):
+        try:
+            if not options.get('profile'):
+                ret = self.synchronize_channels(**options)
+            else:
+                from synchro.profiling import SyncProfiler
+                aliases = (LOCAL, settings.LOCAL_READ, REMOTE)
+                with SyncProfiler(options['profile'], aliases) as profiler:
+                    ret = self.synchronize_channels(**options)
+                ret = u'%s\n%s' % (ret, profiler.report())
+        except Exception as e:
+            exc_info = sys.exc_info()
+            # Changes of the failed channel were rolled back on REMOTE
+            forget_caches()
+            try:
+                record_run(start, self.count, e)
+            except DatabaseError:
+                # LOCAL is unusable (e.g. in a broken transaction); keep the original error
+                pass
+            six.reraise(*exc_info)
+        record_run(start, self.count)
+        return ret
+
+    def synchronize_channels(self, **options):
+        # Because of BaseCommand bug (#18387, fixed in Django 1.5), we cannot use CommandError
+        # in tests. Hence this hook.
+        exception_class = options.get('exception_class', CommandError)
         if REMOTE is None:
-            # Because of BaseCommand bug (#18387, fixed in Django 1.5), we cannot use CommandError
-            # in tests. Hence this hook.
-            exception_class = options.get('exception_class', CommandError)
             raise exception_class('No REMOTE database specified in settings.')
 
-        since = app_options.last_check
-        last_time = datetime.now()
-        logs = ChangeLog.objects.filter(date__gt=since).select_related().order_by('date', 'pk')
-
-        # Don't synchronize if object should be added/changed and later deleted;
-        to_del = {}
-        for log in logs:
-            if log.action == DELETION:
-                to_del[(log.content_type, log.object_id)] = log.date
-
-        for log in logs:
-            last_time = log.date
-            del_time = to_del.get((log.content_type, log.object_id))
-            if last_time == del_time and log.action == DELETION:
-                ACTIONS[log.action](log.content_type, log.object_id, log)
-                # delete record so that next actions with the same time can be performed
-                del to_del[(log.content_type, log.object_id)]
-            if del_time is None or last_time > del_time:
-                ACTIONS[log.action](log.content_type, log.object_id, log)
-
-        if len(logs):
-            app_options.last_check = last_time
+        channels = settings.CHANNELS
+        names = options.get('channels')
+        if names:
+            unknown = set(names) - set(c.name for c in channels)
+            if unknown:
+                raise exception_class('Unknown channel: %s.' % ', '.join(sorted(unknown)))
+            channels = [c for c in channels if c.name in names]
+
+        global local_read, shard, sharded
+        shard = self.shard
+        sharded = shard is not None or has_shard_states()
+        local_read = get_read_alias()
+        # Channels are ordered by priority; each one is committed separately
+        # (unless snapshot is read - then all of them are committed at once).
+        performed = False
+        try:
+            with self.read_snapshot(options.get('snapshot') or settings.SNAPSHOT):
+                for channel in channels:
+                    if settings.CAPTURE == 'state':
+                        performed |= self.synchronize_pending(channel)
+                    else:
+                        performed |= self.synchronize_channel(channel)
+        finally:
+            local_read = LOCAL
+            shard = None
+            sharded = False
+
+        if self.quarantined:
+            return _t('Synchronization performed; %d changes quarantined.') % self.quarantined
+        if performed:
             return _t('Synchronization performed successfully.')
         else:
             return _t('No changes since last synchronization.')
 
+    def get_shard(self, **options):
+        """Returns (index, count) of shard given in options or None."""
+        if not options.get('shard'):
+            return None
+        exception_class = options.get('exception_class', CommandError)
+        if settings.CAPTURE == 'state':
+            raise exception_class('Sharding requires SYNCHRO_CAPTURE = "log".')
+        try:
+            return parse_shard(options['shard'])
+        except ValueError:
+            raise exception_class('Invalid shard: %s (expected I/N).' % options['shard'])
+
+    @contextmanager
+    def read_snapshot(self, enabled):
+        """Performs the block reading LOCAL snapshot, if enabled."""
+        self.snapshot_id = None
+        if not enabled:
+            yield
+            return
+        with read_snapshot(local_read) as snapshot_id:
+            self.snapshot_id = snapshot_id
+            if snapshot_id is None and not is_in_memory(connections[local_read]):
+                # Reading thread would not see the snapshot
+                self.pipeline = False
+            yield
+
+    def check_cancel(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise SynchronizationCancelled('Synchronization cancelled.')
+        if self.lease is not None and self.lease.lost.is_set():
+            raise LeaseLost('Lease of synchronization run was lost.')
+
+    def report(self, channel, batch_size):
+        if self.progress is not None:
+            self.progress({'channel': channel.name, 'batch': batch_size, 'count': self.count})
+
+    def perform(self, batch):
+        prime_natural(batch)
+        if self.quarantine:
+            self.quarantined += perform_isolated(batch)
+        else:
+            perform_batch(batch)
+
+    def get_batches(self, items, size):
+        batches = chunked(items, size)
+        if self.pipeline:
+            batches = pipelined(batches, local_read, self.snapshot_id)
+        return batches
+
+    @transaction.atomic
+    @transaction.atomic(using=REMOTE)
+    def synchronize_channel(self, channel):
+        """Synchronizes logs of the channel. Returns whether there were any."""
+        logs, last = get_pending_logs(channel, shard)
+        logs = compact(logs)
+        if shard is not None:
+            # Objects of other shards are skipped (unless needed as foreign key targets)
+            logs = (log for log in logs if in_shard(log, shard))
+        batches = self.get_batches(logs, channel.batch_size)
+        try:
+            with syncing_files():
+                for batch in batches:
+                    self.check_cancel()
+                    self.perform(batch)
+                    self.count += len(batch)
+                    NATURAL_CACHE.clear()
+                    self.report(channel, len(batch))
+        finally:
+            NATURAL_CACHE.clear()
+
+        if last is None:
+            return False
+        set_checkpoint(last, channel, shard)
+        return True
+
+    @transaction.atomic
+    @transaction.atomic(using=REMOTE)
+    def synchronize_pending(self, channel):
+        """Synchronizes objects of the channel recorded as PendingChange and clears them."""
+        changes = get_pending_changes(channel)
+        performed = []
+        batches = self.get_batches(changes.select_related().order_by('date', 'pk').iterator(),
+                                   channel.batch_size)
+        try:
+            with syncing_files():
+                for batch in batches:
+                    self.check_cancel()
+                    self.perform(batch)
+                    performed.extend((change.pk, change.date) for change in batch)
+                    self.count += len(batch)
+                    NATURAL_CACHE.clear()
+                    self.report(channel, len(batch))
+        finally:
+            NATURAL_CACHE.clear()
+
+        if not performed:
+            return False
+        clear_pending(performed)
+        app_options.last_check = datetime.now()
+        return True
+
 
 def call_synchronize(**kwargs):
     "Shortcut to call management command and get return message."
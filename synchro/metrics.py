@@ -0,0 +1,156 @@
+"""
+Synchronization backlog and replication lag metrics.
+
+``get_metrics`` collects them with aggregate (and read-only) queries, backed by ChangeLog indexes,
+and caches the result for ``SYNCHRO_METRICS_CACHE`` seconds; ``render_metrics`` formats them in
+Prometheus text exposition format.
+"""
+import calendar
+from datetime import datetime
+import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connections
+from django.db.models import Count
+from django.utils import six, timezone
+
+from synchro import settings
+from synchro.management.commands.synchronize import (
+    get_checkpoint, get_pending_changes, get_pending_logs)
+from synchro.models import QuarantinedChange, REFERENCE_MODELS, options
+
+CACHE_KEY = 'synchro_metrics'
+
+
+def count_references():
+    """Returns (estimated on PostgreSQL) number of References."""
+    return sum(count_rows(model) for model in REFERENCE_MODELS)
+
+
+def count_rows(model):
+    connection = connections[settings.LOCAL]
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s',
+                           [model._meta.db_table])
+            row = cursor.fetchone()
+        if row is not None and row[0] >= 0:
+            return int(row[0])
+    return model.objects.count()
+
+
+def get_channel_metrics(channel):
+    """Returns ({model label: pending changes}, date of the oldest pending change or None)."""
+    if settings.CAPTURE == 'state':
+        pending = get_pending_changes(channel)
+        oldest = pending.order_by('date').values_list('date', flat=True).first()
+    else:
+        pending, last = get_pending_logs(channel, create=False)
+        oldest = pending.values_list('date', flat=True).first() if last is not None else None
+    counts = pending.order_by().values_list('content_type').annotate(Count('pk'))
+    res = {}
+    for ct_id, count in counts:
+        model = ContentType.objects.get_for_id(ct_id).model_class()
+        label = ('%s.%s' % (model._meta.app_label, model._meta.model_name) if model is not None
+                 else str(ct_id))
+        res[label] = count
+    return res, oldest
+
+
+def _age(value):
+    now = timezone.now() if timezone.is_aware(value) else datetime.now()
+    return (now - value).total_seconds()
+
+
+def collect_metrics():
+    channels = {}
+    for channel in settings.CHANNELS:
+        pending, oldest = get_channel_metrics(channel)
+        last_check = get_checkpoint(channel, create=False)[0] if settings.CAPTURE == 'log' else None
+        channels[channel.name] = {
+            'pending': pending,
+            'oldest_pending_age': _age(oldest) if oldest else 0.0,
+            'last_check': last_check,
+        }
+    duration = options.last_run_duration
+    count = options.last_run_count
+    return {
+        'channels': channels,
+        'last_run': options.last_run,
+        'last_run_duration': duration,
+        'last_run_count': count,
+        'last_run_throughput': count / duration if duration and count is not None else None,
+        'last_error': options.last_error or None,
+        'references': count_references(),
+        'quarantined': QuarantinedChange.objects.count(),
+    }
+
+
+def get_metrics():
+    """
+    Returns dict of metrics:
+    channels ({name: {pending: {model: count}, oldest_pending_age, last_check}}), last_run,
+    last_run_duration, last_run_count, last_run_throughput, last_error, references and quarantined.
+    """
+    metrics = cache.get(CACHE_KEY) if settings.METRICS_CACHE else None
+    if metrics is None:
+        metrics = collect_metrics()
+        if settings.METRICS_CACHE:
+            cache.set(CACHE_KEY, metrics, settings.METRICS_CACHE)
+    return metrics
+
+
+def _label(value):
+    return six.text_type(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _timestamp(value):
+    if timezone.is_aware(value):
+        seconds = calendar.timegm(value.utctimetuple())
+    else:
+        seconds = time.mktime(value.timetuple())
+    return seconds + value.microsecond / 1e6
+
+
+def render_metrics(metrics):
+    """Formats metrics in Prometheus text exposition format."""
+    lines = []
+
+    def metric(name, help_text, samples):
+        lines.append(u'# HELP synchro_%s %s' % (name, help_text))
+        lines.append(u'# TYPE synchro_%s gauge' % name)
+        for labels, value in samples:
+            if value is None:
+                continue
+            labels = u','.join(u'%s="%s"' % (k, _label(v)) for k, v in sorted(labels.items()))
+            lines.append(u'synchro_%s%s %s' % (name, u'{%s}' % labels if labels else u'',
+                                               repr(float(value))))
+
+    channels = sorted(metrics['channels'].items())
+    metric('pending_changes', 'Changes awaiting synchronization.',
+           [({'channel': name, 'model': model}, count)
+            for name, data in channels for model, count in sorted(data['pending'].items())])
+    metric('oldest_pending_age_seconds', 'Age of the oldest change awaiting synchronization.',
+           [({'channel': name}, data['oldest_pending_age']) for name, data in channels])
+    metric('checkpoint_timestamp_seconds', 'Date of the last synchronized change.',
+           [({'channel': name}, _timestamp(data['last_check']) if data['last_check'] else None)
+            for name, data in channels])
+    last_run = metrics['last_run']
+    metric('last_run_timestamp_seconds', 'Time of the last synchronization run.',
+           [({}, _timestamp(last_run) if last_run else None)])
+    metric('last_run_duration_seconds', 'Duration of the last synchronization run.',
+           [({}, metrics['last_run_duration'])])
+    metric('last_run_changes', 'Changes performed in the last synchronization run.',
+           [({}, metrics['last_run_count'])])
+    metric('last_run_throughput', 'Changes per second in the last synchronization run.',
+           [({}, metrics['last_run_throughput'])])
+    metric('last_run_failed', 'Whether the last synchronization run failed.',
+           [({}, 1 if metrics['last_error'] else 0)])
+    metric('last_error_info', 'Error of the last synchronization run.',
+           [({'error': metrics['last_error']}, 1)] if metrics['last_error'] else [])
+    metric('references', 'Number of References (estimated on PostgreSQL).',
+           [({}, metrics['references'])])
+    metric('quarantined_changes', 'Changes which failed to synchronize.',
+           [({}, metrics['quarantined'])])
+    return u'\n'.join(lines) + u'\n'
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+from synchro.utility import decode_key, decode_legacy_key, encode_key
+
+
+def convert_keys(apps, schema_editor):
+    """Moves delete keys stored as reprs in DeleteKey into ChangeLog.key."""
+    using = schema_editor.connection.alias
+    ChangeLog = apps.get_model('synchro', 'ChangeLog')
+    DeleteKey = apps.get_model('synchro', 'DeleteKey')
+    converted = []
+    for pk, changelog_id, raw in DeleteKey.objects.using(using).values_list(
+            'pk', 'changelog', 'key').iterator():
+        try:
+            key = encode_key(decode_legacy_key(raw))
+        except (ValueError, TypeError):
+            # Left in DeleteKey; ChangeLog.get_delete_key reports it when used
+            continue
+        ChangeLog.objects.using(using).filter(pk=changelog_id).update(key=key)
+        converted.append(pk)
+    for i in range(0, len(converted), 500):
+        DeleteKey.objects.using(using).filter(pk__in=converted[i:i + 500]).delete()
+
+
+def restore_keys(apps, schema_editor):
+    """Moves delete keys back into DeleteKey (as reprs, as stored by versions prior to 0.8)."""
+    using = schema_editor.connection.alias
+    ChangeLog = apps.get_model('synchro', 'ChangeLog')
+    DeleteKey = apps.get_model('synchro', 'DeleteKey')
+    DeleteKey.objects.using(using).bulk_create(
+        DeleteKey(changelog_id=pk, key=repr(decode_key(key))) for pk, key in
+        ChangeLog.objects.using(using).filter(key__isnull=False).values_list('pk', 'key'))
+
+
+class Migration(migrations.Migration):
+    """
+    Schema added in 0.8: changed fields and delete keys of ChangeLog, indexes used by keyset
+    checkpoints and remote id lookups, and models of capture modes, channels, typed and imported
+    references, leases and quarantine.
+    """
+
+    dependencies = [
+        ('contenttypes', '__first__'),
+        ('synchro', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChannelState',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('last_check', models.DateTimeField()),
+                ('last_check_id', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ImportReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_object_id', models.CharField(max_length=20)),
+                ('local_object_id', models.CharField(max_length=20)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='IntegerReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('local_object_id', models.BigIntegerField()),
+                ('remote_object_id', models.BigIntegerField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PendingChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=20)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actions', models.PositiveSmallIntegerField(default=0)),
+                ('key', models.TextField(blank=True, null=True)),
+                ('fields', models.TextField(blank=True, null=True)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='QuarantinedChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('object_id', models.CharField(max_length=20)),
+                ('date', models.DateTimeField(default=django.utils.timezone.now)),
+                ('actions', models.PositiveSmallIntegerField(default=0)),
+                ('key', models.TextField(blank=True, null=True)),
+                ('fields', models.TextField(blank=True, null=True)),
+                ('error', models.TextField()),
+                ('traceback', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('quarantined', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='SyncLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+                ('owner', models.CharField(blank=True, max_length=200)),
+                ('acquired', models.DateTimeField(null=True)),
+                ('expires', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='changelog',
+            name='fields',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='changelog',
+            name='key',
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.RunPython(convert_keys, restore_keys),
+        migrations.AlterIndexTogether(
+            name='changelog',
+            index_together=set([('date', 'id'), ('content_type', 'date', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='reference',
+            index_together=set([('content_type', 'remote_object_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='quarantinedchange',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='pendingchange',
+            unique_together=set([('content_type', 'object_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='integerreference',
+            unique_together=set([('content_type', 'local_object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='integerreference',
+            index_together=set([('content_type', 'remote_object_id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='importreference',
+            unique_together=set([('content_type', 'source_object_id')]),
+        ),
+    ]
+
+if hasattr(models, 'UUIDField'):
+    # Django < 1.8 has no UUIDField (see synchro.models)
+    Migration.operations += [
+        migrations.CreateModel(
+            name='UUIDReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('local_object_id', models.UUIDField()),
+                ('remote_object_id', models.UUIDField()),
+                ('content_type', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='contenttypes.ContentType')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='uuidreference',
+            unique_together=set([('content_type', 'local_object_id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='uuidreference',
+            index_together=set([('content_type', 'remote_object_id')]),
+        ),
+    ]
@@ -1,11 +1,18 @@
+from collections import OrderedDict
+
 import django
 from django.contrib.admin.models import ADDITION, CHANGE, DELETION
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.db import models
+from django.utils import six
+from django.utils.encoding import python_2_unicode_compatible
 from django.utils.timezone import now
 import dbsettings
 
+from synchro import settings
+from synchro.utility import decode_key, decode_legacy_key
+
 
 M2M_CHANGE = 4
 
@@ -17,11 +24,50 @@ ACTIONS = (
 )
 
 
+class PreciseDateTimeValue(dbsettings.DateTimeValue):
+    """DateTimeValue that keeps microseconds, so that it can be compared with ChangeLog dates."""
+    def get_db_prep_save(self, value):
+        if isinstance(value, six.string_types):
+            return value
+        return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
 class SynchroSettings(dbsettings.Group):
-    last_check = dbsettings.DateTimeValue('Last synchronization', default=now())
+    # Checkpoint is (date, pk) of the last synchronized ChangeLog.
+    last_check = PreciseDateTimeValue('Last synchronization', default=now())
+    last_check_id = dbsettings.PositiveIntegerValue('Last synchronized log', default=0)
+    # Statistics of the last run, reported by metrics
+    last_run = PreciseDateTimeValue('Last synchronization run', required=False)
+    last_run_duration = dbsettings.FloatValue('Duration of the last run (seconds)', required=False)
+    last_run_count = dbsettings.PositiveIntegerValue('Changes performed in the last run',
+                                                     required=False)
+    last_error = dbsettings.TextValue('Error of the last run', required=False)
 options = SynchroSettings()
 
 
+@python_2_unicode_compatible
+class ChannelState(models.Model):
+    """Checkpoint of a synchronization channel (the default channel uses options)."""
+    name = models.CharField(max_length=50, unique=True)
+    last_check = models.DateTimeField()
+    last_check_id = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return u'Channel %s' % self.name
+
+
+@python_2_unicode_compatible
+class SyncLease(models.Model):
+    """Lease of a synchronization run (see synchro.lease); empty owner means it is free."""
+    name = models.CharField(max_length=50, unique=True)
+    owner = models.CharField(max_length=200, blank=True)
+    acquired = models.DateTimeField(null=True)
+    expires = models.DateTimeField()
+
+    def __str__(self):
+        return u'Lease %s' % self.name
+
+
 class Reference(models.Model):
     content_type = models.ForeignKey(ContentType)
     local_object_id = models.CharField(max_length=20)
@@ -29,19 +75,234 @@ class Reference(models.Model):
 
     class Meta:
         unique_together = ('content_type', 'local_object_id')
+        index_together = (('content_type', 'remote_object_id'),)
+
+
+class IntegerReference(models.Model):
+    """Reference of object with integer primary key (see SYNCHRO_TYPED_REFERENCES)."""
+    content_type = models.ForeignKey(ContentType)
+    local_object_id = models.BigIntegerField()
+    remote_object_id = models.BigIntegerField()
+
+    class Meta:
+        unique_together = ('content_type', 'local_object_id')
+        index_together = (('content_type', 'remote_object_id'),)
 
 
+if hasattr(models, 'UUIDField'):
+    class UUIDReference(models.Model):
+        """Reference of object with UUID primary key (see SYNCHRO_TYPED_REFERENCES)."""
+        content_type = models.ForeignKey(ContentType)
+        local_object_id = models.UUIDField()
+        remote_object_id = models.UUIDField()
+
+        class Meta:
+            unique_together = ('content_type', 'local_object_id')
+            index_together = (('content_type', 'remote_object_id'),)
+    REFERENCE_MODELS = (Reference, IntegerReference, UUIDReference)
+else:
+    # Django < 1.8
+    UUIDReference = None
+    REFERENCE_MODELS = (Reference, IntegerReference)
+
+
+def get_reference_model(model):
+    """Returns model storing References of objects of model (or content type)."""
+    if isinstance(model, ContentType):
+        model = model.model_class()
+    if not settings.TYPED_REFERENCES or model is None:
+        return Reference
+    pk = model._meta.pk
+    if pk.rel:
+        # Multi-table inheritance
+        return get_reference_model(pk.rel.to)
+    if isinstance(pk, (models.AutoField, models.IntegerField)):
+        return IntegerReference
+    if UUIDReference is not None and isinstance(pk, models.UUIDField):
+        return UUIDReference
+    return Reference
+
+
+class ReferenceCache(object):
+    """
+    Bounded LRU cache of References: (content type id, local id) -> remote id.
+    It lives as long as the process, so that consecutive synchronizations can use it.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.items = OrderedDict()
+
+    def get(self, ct, id):
+        key = (ct.pk, six.text_type(id))
+        remote_id = self.items.pop(key, None)
+        if remote_id is not None:
+            self.items[key] = remote_id
+        return remote_id
+
+    def set(self, ct, id, remote_id):
+        if not self.size:
+            return
+        key = (ct.pk, six.text_type(id))
+        self.items.pop(key, None)
+        self.items[key] = six.text_type(remote_id)
+        if len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+    def forget(self, ct, id):
+        self.items.pop((ct.pk, six.text_type(id)), None)
+
+REFERENCE_CACHE = ReferenceCache(settings.REFERENCE_CACHE)
+
+
+class ImportReference(models.Model):
+    """Links object imported from a changeset file (see synchro_import) with its source object."""
+    content_type = models.ForeignKey(ContentType)
+    source_object_id = models.CharField(max_length=20)
+    local_object_id = models.CharField(max_length=20)
+
+    class Meta:
+        unique_together = ('content_type', 'source_object_id')
+
+
+@python_2_unicode_compatible
 class ChangeLog(models.Model):
     content_type = models.ForeignKey(ContentType)
     object_id = models.CharField(max_length=20)
     object = GenericForeignKey()
     date = models.DateTimeField(auto_now=True)
     action = models.PositiveSmallIntegerField(choices=ACTIONS)
+    # Comma separated names of changed fields (None if unknown)
+    fields = models.TextField(null=True, blank=True)
+    # Natural key of deleted object, encoded with utility.encode_key
+    key = models.TextField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('date', 'id'), ('content_type', 'date', 'id'))
+
+    def get_actions(self):
+        return [self.action]
+
+    def get_changed_fields(self):
+        return [f for f in self.fields.split(',') if f] if self.fields is not None else None
+
+    def get_delete_key(self):
+        """
+        Returns natural key of deleted object (or None).
+        Falls back to DeleteKey of logs stored by versions prior to 0.8 which were not converted.
+        """
+        if self.key is None and self.action == DELETION and hasattr(
+                ContentType.objects.get_for_id(self.content_type_id).model_class(), 'natural_key'):
+            try:
+                return decode_legacy_key(self.deletekey.key)
+            except DeleteKey.DoesNotExist:
+                return None
+        return decode_key(self.key)
 
-    def __unicode__(self):
-        return u'ChangeLog for %s (%s)' % (unicode(self.object), self.get_action_display())
+    def __str__(self):
+        return u'ChangeLog for %s (%s)' % (six.text_type(self.object), self.get_action_display())
+
+
+def merge_fields(a, b):
+    """Merges two comma separated lists of changed fields (None means all fields)."""
+    if a is None or b is None:
+        return None
+    return ','.join(sorted(set(f for f in a.split(',') + b.split(',') if f)))
 
 
 class DeleteKey(models.Model):
+    """
+    Delete key storage of versions prior to 0.8. Migration 0002 moves its rows into ChangeLog.key,
+    except keys which cannot be decoded or encoded (see ChangeLog.get_delete_key).
+    """
     changelog = models.OneToOneField(ChangeLog)
     key = models.CharField(max_length=200)
+
+
+# Bits of PendingChange.actions
+ACTION_FLAGS = {
+    ADDITION:   1,
+    CHANGE:     2,
+    DELETION:   4,
+    M2M_CHANGE: 8,
+}
+
+
+class MergedChange(models.Model):
+    """Actions performed on an object, merged into one row (see ChangeLog for single actions)."""
+    content_type = models.ForeignKey(ContentType)
+    object_id = models.CharField(max_length=20)
+    object = GenericForeignKey()
+    date = models.DateTimeField(default=now)
+    actions = models.PositiveSmallIntegerField(default=0)
+    # Natural key of deleted object, encoded with utility.encode_key
+    key = models.TextField(null=True, blank=True)
+    # Comma separated names of changed fields (None if unknown)
+    fields = models.TextField(null=True, blank=True)
+
+    class Meta:
+        abstract = True
+        unique_together = ('content_type', 'object_id')
+
+    def get_changed_fields(self):
+        return [f for f in self.fields.split(',') if f] if self.fields is not None else None
+
+    def has_action(self, action):
+        return bool(self.actions & ACTION_FLAGS[action])
+
+    def get_actions(self):
+        """Returns actions to perform, in order reproducing their effect."""
+        res = []
+        if self.has_action(DELETION):
+            # If there is anything more to do, the object was created again after deletion.
+            res.append(DELETION)
+        if self.has_action(ADDITION):
+            res.append(ADDITION)
+        elif self.has_action(CHANGE):
+            res.append(CHANGE)
+        if self.has_action(M2M_CHANGE):
+            res.append(M2M_CHANGE)
+        return res
+
+    def get_delete_key(self):
+        """Returns natural key of deleted object (or None)."""
+        return decode_key(self.key)
+
+    def merge(self, action, key=None, fields=None):
+        """Merges action (without saving). Deletion supersedes every action merged before."""
+        flag = ACTION_FLAGS[action]
+        if action == DELETION:
+            self.actions, self.key, self.fields = flag, key, None
+            return
+        if action == CHANGE:
+            self.fields = merge_fields(self.fields, fields) if self.actions & flag else fields
+        self.actions |= flag
+
+
+@python_2_unicode_compatible
+class PendingChange(MergedChange):
+    """
+    Latest state of an object awaiting synchronization (used when SYNCHRO_CAPTURE is 'state').
+    Unlike ChangeLog, there is only one row per object, no matter how many times it was changed.
+    """
+
+    def __str__(self):
+        actions = [label for action, label in ACTIONS if self.has_action(action)]
+        return u'PendingChange for %s (%s)' % (six.text_type(self.object), ', '.join(actions))
+
+
+@python_2_unicode_compatible
+class QuarantinedChange(MergedChange):
+    """
+    Change which failed to synchronize (see SYNCHRO_QUARANTINE). Later changes of the object
+    are merged into it, until it is retried successfully with ``synchro_retry`` command.
+    """
+    error = models.TextField()
+    traceback = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=1)
+    quarantined = models.DateTimeField(default=now)
+
+    def __str__(self):
+        return u'QuarantinedChange for %s (%s)' % (six.text_type(self.object), self.error)
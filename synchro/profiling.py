@@ -0,0 +1,115 @@
+"""
+Instrumentation of a synchronization run (``synchronize --profile PREFIX``).
+
+Writes ``PREFIX.prof`` (cProfile statistics, to be read with ``pstats`` or e.g. snakeviz) and
+``PREFIX.sql.jsonl`` (every executed query: database alias, action of the engine which issued it,
+SQL and duration in milliseconds). Queries are also summarized by their shape.
+"""
+import cProfile
+from collections import defaultdict
+import json
+import re
+import sys
+from time import time
+
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+
+ENGINE_MODULE = 'synchro.management.commands.synchronize'
+# Engine functions performing actions of logs; queries are attributed to them
+ACTION_FUNCTIONS = ('perform_add', 'perform_chg', 'perform_del', 'perform_del_many', 'perform_m2m')
+# Variable-length lists of placeholders, e.g. in "pk IN (%s, %s, %s)"
+PLACEHOLDERS_RE = re.compile(r'\((?:%s, )+%s\)')
+
+
+def get_action():
+    """
+    Returns name of the outermost action function on the stack (e.g. perform_chg, even if the
+    query is issued by perform_add adding a foreign key target), or - outside of actions - of the
+    innermost synchronization engine function.
+    """
+    frame = sys._getframe(2)
+    action = None
+    while frame is not None:
+        if frame.f_globals.get('__name__') == ENGINE_MODULE:
+            name = frame.f_code.co_name
+            if name in ACTION_FUNCTIONS or action is None:
+                action = name
+        frame = frame.f_back
+    return action
+
+
+def get_shape(sql):
+    return PLACEHOLDERS_RE.sub('(%s, ...)', sql)
+
+
+class TracingCursorWrapper(CursorWrapper):
+    def __init__(self, cursor, db, tracer):
+        super(TracingCursorWrapper, self).__init__(cursor, db)
+        self.tracer = tracer
+
+    def execute(self, sql, params=None):
+        start = time()
+        try:
+            return super(TracingCursorWrapper, self).execute(sql, params)
+        finally:
+            self.tracer.record(self.db.alias, sql, time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time()
+        try:
+            return super(TracingCursorWrapper, self).executemany(sql, param_list)
+        finally:
+            self.tracer.record(self.db.alias, sql, time() - start)
+
+
+class SyncProfiler(object):
+    """Context manager profiling code and tracing queries of given database aliases."""
+
+    def __init__(self, prefix, aliases, top=10):
+        self.prefix = prefix
+        self.aliases = [a for a in set(aliases) if a is not None]
+        self.top = top
+        self.shapes = defaultdict(lambda: [0, 0.0])  # (alias, action, shape): [count, time]
+
+    def record(self, alias, sql, duration):
+        action = get_action()
+        self.trace.write(json.dumps({'alias': alias, 'action': action, 'sql': sql,
+                                     'ms': round(duration * 1000, 3)}) + '\n')
+        entry = self.shapes[(alias, action, get_shape(sql))]
+        entry[0] += 1
+        entry[1] += duration
+
+    def __enter__(self):
+        self.trace = open(self.prefix + '.sql.jsonl', 'w')
+        self.saved = {}
+        for alias in self.aliases:
+            connection = connections[alias]
+            self.saved[alias] = connection.force_debug_cursor
+            connection.force_debug_cursor = True
+            connection.make_debug_cursor = (
+                lambda cursor, connection=connection: TracingCursorWrapper(cursor, connection, self))
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profile.disable()
+        for alias, force_debug_cursor in self.saved.items():
+            connection = connections[alias]
+            del connection.make_debug_cursor
+            connection.force_debug_cursor = force_debug_cursor
+        self.trace.close()
+        self.profile.dump_stats(self.prefix + '.prof')
+
+    def report(self):
+        """Returns summary of the most expensive query shapes."""
+        shapes = sorted(self.shapes.items(), key=lambda item: -item[1][1])
+        lines = [u'%d queries in %.3f ms. Most expensive:' % (
+            sum(c for c, _ in self.shapes.values()),
+            sum(t for _, t in self.shapes.values()) * 1000)]
+        for (alias, action, shape), (count, duration) in shapes[:self.top]:
+            lines.append(u'%10.3f ms %6dx  [%s] %s: %s' % (
+                duration * 1000, count, alias, action, shape[:200]))
+        lines.append(u'Profile: %s.prof, queries: %s.sql.jsonl' % (self.prefix, self.prefix))
+        return u'\n'.join(lines)
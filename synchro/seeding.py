@@ -0,0 +1,211 @@
+"""
+Initial seeding of an empty (or partially filled) REMOTE (``synchro_seed`` command).
+
+Instead of replaying ChangeLog, every synchronized model is copied in foreign key dependency
+order, in chunks read by primary key ranges and written with bulk inserts. Local primary keys
+are kept where possible. Objects already having References are skipped; objects matched by
+natural key are updated like by ``synchronize``. Every chunk is committed with its References,
+so an interrupted seeding continues where it stopped when run again. Finally the checkpoint is
+set to the newest log seen before copying, so changes made in the meantime are synchronized
+afterwards.
+"""
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.color import no_style
+from django.db import connections, transaction
+from django.utils import six
+from django.utils.timezone import now
+
+from synchro import settings
+from synchro.management.commands.synchronize import (
+    NATURAL_CACHE, change_with_fks, create_with_fks, ensure_exist, find_natural, get_checkpoint,
+    get_m2m_fields, queue_files, set_checkpoint, syncing_files)
+from synchro.models import ChangeLog, PendingChange, get_reference_model
+from synchro.settings import LOCAL, REMOTE
+from synchro.utility import chunked
+
+
+def get_models():
+    """Returns synchronized models (with intermediary ones) in foreign key dependency order."""
+    models = list(settings.MODELS) + [m for m in settings.INTER_MODELS if m not in settings.MODELS]
+    deps = dict((m, set(f.rel.to for f in m._meta.fields
+                        if f.rel and f.rel.to in models and f.rel.to is not m)) for m in models)
+    res = []
+    while deps:
+        ready = [m for m in models if m in deps and not deps[m] - set(res)]
+        if not ready:
+            # Cycle; its foreign keys are resolved object by object (see get_remote_ids)
+            ready = [next(m for m in models if m in deps)]
+        for m in ready:
+            res.append(m)
+            del deps[m]
+    return res
+
+
+def get_through_models(models):
+    """Returns auto-created m2m intermediary models of models (both direct and reverse)."""
+    res = []
+    for model in models:
+        for _, through, _, _ in six.itervalues(get_m2m_fields(model)):
+            if through._meta.auto_created and through not in res:
+                res.append(through)
+    return res
+
+
+def read_chunks(model, size):
+    """Yields lists of LOCAL objects of model, read by primary key ranges."""
+    qs = model._base_manager.using(LOCAL).order_by('pk')
+    chunk = list(qs[:size])
+    while chunk:
+        yield chunk
+        chunk = list(qs.filter(pk__gt=chunk[-1].pk)[:size])
+
+
+def get_references(ct, ids):
+    """Returns {local id: remote id} of References of given LOCAL objects."""
+    res = {}
+    refs = get_reference_model(ct).objects.filter(content_type=ct)
+    for chunk in chunked(set(ids), settings.BATCH_SIZE):
+        res.update((six.text_type(local_id), six.text_type(remote_id)) for local_id, remote_id in
+                   refs.filter(local_object_id__in=chunk)
+                   .values_list('local_object_id', 'remote_object_id'))
+    return res
+
+
+def get_remote_ids(ct, ids):
+    """Returns {local id: remote id} of given LOCAL objects, copying missing ones to REMOTE."""
+    res = get_references(ct, ids)
+    for id in set(ids) - set(res):
+        rem, _ = ensure_exist(ct, id)
+        res[id] = six.text_type(rem.pk)
+    return res
+
+
+class Seeder(object):
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.copied = self.matched = self.links = 0
+
+    def seed(self):
+        """Copies all synchronized objects to REMOTE and sets the checkpoint."""
+        start = now()
+        last = ChangeLog.objects.order_by('-date', '-pk').first()
+        models = get_models()
+        with syncing_files():
+            for model in models:
+                self.seed_model(model)
+        for through in get_through_models(models):
+            self.seed_links(through)
+        self.reset_sequences(models)
+        # Only when everything is copied
+        with transaction.atomic(using=LOCAL):
+            if settings.CAPTURE == 'state':
+                PendingChange.objects.filter(date__lt=start).delete()
+            elif last is not None:
+                for channel in settings.CHANNELS:
+                    get_checkpoint(channel)
+                    set_checkpoint(last, channel)
+
+    def seed_model(self, model):
+        ct = ContentType.objects.get_for_model(model)
+        for chunk in read_chunks(model, self.chunk_size):
+            try:
+                with transaction.atomic(using=LOCAL), transaction.atomic(using=REMOTE):
+                    self.seed_chunk(ct, model, chunk)
+            finally:
+                NATURAL_CACHE.clear()
+
+    def seed_chunk(self, ct, model, chunk):
+        refs = get_references(ct, [six.text_type(obj.pk) for obj in chunk])
+        chunk = [obj for obj in chunk if six.text_type(obj.pk) not in refs]
+        if hasattr(model, 'natural_key'):
+            if hasattr(getattr(model, 'objects', None), 'get_many_by_natural_keys'):
+                NATURAL_CACHE.prime(model, [obj.natural_key() for obj in chunk])
+            new = []
+            for obj in chunk:
+                rem = find_natural(ct, obj)
+                if rem is None:
+                    new.append(obj)
+                else:
+                    change_with_fks(ct, obj, rem)
+                    self.matched += 1
+            chunk = new
+        if model._meta.parents:
+            # Multi-table inheritance; bulk inserts are not supported
+            for obj in chunk:
+                create_with_fks(ct, obj, None if model._meta.has_auto_field else obj.pk)
+            self.copied += len(chunk)
+            return
+
+        skip = getattr(model, 'SYNCHRO_SKIP', ())
+        raw = model()
+        for obj in chunk:
+            for f in skip:
+                setattr(obj, f, getattr(raw, f))
+        for f in model._meta.fields:
+            if not f.rel:
+                continue
+            ids = [six.text_type(f.value_from_object(obj)) for obj in chunk
+                   if f.value_from_object(obj) is not None]
+            remote_ids = get_remote_ids(ContentType.objects.get_for_model(f.rel.to), ids)
+            for obj in chunk:
+                if f.value_from_object(obj) is not None:
+                    setattr(obj, f.attname, remote_ids[six.text_type(f.value_from_object(obj))])
+        # Foreign keys of a cycle (or to self) may have copied some of the objects already
+        refs = get_references(ct, [six.text_type(obj.pk) for obj in chunk])
+        chunk = [obj for obj in chunk if six.text_type(obj.pk) not in refs]
+
+        manager = model._base_manager.db_manager(REMOTE)
+        taken = set(six.text_type(pk) for pk in manager.filter(pk__in=[obj.pk for obj in chunk])
+                    .values_list('pk', flat=True))
+        new = [obj for obj in chunk if six.text_type(obj.pk) not in taken]
+        manager.bulk_create(new)
+        if new and model._meta.has_auto_field:
+            # Objects saved without pk below (or by get_remote_ids later) must not get inserted pks
+            self.reset_sequences([model])
+        Reference = get_reference_model(ct)
+        references = [Reference(content_type=ct, local_object_id=obj.pk, remote_object_id=obj.pk)
+                      for obj in new]
+        for obj in chunk:
+            if six.text_type(obj.pk) in taken:
+                # Primary key is used by another REMOTE object
+                local_id = obj.pk
+                if model._meta.has_auto_field:
+                    obj.pk = None
+                obj.save(using=REMOTE)
+                references.append(Reference(content_type=ct, local_object_id=local_id,
+                                            remote_object_id=obj.pk))
+        Reference.objects.bulk_create(references, settings.BATCH_SIZE)
+        for obj in chunk:
+            queue_files(obj)
+        self.copied += len(chunk)
+
+    def seed_links(self, through):
+        """Copies rows of auto-created m2m intermediary model."""
+        source, target = [f for f in through._meta.fields if f.rel]
+        source_ct = ContentType.objects.get_for_model(source.rel.to)
+        target_ct = ContentType.objects.get_for_model(target.rel.to)
+        qs = through._base_manager.using(LOCAL).order_by('pk')
+        rows = list(qs.values_list('pk', source.attname, target.attname)[:self.chunk_size])
+        while rows:
+            sources = get_remote_ids(source_ct, [six.text_type(row[1]) for row in rows])
+            targets = get_remote_ids(target_ct, [six.text_type(row[2]) for row in rows])
+            pairs = set((sources[six.text_type(s)], targets[six.text_type(t)]) for _, s, t in rows)
+            existing = set(
+                (six.text_type(s), six.text_type(t)) for s, t in through._base_manager.using(REMOTE)
+                .filter(**{'%s__in' % source.attname: set(s for s, _ in pairs)})
+                .values_list(source.attname, target.attname))
+            new = [through(**{source.attname: s, target.attname: t})
+                   for s, t in sorted(pairs - existing)]
+            through._base_manager.db_manager(REMOTE).bulk_create(new)
+            self.links += len(new)
+            rows = list(qs.filter(pk__gt=rows[-1][0])
+                        .values_list('pk', source.attname, target.attname)[:self.chunk_size])
+
+    def reset_sequences(self, models):
+        """Moves REMOTE sequences past primary keys inserted explicitly."""
+        connection = connections[REMOTE]
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
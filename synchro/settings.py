@@ -1,6 +1,9 @@
+from collections import namedtuple
+
 from django.apps import apps
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
 
 
 def get_all_models(app):
@@ -16,12 +19,15 @@ def get_all_models(app):
 
 def gel_listed_models(app, l):
     def parse(model):
-        m = apps.get_model(app, model)
+        try:
+            m = apps.get_model(app, model)
+        except LookupError:
+            m = None
         if m is None:
             raise ImproperlyConfigured(
                 'SYNCHRO_MODELS: Model %s not found in %s app.' % (model, app))
         return m
-    return map(parse, l)
+    return [parse(model) for model in l]
 
 
 def parse_models(l):
@@ -47,24 +53,102 @@ def get_intermediary(models):
                    if not m2m.rel.through._meta.auto_created)
     return res
 
-MODELS = INTER_MODELS = []
+# Channel of models not assigned to any other channel. It uses the global checkpoint.
+DEFAULT_CHANNEL = 'default'
+Channel = namedtuple('Channel', 'name models priority batch_size')
 
 
-def prepare():
-    global MODELS, INTER_MODELS
-    MODELS = parse_models(getattr(settings, 'SYNCHRO_MODELS', ()))
+def parse_channels(channels, models):
+    """Returns list of Channels, ordered by priority (the highest first)."""
+    res = []
+    assigned = {}
+    for name, conf in channels.items():
+        chan_models = parse_models(conf.get('models', ()))
+        if name == DEFAULT_CHANNEL and chan_models:
+            raise ImproperlyConfigured(
+                'SYNCHRO_CHANNELS: %s channel consists of unassigned models.' % DEFAULT_CHANNEL)
+        for m in chan_models:
+            if m not in models:
+                raise ImproperlyConfigured(
+                    'SYNCHRO_CHANNELS: Model %s is not listed in SYNCHRO_MODELS.' % m.__name__)
+            if m in assigned:
+                raise ImproperlyConfigured('SYNCHRO_CHANNELS: Model %s is assigned to both %s and %s.'
+                                           % (m.__name__, assigned[m], name))
+            assigned[m] = name
+        res.append(Channel(name, chan_models, conf.get('priority', 0),
+                           conf.get('batch_size', BATCH_SIZE)))
+    if DEFAULT_CHANNEL not in channels:
+        res.append(Channel(DEFAULT_CHANNEL, [], 0, BATCH_SIZE))
+    return sorted(res, key=lambda c: -c.priority)
+
+
+def resolve():
+    """Returns (MODELS, INTER_MODELS, CHANNELS) read from settings."""
+    models = parse_models(getattr(settings, 'SYNCHRO_MODELS', ()))
     # Since user-defined m2m intermediary objects don't send m2m_changed signal,
     #  we need to listen to those models.
-    INTER_MODELS = get_intermediary(MODELS)
+    inter_models = get_intermediary(models)
+    return models, inter_models, parse_channels(getattr(settings, 'SYNCHRO_CHANNELS', {}), models)
 
-if apps.ready:
-    # In order to prevent exception in Django 1.7
-    prepare()
+
+def prepare():
+    """
+    Declares MODELS, INTER_MODELS and CHANNELS. They are resolved once, on first use, so this
+    module can be imported before the app registry is ready; SynchroConfig.ready uses them
+    first (see load).
+    """
+    global MODELS, INTER_MODELS, CHANNELS
+    resolved = SimpleLazyObject(resolve)
+    MODELS = SimpleLazyObject(lambda: resolved[0])
+    INTER_MODELS = SimpleLazyObject(lambda: resolved[1])
+    CHANNELS = SimpleLazyObject(lambda: resolved[2])
+
+
+def load():
+    """Resolves MODELS, INTER_MODELS and CHANNELS now. Raises ImproperlyConfigured."""
+    for value in (MODELS, INTER_MODELS, CHANNELS):
+        bool(value)
 
 REMOTE = getattr(settings, 'SYNCHRO_REMOTE', None)
 LOCAL = 'default'
+# Alias of LOCAL replica synchronization reads from (see get_read_alias in synchronize command)
+LOCAL_READ = getattr(settings, 'SYNCHRO_LOCAL_READ', LOCAL)
+LOCAL_READ_MAX_LAG = getattr(settings, 'SYNCHRO_LOCAL_READ_MAX_LAG', None)
 ALLOW_RESET = getattr(settings, 'SYNCHRO_ALLOW_RESET', True)
 DEBUG = getattr(settings, 'SYNCHRO_DEBUG', False)
+CAPTURE = getattr(settings, 'SYNCHRO_CAPTURE', 'log')
+TRACK_FIELDS = getattr(settings, 'SYNCHRO_TRACK_FIELDS', False)
+BATCH_SIZE = getattr(settings, 'SYNCHRO_BATCH_SIZE', 500)
+PIPELINE = getattr(settings, 'SYNCHRO_PIPELINE', False)
+# Number of batches read in advance by pipelined synchronization
+PIPELINE_DEPTH = getattr(settings, 'SYNCHRO_PIPELINE_DEPTH', 2)
+SNAPSHOT = getattr(settings, 'SYNCHRO_SNAPSHOT', False)
+# Storage class (dotted path) files of FileFields are copied to (see synchro.files)
+REMOTE_STORAGE = getattr(settings, 'SYNCHRO_REMOTE_STORAGE', None)
+REMOTE_STORAGE_OPTIONS = getattr(settings, 'SYNCHRO_REMOTE_STORAGE_OPTIONS', {})
+# Number of threads copying files
+FILE_WORKERS = getattr(settings, 'SYNCHRO_FILE_WORKERS', 4)
+# Record failing changes in QuarantinedChange instead of aborting synchronization
+QUARANTINE = getattr(settings, 'SYNCHRO_QUARANTINE', False)
+# Seconds a synchronization lease is valid without renewal (None disables leases)
+LEASE_TTL = getattr(settings, 'SYNCHRO_LEASE_TTL', 300)
+# Alias leases are stored in (None: a separate connection to LOCAL, see synchro.lease)
+LEASE_DATABASE = getattr(settings, 'SYNCHRO_LEASE_DATABASE', None)
+# Store References of objects with integer or UUID primary keys in typed columns
+TYPED_REFERENCES = getattr(settings, 'SYNCHRO_TYPED_REFERENCES', False)
+# Number of References cached in memory by synchronization
+REFERENCE_CACHE = getattr(settings, 'SYNCHRO_REFERENCE_CACHE', 100000)
+# Seconds metrics are cached for; longer than a usual scrape interval (15 - 60 s)
+METRICS_CACHE = getattr(settings, 'SYNCHRO_METRICS_CACHE', 60)
+METRICS_TOKEN = getattr(settings, 'SYNCHRO_METRICS_TOKEN', None)
+# Synchronization over HTTP (see synchro.transport)
+REMOTE_URL = getattr(settings, 'SYNCHRO_REMOTE_URL', None)
+TRANSPORT_KEY = getattr(settings, 'SYNCHRO_TRANSPORT_KEY', None)
+# Database pushed changes are applied to
+RECEIVE_DATABASE = getattr(settings, 'SYNCHRO_RECEIVE_DATABASE', LOCAL)
+
+if CAPTURE not in ('log', 'state'):
+    raise ImproperlyConfigured("SYNCHRO_CAPTURE must be either 'log' or 'state'.")
 
 if REMOTE is None:
     if not hasattr(settings, 'SYNCHRO_REMOTE'):
@@ -72,3 +156,8 @@ if REMOTE is None:
         warnings.warn('SYNCHRO_REMOTE not specified. Synchronization is disabled.', RuntimeWarning)
 elif REMOTE not in settings.DATABASES:
     raise ImproperlyConfigured('SYNCHRO_REMOTE invalid - no such database: %s.' % REMOTE)
+
+if LOCAL_READ not in settings.DATABASES:
+    raise ImproperlyConfigured('SYNCHRO_LOCAL_READ invalid - no such database: %s.' % LOCAL_READ)
+
+prepare()
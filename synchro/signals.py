@@ -1,16 +1,22 @@
 from functools import wraps
 
-from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
 
 
 def synchro_connect():
-    from handlers import save_changelog_add_chg, save_changelog_del, save_changelog_m2m
+    from synchro.handlers import save_changelog_add_chg, save_changelog_del, save_changelog_m2m
+    from synchro.handlers import save_initial_state
+    from synchro import settings
     post_save.connect(save_changelog_add_chg, dispatch_uid='synchro_add_chg')
     post_delete.connect(save_changelog_del, dispatch_uid='synchro_del')
     m2m_changed.connect(save_changelog_m2m, dispatch_uid='synchro_m2m')
+    if settings.TRACK_FIELDS:
+        # Don't slow down instantiation of every object unless needed
+        post_init.connect(save_initial_state, dispatch_uid='synchro_init')
 
 
 def synchro_disconnect():
+    post_init.disconnect(dispatch_uid='synchro_init')
     post_save.disconnect(dispatch_uid='synchro_add_chg')
     post_delete.disconnect(dispatch_uid='synchro_del')
     m2m_changed.disconnect(dispatch_uid='synchro_m2m')
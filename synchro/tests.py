@@ -2,24 +2,28 @@ import datetime
 
 from django import VERSION
 from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import ValidationError, ImproperlyConfigured
 from django.core.management import call_command, CommandError
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import connections, models
 from django.db.models import F
 from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from django.test import TestCase
-from django.test.utils import override_settings
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import six
+from django.utils.six import StringIO
+from django.utils.six.moves import reload_module as reload
 try:
     from unittest.case import skipUnless
 except ImportError:
     from django.utils.unittest.case import skipUnless
 
-from models import ChangeLog
-import settings as synchro_settings
-from signals import DisableSynchroLog, disable_synchro_log
-from utility import NaturalManager, reset_synchro, NaturalKeyModel
+from synchro.models import ChangeLog, Reference, REFERENCE_CACHE, CHANGE
+from synchro import settings as synchro_settings
+from synchro.signals import DisableSynchroLog, disable_synchro_log
+from synchro.utility import NaturalManager, reset_synchro, NaturalKeyModel
 
 from django.contrib.auth import get_user_model
 User = get_user_model()
@@ -38,7 +42,8 @@ REMOTE = settings.SYNCHRO_REMOTE
 SETTINGS = {
     'SYNCHRO_MODELS': (
         ('synchro', 'testmodel', 'PkModelWithSkip', 'ModelWithKey', 'ModelWithFK', 'A', 'X',
-         'M2mModelWithKey', 'M2mAnother', 'M2mModelWithInter', 'M2mSelf', 'ModelWithFKtoKey'),
+         'M2mModelWithKey', 'M2mAnother', 'M2mModelWithInter', 'M2mSelf', 'ModelWithFKtoKey',
+         'Node', 'Document'),
     ),
     'ROOT_URLCONF': 'synchro.test_urls',
 }
@@ -161,6 +166,16 @@ class M2mSelf(models.Model):
     m2m = models.ManyToManyField('self')
 
 
+class Node(models.Model):
+    name = models.CharField(max_length=10)
+    parent = models.ForeignKey('self', null=True, related_name='children')
+
+
+class Document(models.Model):
+    name = models.CharField(max_length=10)
+    file = models.FileField(upload_to='docs')
+
+
 class A(models.Model):
     foo = models.IntegerField(default=1)
     bar = models.IntegerField(default=1)
@@ -210,6 +225,12 @@ class SynchroTests(TestCase):
         super(SynchroTests, cls).tearDownClass()
         reload(synchro_settings)
 
+    def tearDown(self):
+        from synchro.management.commands.synchronize import forget_caches
+        # The test is rolled back, like a failed synchronization run
+        forget_caches()
+        super(SynchroTests, self).tearDown()
+
     def _assertDbCount(self, db, num, cls):
         self.assertEqual(num, cls.objects.db_manager(db).count())
 
@@ -256,6 +277,33 @@ class SimpleSynchroTests(SynchroTests):
         self.assertIn(PkModelWithSkip, synchro_settings.MODELS)
         self.assertNotIn(ChangeLog, synchro_settings.MODELS)
 
+    def test_lazy_settings(self):
+        """Check if SYNCHRO_MODELS and SYNCHRO_CHANNELS are resolved once, on first use."""
+        calls = []
+        resolve = synchro_settings.resolve
+        synchro_settings.resolve = lambda: calls.append(1) or resolve()
+        try:
+            synchro_settings.prepare()
+            self.assertEqual([], calls)
+            TestModel.objects.create(name='James')
+            self.assertEqual([1], calls)
+            self.assertIn(TestModel, synchro_settings.MODELS)
+            self.assertEqual(['default'], [c.name for c in synchro_settings.CHANNELS])
+            self.assertEqual([1], calls)
+        finally:
+            synchro_settings.resolve = resolve
+            synchro_settings.prepare()
+
+    def test_settings_validated_on_startup(self):
+        """Check if invalid SYNCHRO_MODELS are reported when the app is ready."""
+        from django.apps import apps
+        try:
+            with override_settings(SYNCHRO_MODELS=(('synchro', 'NoSuchModel'),)):
+                reload(synchro_settings)
+                self.assertRaises(ImproperlyConfigured, apps.get_app_config('synchro').ready)
+        finally:
+            reload(synchro_settings)
+
     def test_app_paths(self):
         """Check if app in SYNCHRO_MODELS can be stated in any way."""
         from django.contrib.auth.models import Group
@@ -325,6 +373,20 @@ class SimpleSynchroTests(SynchroTests):
         from synchro.models import options
         self.assertTrue(options.last_check >= prev.replace(microsecond=0))
 
+    def test_checkpoint(self):
+        """Test if logs sharing date with the checkpoint are told apart by their pk."""
+        TestModel.objects.create(name='James', cash=7)
+        self.synchronize()
+        log = ChangeLog.objects.get()
+        from synchro.models import options
+        self.assertEqual((log.date, log.pk), (options.last_check, options.last_check_id))
+        TestModel.objects.create(name='Bond', cash=7)
+        # Simulate log committed later, but with the same date
+        ChangeLog.objects.exclude(pk=log.pk).update(date=log.date)
+        self.synchronize()
+        self.assertRemoteCount(2, TestModel)
+        self.assertNoActionOnSynchronize(TestModel)
+
     def test_auto_pk(self):
         """
         Test if auto pk is *not* overwritten.
@@ -400,6 +462,24 @@ class SimpleSynchroTests(SynchroTests):
         self.synchronize()
         self.assertRemoteCount(0, TestModel)
 
+    def test_bulk_deletion(self):
+        """Test if consecutive deletions are performed together, with constant number of queries."""
+
+        def delete_and_count(n):
+            for i in range(n):
+                TestModel.objects.create(name='James %d' % i)
+            self.synchronize()
+            self.wait()
+            TestModel.objects.all().delete()
+            with CaptureQueriesContext(connections[REMOTE]) as queries:
+                self.synchronize()
+            self.assertRemoteCount(0, TestModel)
+            self.assertLocalCount(0, Reference)
+            self.wait()
+            return len(queries)
+
+        self.assertEqual(delete_and_count(2), delete_and_count(6))
+
     def test_untracked_deletion(self):
         """Test if deletion is not performed on lack of Reference and key."""
         TestModel.objects.db_manager(REMOTE).create(name='James', cash=7)
@@ -410,6 +490,55 @@ class SimpleSynchroTests(SynchroTests):
         self.assertLocalCount(0, TestModel)
         self.assertRemoteCount(1, TestModel)
 
+    def test_profile(self):
+        """Test if profiling writes cProfile stats and query trace, and reports queries."""
+        import json
+        import os
+        import pstats
+        import shutil
+        import tempfile
+        from synchro.core import call_synchronize
+        parent = Node.objects.create(name='Parent')
+        self.reset()
+        Node.objects.create(name='Child', parent=parent)
+        directory = tempfile.mkdtemp()
+        try:
+            prefix = os.path.join(directory, 'sync')
+            message = call_synchronize(profile=prefix)
+            self.assertIn('Most expensive', message)
+            pstats.Stats(prefix + '.prof')
+            with open(prefix + '.sql.jsonl') as f:
+                trace = [json.loads(line) for line in f]
+            # Queries of helpers (also of adding the parent on demand) are attributed to the action
+            self.assertEqual(set(['perform_add']), set(
+                q['action'] for q in trace if q['alias'] == REMOTE and 'synchro_node' in q['sql']))
+            self.assertRemoteCount(2, Node)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_reset(self):
+        """Test if reset removes logs and references and reports their number."""
+        ModelWithKey.objects.create(name='James')
+        a = ModelWithKey.objects.create(name='Bond')
+        self.synchronize()
+        a.delete()
+        self.assertLocalCount(3, ChangeLog)
+        self.assertLocalCount(2, Reference)
+        self.assertEqual(5, reset_synchro(chunk_size=2))
+        self.assertLocalCount(0, ChangeLog)
+        self.assertLocalCount(0, Reference)
+        self.assertEqual(0, reset_synchro())
+
+    def test_reset_sparse_keys(self):
+        """Test if chunked delete does not walk gaps between primary keys."""
+        from synchro.utility import _chunked_delete
+        for pk in (1, 2, 10 ** 6, 10 ** 9):
+            TestModel.objects.create(pk=pk, name='James')
+        # Two chunks, each found and deleted with two queries, and the final lookup (twice).
+        with self.assertNumQueries(6):
+            self.assertEqual(4, _chunked_delete(TestModel, LOCAL, 2))
+        self.assertLocalCount(0, TestModel)
+
     def test_add_del(self):
         """Test if no unnecessary action is performed if added and deleted."""
         a = TestModel.objects.create(name='James')
@@ -471,6 +600,45 @@ class SimpleSynchroTests(SynchroTests):
         self.assertRemoteCount(1, ModelWithFKtoKey)
         self.assertRemoteCount(1, ModelWithKey)
 
+    def test_typed_references(self):
+        """Test if References are stored in typed tables and cached."""
+        from synchro.models import IntegerReference
+        a = TestModel.objects.create(name='James')
+        self.synchronize()
+        self.assertLocalCount(1, Reference)
+        try:
+            with override_settings(SYNCHRO_TYPED_REFERENCES=True):
+                reload(synchro_settings)
+                call_command('synchro_convert_references', verbosity=0)
+                self.assertLocalCount(0, Reference)
+                self.assertLocalCount(1, IntegerReference)
+                self.wait()
+                PkModelWithSkip.objects.create(name='Bond')
+                a.cash = 5
+                a.save()
+                self.synchronize()
+                self.assertRemoteCount(1, TestModel)
+                self.assertEqual(5, TestModel.objects.db_manager(REMOTE).get().cash)
+                self.assertLocalCount(1, Reference)  # primary key is not an integer
+                ct = ContentType.objects.get_for_model(TestModel)
+                remote_pk = TestModel.objects.db_manager(REMOTE).get().pk
+                self.assertEqual(six.text_type(remote_pk), REFERENCE_CACHE.get(ct, a.pk))
+                # Stale cache entry is replaced
+                REFERENCE_CACHE.set(ct, a.pk, remote_pk + 100)
+                self.wait()
+                a.cash = 7
+                a.save()
+                self.synchronize()
+                self.assertRemoteCount(1, TestModel)
+                self.assertEqual(7, TestModel.objects.db_manager(REMOTE).get().cash)
+                self.assertEqual(six.text_type(remote_pk), REFERENCE_CACHE.get(ct, a.pk))
+                self.wait()
+                a.delete()
+                self.synchronize()
+                self.assertRemoteCount(0, TestModel)
+        finally:
+            reload(synchro_settings)
+
     def test_time_comparing(self):
         """Test if synchronization is not performed if REMOTE object is newer."""
         a = TestModel.objects.create(name="James", cash=7)
@@ -518,16 +686,100 @@ class SimpleSynchroTests(SynchroTests):
         self.client.post(path, {'reset': True})  # button clicked
         self.assertEqual(ChangeLog.objects.count(), 0)
 
+    @skipUnless(contrib_apps('admin', 'auth', 'sessions'),
+                'admin, auth or sessions not in INSTALLED_APPS')
+    @skipUnless(user_model_quite_standard(), 'Too custom User model')
+    def test_backlog(self):
+        """Test if pending changes are listed page by page, with constant number of queries."""
+        from django.contrib.admin.models import DELETION
+        from synchro import backlog
+        path = reverse('backlog')
+        User._default_manager.create_superuser('admin', 'mail', 'admin')
+        self.client.login(username='admin', password='admin')
+        TestModel.objects.create(name='Old')
+        self.synchronize()
+        self.wait()
+
+        def create(n):
+            for i in range(n):
+                TestModel.objects.create(name='James')
+                ModelWithKey.objects.create(name='Bond%d' % ModelWithKey.objects.count())
+        create(3)
+        TestModel.objects.filter(name='James').first().delete()
+        response = self.client.get(path)
+        self.assertEqual(7, response.context['total'])
+        self.assertEqual([3, 4], sorted(c for _, c in response.context['counts']))
+        ct = ContentType.objects.get_for_model(TestModel)
+        rows = self.client.get(path, {'ct': ct.pk}).context['rows']
+        self.assertEqual(4, len(rows))
+        self.assertEqual([None, 'James', 'James', None],
+                         [r.instance and r.instance.name for r in rows])
+        rows = self.client.get(path, {'action': DELETION}).context['rows']
+        self.assertEqual([(['Delete'], None)], [(r.action_labels, r.instance) for r in rows])
+
+        page_size = backlog.PAGE_SIZE
+        backlog.PAGE_SIZE = 3
+        try:
+            pages = []
+            last = None
+            while True:
+                context = self.client.get(path, {'after': last} if last else {}).context
+                pages.append(len(context['rows']))
+                last = context['last']
+                if last is None:
+                    break
+            self.assertEqual([3, 3, 1], pages)
+        finally:
+            backlog.PAGE_SIZE = page_size
+
+        with CaptureQueriesContext(connections[LOCAL]) as queries:
+            self.client.get(path)
+        create(5)
+        self.assertNumQueries(len(queries), self.client.get, path)
+
+    def test_metrics(self):
+        """Test if backlog and last run metrics are exposed in Prometheus format."""
+        path = reverse('metrics')
+        TestModel.objects.create(name='James')
+        self.synchronize()
+        self.wait()
+        TestModel.objects.create(name='Bond')
+        ModelWithKey.objects.create(name='Bond')
+        from synchro.models import ChannelState
+        channels = {'fk': {'models': (('synchro', 'ModelWithFK'),)}}
+        try:
+            with override_settings(SYNCHRO_METRICS_TOKEN='secret', SYNCHRO_METRICS_CACHE=0,
+                                   SYNCHRO_CHANNELS=channels):
+                reload(synchro_settings)
+                self.assertEqual(403, self.client.get(path).status_code)
+                with CaptureQueriesContext(connections[LOCAL]) as queries:
+                    response = self.client.get(path, HTTP_AUTHORIZATION='Bearer secret')
+                self.assertEqual(200, response.status_code)
+                # Scraping is read-only, even for a channel which was never synchronized
+                self.assertLocalCount(0, ChannelState)
+                self.assertEqual([], [q['sql'] for q in queries if
+                                      not q['sql'].lstrip().upper().startswith('SELECT')])
+                lines = response.content.decode('utf-8').splitlines()
+                for line in (
+                        'synchro_pending_changes{channel="default",model="synchro.testmodel"} 1.0',
+                        'synchro_pending_changes{channel="default",model="synchro.modelwithkey"} 1.0',
+                        'synchro_last_run_changes 1.0',
+                        'synchro_last_run_failed 0.0',
+                        'synchro_references 1.0'):
+                    self.assertIn(line, lines)
+        finally:
+            reload(synchro_settings)
+
     def test_translation(self):
         """Test if texts are translated."""
         from django.utils.translation import override
-        from django.utils.encoding import force_unicode
+        from django.utils.encoding import force_text
         from synchro.core import call_synchronize
         languages = ('en', 'pl', 'de', 'es', 'fr')
         messages = set()
         for lang in languages:
             with override(lang):
-                messages.add(force_unicode(call_synchronize()))
+                messages.add(force_text(call_synchronize()))
         self.assertEqual(len(messages), len(languages), 'Some language is missing.')
 
 
@@ -596,6 +848,57 @@ class AdvancedSynchroTests(SynchroTests):
         # Because remote object is found, skipping use remote value (not default).
         self.assertEqual(5, remote.visits)
 
+    def test_natural_keys_batch(self):
+        """Test if natural keys are resolved in bulk, both on addition and deletion."""
+        for name in ('A', 'B', 'C'):
+            ModelWithKey.objects.db_manager(REMOTE).create(name=name, cash=1)
+        found = ModelWithKey.objects.db_manager(REMOTE).get_many_by_natural_keys(
+            [('A',), ('C',), ('X',)])
+        self.assertEqual(['A', 'C'], sorted(k[0] for k in found))
+        self.assertEqual('C', found[('C',)].name)
+        ModelWithKey.objects.db_manager(REMOTE).create(name='A')
+        self.assertRaises(ModelWithKey.MultipleObjectsReturned,
+                          ModelWithKey.objects.db_manager(REMOTE).get_many_by_natural_keys, [('A',)])
+        ModelWithKey.objects.db_manager(REMOTE).filter(name='A', cash=0).delete()
+
+        for name in ('A', 'B', 'D'):
+            ModelWithKey.objects.create(name=name, cash=7)
+        self.synchronize()
+        self.assertRemoteCount(4, ModelWithKey)
+        self.assertEqual(7, ModelWithKey.objects.db_manager(REMOTE).get(name='A').cash)
+        self.assertEqual(1, ModelWithKey.objects.db_manager(REMOTE).get(name='C').cash)
+        self.reset()
+        ModelWithKey.objects.filter(name__in=('A', 'D')).delete()
+        self.synchronize()
+        self.assertEqual(['B', 'C'], sorted(ModelWithKey.objects.db_manager(REMOTE)
+                                            .values_list('name', flat=True)))
+
+    def test_delete_keys(self):
+        """Test if delete keys are encoded as JSON, and if old keys can be converted."""
+        from decimal import Decimal
+        from synchro.models import DeleteKey
+        from synchro.utility import decode_key, encode_key
+        key = (u'James', 7, None, datetime.date(2017, 11, 12), Decimal('1.50'), ('nested',))
+        self.assertEqual('["James",7,null,{"date":"2017-11-12"},{"decimal":"1.50"},["nested"]]',
+                         encode_key(key))
+        self.assertEqual(key, decode_key(encode_key(key)))
+
+        ModelWithKey.objects.db_manager(REMOTE).create(name='James')
+        a = ModelWithKey.objects.create(name='James')
+        self.reset()
+        a.delete()
+        log = ChangeLog.objects.get()
+        self.assertEqual((u'James',), log.get_delete_key())
+        # Key stored by older version
+        ChangeLog.objects.update(key=None)
+        DeleteKey.objects.create(changelog=log, key=repr((u'James',)))
+        self.assertEqual((u'James',), ChangeLog.objects.get().get_delete_key())
+        call_command('synchro_convert_keys', verbosity=0)
+        self.assertLocalCount(0, DeleteKey)
+        self.assertEqual('["James"]', ChangeLog.objects.get().key)
+        self.synchronize()
+        self.assertRemoteCount(0, ModelWithKey)
+
     def test_natural_key_deletion(self):
         """
         Test if natural key works on deletion.
@@ -641,6 +944,513 @@ class AdvancedSynchroTests(SynchroTests):
         self.assertLocalCount(1, PkModelWithSkip)
         self.assertRemoteCount(0, PkModelWithSkip)
 
+    def test_state_capture(self):
+        """Test if only one PendingChange per object is kept and synchronized."""
+        from synchro.models import PendingChange
+        try:
+            with override_settings(SYNCHRO_CAPTURE='state'):
+                reload(synchro_settings)
+                a = TestModel.objects.create(name='James', cash=7)
+                for cash in range(3):
+                    a.cash = cash
+                    a.save()
+                b = ModelWithKey.objects.create(name='Bond')
+                self.assertLocalCount(0, ChangeLog)
+                self.assertLocalCount(2, PendingChange)
+                self.synchronize()
+                self.assertLocalCount(0, PendingChange)
+                self.assertEqual(2, TestModel.objects.db_manager(REMOTE).get(name='James').cash)
+                self.assertRemoteCount(1, ModelWithKey)
+
+                # changed and deleted
+                a.cash = 42
+                a.save()
+                a.delete()
+                b.delete()
+                self.assertLocalCount(2, PendingChange)
+                self.assertNoActionOnSynchronize(TestModel, delete=False)
+                self.assertLocalCount(0, PendingChange)
+                self.assertRemoteCount(0, TestModel)
+                self.assertRemoteCount(0, ModelWithKey)
+        finally:
+            reload(synchro_settings)
+
+    def test_state_capture_late_commit(self):
+        """Test if PendingChange updated during synchronization is kept, even if dated earlier."""
+        from synchro.management.commands.synchronize import call_synchronize
+        from synchro.models import ACTION_FLAGS, PendingChange
+        try:
+            with override_settings(SYNCHRO_CAPTURE='state'):
+                reload(synchro_settings)
+                a = TestModel.objects.create(name='James')
+                date = PendingChange.objects.get().date
+
+                def progress(event):
+                    # Update which was dated before the run started, but committed only now
+                    PendingChange.objects.update(
+                        actions=F('actions').bitor(ACTION_FLAGS[CHANGE]), date=date + datetime.timedelta(microseconds=1))
+                call_synchronize(progress=progress)
+                self.assertRemoteCount(1, TestModel)
+                self.assertLocalCount(1, PendingChange)
+                a.name = 'Bond'
+                a.save()
+                self.synchronize()
+                self.assertLocalCount(0, PendingChange)
+                self.assertEqual('Bond', TestModel.objects.db_manager(REMOTE).get().name)
+        finally:
+            reload(synchro_settings)
+
+    def test_channels(self):
+        """Test if channels are synchronized separately, each with its own checkpoint."""
+        from synchro.models import ChannelState
+        channels = {'fk': {'models': (('synchro', 'ModelWithFK'),), 'priority': 10}}
+        try:
+            with override_settings(SYNCHRO_CHANNELS=channels):
+                reload(synchro_settings)
+                self.assertEqual(['fk', 'default'], [c.name for c in synchro_settings.CHANNELS])
+                TestModel.objects.create(name='James')
+                link = PkModelWithSkip.objects.create(name='Bond')
+                ModelWithFK.objects.create(name='M', link=link)
+                self.synchronize(channels=['fk'])
+                self.assertRemoteCount(1, ModelWithFK)
+                self.assertRemoteCount(1, PkModelWithSkip)  # FK target from other channel
+                self.assertRemoteCount(0, TestModel)
+                self.assertEqual(1, ChannelState.objects.count())
+
+                ModelWithFK.objects.create(name='N', link=link)
+                self.synchronize()
+                self.assertRemoteCount(2, ModelWithFK)
+                self.assertRemoteCount(1, PkModelWithSkip)
+                self.assertRemoteCount(1, TestModel)
+                self.assertRaises(CommandError, self.synchronize, channels=['foo'],
+                                  exception_class=CommandError)
+
+            # Invalid configurations
+            channel = {'models': (('synchro', 'testmodel'),)}
+            for channels in ({'default': channel}, {'a': channel, 'b': channel},
+                             {'a': {'models': (('synchro', 'M2mIntermediate'),)}}):
+                with override_settings(SYNCHRO_CHANNELS=channels):
+                    reload(synchro_settings)  # Settings are validated on first use
+                    self.assertRaises(ImproperlyConfigured, len, synchro_settings.CHANNELS)
+        finally:
+            reload(synchro_settings)
+
+    def test_local_read(self):
+        """Test if LOCAL data is read from SYNCHRO_LOCAL_READ, unless it lags too much."""
+        TestModel.objects.create(name='James')
+        try:
+            # REMOTE plays the role of LOCAL replica, which has not received any changes yet
+            with override_settings(SYNCHRO_LOCAL_READ=REMOTE):
+                reload(synchro_settings)
+                self.synchronize()
+                self.assertRemoteCount(0, TestModel)
+            with override_settings(SYNCHRO_LOCAL_READ=REMOTE, SYNCHRO_LOCAL_READ_MAX_LAG=60):
+                reload(synchro_settings)
+                self.synchronize()
+                self.assertRemoteCount(1, TestModel)
+        finally:
+            reload(synchro_settings)
+
+    def test_pipeline(self):
+        """Test if pipelined synchronization performs the same actions as the sequential one."""
+        a = TestModel.objects.create(name='James')
+        m2m = M2mModelWithKey.objects.create()
+        m2m.r_m2m.add(M2mAnother.objects.create(bar=3))
+        self.synchronize(pipeline=True)
+        self.assertRemoteCount(1, TestModel)
+        self.assertEqual([3], list(M2mModelWithKey.objects.db_manager(REMOTE).get()
+                                   .r_m2m.values_list('bar', flat=True)))
+        self.wait()
+        a.delete()
+        TestModel.objects.create(name='Bond')
+        self.synchronize(pipeline=True)
+        self.assertEqual(['Bond'], list(TestModel.objects.db_manager(REMOTE)
+                                        .values_list('name', flat=True)))
+
+    def test_seed(self):
+        """Test if synchro_seed copies objects in bulk and sets the checkpoint."""
+        ModelWithKey.objects.db_manager(REMOTE).create(name='James', cash=1)
+        key = ModelWithKey.objects.create(name='James', cash=7)
+        ModelWithFKtoKey.objects.create(name='Bond', link=key)
+        a = TestModel.objects.create(name='James')
+        TestModel.objects.create(name='Bond')
+        m2m = M2mModelWithKey.objects.create(foo=5)
+        m2m.r_m2m.add(M2mAnother.objects.create(bar=3))
+        s1, s2 = M2mSelf.objects.create(foo=1), M2mSelf.objects.create(foo=2)
+        s1.m2m.add(s2)
+        call_command('synchro_seed', verbosity=0)
+        self.assertRemoteCount(2, TestModel)
+        self.assertRemoteCount(1, ModelWithKey)
+        rem_key = ModelWithKey.objects.db_manager(REMOTE).get()
+        self.assertEqual(7, rem_key.cash)
+        self.assertEqual(rem_key, ModelWithFKtoKey.objects.db_manager(REMOTE).get().link)
+        self.assertEqual([3], list(M2mModelWithKey.objects.db_manager(REMOTE).get()
+                                   .r_m2m.values_list('bar', flat=True)))
+        self.assertEqual([2], list(M2mSelf.objects.db_manager(REMOTE).get(foo=1)
+                                   .m2m.values_list('foo', flat=True)))
+        self.assertNoActionOnSynchronize(TestModel)
+        self.wait()
+        a.name = 'Bond'
+        a.save()
+        self.synchronize()
+        self.assertRemoteCount(2, TestModel)
+        self.assertEqual(['Bond', 'Bond'], list(TestModel.objects.db_manager(REMOTE)
+                                                .values_list('name', flat=True)))
+
+    def test_seed_taken_pks(self):
+        """Test if seeding commits chunk by chunk and copies objects whose pks are taken."""
+        TestModel.objects.db_manager(REMOTE).create(name='Remote')
+        for name in ('James', 'Bond', 'Q'):
+            TestModel.objects.create(name=name)
+
+        def fail(sender, instance, using, **kwargs):
+            if using == REMOTE and instance.name == 'Q':
+                raise ValueError('Q')
+        pre_save.connect(fail, sender=TestModel)
+        try:
+            self.assertRaises(ValueError, call_command, 'synchro_seed', chunk_size=2, verbosity=0)
+        finally:
+            pre_save.disconnect(fail, sender=TestModel)
+        # The first chunk stays copied
+        self.assertRemoteCount(3, TestModel)
+        self.assertEqual(2, Reference.objects.count())
+        call_command('synchro_seed', chunk_size=2, verbosity=0)
+        self.assertRemoteCount(4, TestModel)
+        for ref in Reference.objects.all():
+            self.assertEqual(TestModel.objects.get(pk=ref.local_object_id).name,
+                             TestModel.objects.db_manager(REMOTE).get(pk=ref.remote_object_id).name)
+        self.assertEqual(3, Reference.objects.count())
+
+    def test_verify(self):
+        """Test if synchro_verify finds and repairs differences between LOCAL and REMOTE."""
+        TestModel.objects.create(name='James')
+        TestModel.objects.create(name='Bond')
+        c = TestModel.objects.create(name='Q')
+        self.synchronize()
+        TestModel.objects.db_manager(REMOTE).filter(name='James').update(cash=5)
+        TestModel.objects.db_manager(REMOTE).filter(name='Bond').delete()
+        with DisableSynchroLog():
+            c.delete()
+            TestModel.objects.create(name='M')
+        out = StringIO()
+        call_command('synchro_verify', stdout=out)
+        self.assertIn('synchro.testmodel: 3 checked, 1 differing, 2 missing, 1 extra.',
+                      out.getvalue())
+        self.assertRemoteCount(2, TestModel)
+        call_command('synchro_verify', repair=True, verbosity=0)
+        self.assertEqual([(0, 'Bond'), (0, 'James'), (0, 'M')],
+                         sorted(TestModel.objects.db_manager(REMOTE).values_list('cash', 'name')))
+        out = StringIO()
+        call_command('synchro_verify', stdout=out)
+        self.assertEqual('0 objects differ.\n', out.getvalue())
+
+    def test_verify_checksums(self):
+        """Test if synchro_verify fetches only rows of ranges whose checksums differ."""
+        from synchro.verification import LEAF_SIZE
+        TestModel.objects.db_manager(REMOTE).create(name='Old')  # REMOTE ids are shifted
+        link = PkModelWithSkip.objects.create(name='Link')
+        for i in range(40):
+            TestModel.objects.create(name='James %d' % i)
+            ModelWithFK.objects.create(name='Bond %d' % i, link=link)
+        self.synchronize()
+        TestModel.objects.db_manager(REMOTE).filter(name='Old').delete()
+
+        def verify():
+            with CaptureQueriesContext(connections[REMOTE]) as queries:
+                call_command('synchro_verify', chunk_size=40, verbosity=0)
+            return [q['sql'] for q in queries
+                    if '."name"' in q['sql'] and 'SUM(' not in q['sql']]
+        self.assertEqual([], verify())
+        # Equal multisets of values, but swapped between objects
+        remote = TestModel.objects.db_manager(REMOTE)
+        remote.filter(name='James 3').update(name='tmp')
+        remote.filter(name='James 30').update(name='James 3')
+        remote.filter(name='tmp').update(name='James 30')
+        fetched = verify()
+        self.assertEqual(2, len(fetched))
+        for sql in fetched:
+            self.assertLessEqual(sql.count(',') - 2, LEAF_SIZE)
+        out = StringIO()
+        call_command('synchro_verify', stdout=out)
+        self.assertIn('synchro.testmodel: 40 checked, 2 differing, 0 missing, 0 extra.',
+                      out.getvalue())
+        self.assertNotIn('synchro.modelwithfk', out.getvalue())
+
+    def test_progress_and_cancel(self):
+        """Test if progress is reported after every batch and synchronization can be cancelled."""
+        from threading import Event
+        from synchro.core import call_synchronize, SynchronizationCancelled
+        TestModel.objects.create(name='James')
+        TestModel.objects.create(name='Bond')
+        try:
+            with override_settings(SYNCHRO_BATCH_SIZE=1):
+                reload(synchro_settings)
+                events = []
+                cancel = Event()
+
+                def progress(event):
+                    events.append(event)
+                    cancel.set()
+                self.assertRaises(SynchronizationCancelled, call_synchronize,
+                                  progress=progress, cancel=cancel)
+                self.assertEqual([{'channel': 'default', 'batch': 1, 'count': 1}], events)
+                self.assertRemoteCount(0, TestModel)  # rolled back
+                call_synchronize(progress=events.append)
+                self.assertEqual(3, len(events))
+                self.assertRemoteCount(2, TestModel)
+        finally:
+            reload(synchro_settings)
+
+    def test_failure_forgets_references(self):
+        """Test if references cached by a failed (rolled back) run are forgotten."""
+        from threading import Event
+        from synchro.core import call_synchronize, SynchronizationCancelled
+        a = TestModel.objects.create(name='James')
+        TestModel.objects.create(name='Bond')
+        ct = ContentType.objects.get_for_model(TestModel)
+        cancel = Event()
+        try:
+            with override_settings(SYNCHRO_BATCH_SIZE=1):
+                reload(synchro_settings)
+                self.assertRaises(SynchronizationCancelled, call_synchronize,
+                                  progress=lambda event: cancel.set(), cancel=cancel)
+        finally:
+            reload(synchro_settings)
+        self.assertRemoteCount(0, TestModel)
+        self.assertIsNone(REFERENCE_CACHE.get(ct, a.pk))
+        TestModel.objects.db_manager(REMOTE).create(name='Q')  # may take the rolled back id
+        a.name = 'M'
+        a.save()
+        self.synchronize()
+        self.assertEqual(['Bond', 'M', 'Q'], sorted(TestModel.objects.db_manager(REMOTE)
+                                                    .values_list('name', flat=True)))
+
+    def test_snapshot(self):
+        """Test if synchronization reading LOCAL snapshot performs all channels at once."""
+        TestModel.objects.create(name='James')
+        self.synchronize(snapshot=True)
+        self.assertRemoteCount(1, TestModel)
+        self.wait()
+        TestModel.objects.create(name='Bond')
+        self.synchronize(snapshot=True, pipeline=True)
+        self.assertRemoteCount(2, TestModel)
+        self.assertEqual(['Bond', 'James'], sorted(TestModel.objects.db_manager(REMOTE)
+                                                   .values_list('name', flat=True)))
+
+    def test_quarantine(self):
+        """Test if failing changes are quarantined, so that the rest is synchronized."""
+        from synchro.core import call_synchronize
+        from synchro.models import ADDITION, QuarantinedChange
+
+        def poison(sender, instance, using, **kwargs):
+            if using == REMOTE and instance.name == 'Poison':
+                raise ValueError('Poisoned')
+        pre_save.connect(poison, sender=TestModel)
+        try:
+            TestModel.objects.create(name='James')
+            bad = TestModel.objects.create(name='Poison')
+            TestModel.objects.create(name='Bond')
+            self.assertRaises(ValueError, self.synchronize)
+            self.assertRemoteCount(0, TestModel)
+            self.assertEqual('Synchronization performed; 1 changes quarantined.',
+                             call_synchronize(quarantine=True))
+            self.assertRemoteCount(2, TestModel)
+            q = QuarantinedChange.objects.get()
+            self.assertEqual((str(bad.pk), 'ValueError: Poisoned', 1),
+                             (q.object_id, q.error, q.attempts))
+            # Later changes of the object are kept in quarantine
+            self.wait()
+            bad.cash = 5
+            bad.save()
+            call_synchronize(quarantine=True)
+            q = QuarantinedChange.objects.get()
+            self.assertEqual(([ADDITION], 1), (q.get_actions(), q.attempts))
+            call_command('synchro_retry', verbosity=0)
+            self.assertEqual(2, QuarantinedChange.objects.get().attempts)
+        finally:
+            pre_save.disconnect(poison, sender=TestModel)
+        call_command('synchro_retry', verbosity=0)
+        self.assertFalse(QuarantinedChange.objects.exists())
+        self.assertEqual(5, TestModel.objects.db_manager(REMOTE).get(name='Poison').cash)
+
+    def test_files(self):
+        """Test if files are copied to the remote storage, skipping unchanged ones."""
+        import os
+        import shutil
+        import tempfile
+        from django.core.files.base import ContentFile
+        from synchro.files import get_file_sync, get_remote_storage
+        local_dir, remote_dir = tempfile.mkdtemp(), tempfile.mkdtemp()
+        try:
+            with override_settings(
+                    MEDIA_ROOT=local_dir,
+                    SYNCHRO_REMOTE_STORAGE='django.core.files.storage.FileSystemStorage',
+                    SYNCHRO_REMOTE_STORAGE_OPTIONS={'location': remote_dir}):
+                reload(synchro_settings)
+                doc = Document(name='James')
+                doc.file.save('bond.txt', ContentFile(b'007'))
+                self.synchronize()
+                remote = get_remote_storage()
+                self.assertEqual(b'007', remote.open('docs/bond.txt').read())
+                # Unchanged file is skipped
+                files = get_file_sync()
+                files.add(doc)
+                files.finish()
+                self.assertEqual((0, 1), (files.copied, files.skipped))
+                doc.file.open('wb')
+                doc.file.write(b'008')
+                doc.file.close()
+                doc.save()
+                self.synchronize()
+                self.assertEqual(b'008', remote.open('docs/bond.txt').read())
+                # Replaced, without leaving a temporary file behind
+                self.assertEqual(['bond.txt'], os.listdir(os.path.join(remote_dir, 'docs')))
+        finally:
+            reload(synchro_settings)
+            shutil.rmtree(local_dir)
+            shutil.rmtree(remote_dir)
+
+    def test_lease(self):
+        """Test if overlapping synchronization is refused until the lease expires."""
+        from synchro.core import call_synchronize, LeaseUnavailable
+        from synchro.lease import Lease
+        from synchro.models import SyncLease
+        from django.utils.timezone import now
+        TestModel.objects.create(name='James')
+        lease = Lease('synchronize', 60)
+        lease.acquire()
+        self.assertRaises(LeaseUnavailable, call_synchronize)
+        self.assertRaises(CommandError, self.synchronize)
+        self.assertRemoteCount(0, TestModel)
+        self.assertRaises(LeaseUnavailable, call_synchronize, shard='0/1')
+        self.assertRemoteCount(0, TestModel)
+        self.assertTrue(lease.renew())
+        # Holder died
+        SyncLease.objects.filter(name='synchronize').update(expires=now())
+        TestModel.objects.create(name='Bond')
+        self.synchronize()
+        self.assertRemoteCount(2, TestModel)
+        self.assertFalse(lease.renew())
+        self.assertEqual('', SyncLease.objects.get(name='synchronize').owner)
+        lease.release()
+
+    def test_shard_leases(self):
+        """Test if shards run concurrently with each other, but not with a full run."""
+        from synchro.core import call_synchronize, LeaseUnavailable
+        from synchro.lease import Lease
+        from synchro.models import SyncLease
+        TestModel.objects.create(name='James')
+        lease = Lease('synchronize@0/2', 60)
+        lease.acquire()
+        try:
+            self.assertRaises(LeaseUnavailable, call_synchronize)
+            # Refused run doesn't keep its lease
+            self.assertEqual('', SyncLease.objects.get(name='synchronize').owner)
+            call_synchronize(shard='1/2')
+            self.assertRaises(LeaseUnavailable, call_synchronize, shard='0/2')
+        finally:
+            lease.release()
+        call_synchronize()
+        self.assertRemoteCount(1, TestModel)
+
+    def test_shards(self):
+        """Test if shards synchronize disjoint sets of objects and advance the checkpoint."""
+        from synchro.core import call_synchronize
+        from synchro.management.commands.synchronize import in_shard
+        root = Node.objects.create(name='root')
+        for i in range(6):
+            Node.objects.create(name='node%d' % i, parent=root)
+        logs = ChangeLog.objects.all()
+        self.assertEqual(7, sum(in_shard(log, (i, 3)) for log in logs for i in range(3)))
+        self.assertRaises(CommandError, self.synchronize, shard='3/3')
+        self.synchronize(shard='1/2')
+        synced = set(Node.objects.db_manager(REMOTE).values_list('name', flat=True))
+        self.assertEqual(set(log.object.name for log in logs if in_shard(log, (1, 2)))
+                         | set(['root']), synced)
+        self.synchronize(shard='0/2')
+        self.assertRemoteCount(7, Node)
+        self.assertEqual(6, Node.objects.db_manager(REMOTE).get(name='root').children.count())
+        self.assertEqual('No changes since last synchronization.', call_synchronize())
+
+    def test_shards_and_full_run(self):
+        """Test if a full run after a shard doesn't duplicate objects synchronized by the shard."""
+        from synchro.core import call_synchronize
+        for i in range(6):
+            TestModel.objects.create(name='James %d' % i)
+        self.synchronize(shard='0/2')
+        in_shard = TestModel.objects.db_manager(REMOTE).count()
+        self.assertTrue(0 < in_shard < 6)
+        self.synchronize()
+        self.assertRemoteCount(6, TestModel)
+        self.synchronize(shard='1/2')
+        self.assertRemoteCount(6, TestModel)
+        self.wait()
+        TestModel.objects.create(name='Bond')
+        self.synchronize(shard='1/2')
+        self.synchronize(shard='0/2')
+        self.assertRemoteCount(7, TestModel)
+        self.assertEqual('No changes since last synchronization.', call_synchronize())
+
+    def test_claim_ref(self):
+        """Test if an object being created by a shard can't be created by another one as well."""
+        from synchro.management.commands.synchronize import claim_ref, find_ref
+        from synchro.models import get_reference_model
+        a = TestModel.objects.create(name='James')
+        b = TestModel.objects.create(name='Bond')
+        ct = ContentType.objects.get_for_model(TestModel)
+        self.assertEqual((None, None), claim_ref(ct, a.pk))
+        self.assertEqual(1, get_reference_model(ct).objects.filter(local_object_id=a.pk).count())
+        # Placeholder is pending, neither looked up on REMOTE nor deleted as stale
+        self.assertEqual((None, None), find_ref(ct, a.pk))
+        self.assertEqual((None, None), claim_ref(ct, a.pk))
+        self.assertEqual(1, get_reference_model(ct).objects.filter(local_object_id=a.pk).count())
+        # Created (and committed) by another shard in the meantime
+        rem = TestModel.objects.db_manager(REMOTE).create(name='Bond')
+        get_reference_model(ct).objects.create(content_type=ct, local_object_id=b.pk,
+                                               remote_object_id=rem.pk)
+        found, remote_id = claim_ref(ct, b.pk)
+        self.assertEqual(rem, found)
+        self.assertEqual(six.text_type(rem.pk), six.text_type(remote_id))
+
+    def test_track_fields(self):
+        """Test if only changed fields are updated on REMOTE."""
+        from synchro.signals import synchro_connect, synchro_disconnect
+        try:
+            with override_settings(SYNCHRO_TRACK_FIELDS=True):
+                reload(synchro_settings)
+                synchro_disconnect()
+                synchro_connect()
+                TestModel.objects.create(name='James', cash=7)
+                self.synchronize()
+                self.wait()
+                rem = TestModel.objects.db_manager(REMOTE).get(name='James')
+                rem.cash = 10  # remote change
+                rem.save()
+                a = TestModel.objects.get(name='James')
+                a.name = 'Bond'
+                a.save()
+                a.name = 'Bond James'
+                a.save()
+                self.assertEqual(['name'], ChangeLog.objects.get(action=CHANGE).get_changed_fields())
+                self.synchronize()
+                rem = TestModel.objects.db_manager(REMOTE).get(pk=rem.pk)
+                self.assertEqual('Bond James', rem.name)
+                self.assertEqual(10, rem.cash)
+                self.wait()
+
+                # update_fields are respected
+                a.cash = 42
+                a.name = 'Not saved'
+                a.save(update_fields=['cash'])
+                self.synchronize()
+                rem = TestModel.objects.db_manager(REMOTE).get(pk=rem.pk)
+                self.assertEqual('Bond James', rem.name)
+                self.assertEqual(42, rem.cash)
+        finally:
+            reload(synchro_settings)
+            synchro_disconnect()
+            synchro_connect()
+
 
 class SignalSynchroTests(SynchroTests):
     """Cover signals tests."""
@@ -870,3 +1680,462 @@ class M2MSynchroTests(SynchroTests):
         self.synchronize()
         self.assertEqual(0, b.m2m.count())
         self.assertEqual(0, k.m2m.count())
+
+
+class ChangesetSynchroTests(SynchroTests):
+    """Cover export and import of changeset files."""
+
+    def setUp(self):
+        import os
+        import tempfile
+        super(ChangesetSynchroTests, self).setUp()
+        fd, self.path = tempfile.mkstemp(suffix='.jsonl.gz')
+        os.close(fd)
+        self.addCleanup(os.remove, self.path)
+
+    def transfer(self):
+        call_command('synchro_export', self.path, verbosity=0)
+        call_command('synchro_import', self.path, database=REMOTE, verbosity=0)
+
+    def test_export_import(self):
+        """Test if changes are transferred through file."""
+        from synchro.models import ImportReference
+        some = TestModel.objects.db_manager(REMOTE).create(name='Remote James', cash=77)
+        a = TestModel.objects.create(name='James', cash=7)
+        self.assertEqual(a.pk, some.pk)
+        key = ModelWithKey.objects.create(name='Bond', cash=7, visits=42)
+        ModelWithFKtoKey.objects.create(name='Link', link=key)
+        test = M2mNotExplicitlySynced.objects.create(foo=77)
+        inter = M2mModelWithInter.objects.create()
+        M2mIntermediate.objects.create(with_key=M2mModelWithKey.objects.create(foo=42),
+                                       with_inter=inter, cash=42, extra=test)
+        another = M2mAnother.objects.create()
+        another.m2m.add(M2mModelWithKey.objects.create(foo=1))
+        TestModel.objects.create(name='Temp').delete()
+        self.transfer()
+        self.assertRemoteCount(2, TestModel)
+        b = TestModel.objects.db_manager(REMOTE).get(name='James')
+        self.assertNotEqual(a.pk, b.pk)  # auto pk is not overwritten
+        remote_key = ModelWithKey.objects.db_manager(REMOTE).get()
+        self.assertEqual(0, remote_key.visits)  # skipped
+        self.assertEqual('Link', remote_key.links.get().name)
+        self.assertRemoteCount(1, M2mNotExplicitlySynced)
+        inter_b = M2mModelWithInter.objects.db_manager(REMOTE).get()
+        self.assertEqual([42], [k.foo for k in inter_b.m2m.all()])
+        self.assertEqual(77, M2mIntermediate.objects.db_manager(REMOTE).get().extra.foo)
+        self.assertEqual([1], [k.foo for k in
+                               M2mAnother.objects.db_manager(REMOTE).get().m2m.all()])
+
+        # Nothing more to export
+        self.transfer()
+        self.assertRemoteCount(2, TestModel)
+        self.assertRemoteCount(2, M2mModelWithKey)
+
+        # Changes and deletions are applied to the imported objects
+        self.wait()
+        a.cash = 42
+        a.save()
+        key_pk = key.pk
+        self.assertTrue(ImportReference.objects.db_manager(REMOTE).filter(
+            source_object_id=key_pk, content_type__model='modelwithkey').exists())
+        key.delete()
+        another.m2m.clear()
+        self.transfer()
+        self.assertEqual(42, TestModel.objects.db_manager(REMOTE).get(pk=b.pk).cash)
+        self.assertEqual(77, TestModel.objects.db_manager(REMOTE).get(pk=some.pk).cash)
+        self.assertRemoteCount(0, ModelWithKey)
+        self.assertRemoteCount(0, ModelWithFKtoKey)
+        self.assertEqual(0, M2mAnother.objects.db_manager(REMOTE).get().m2m.count())
+        self.assertFalse(ImportReference.objects.db_manager(REMOTE).filter(
+            source_object_id=key_pk, content_type__model='modelwithkey').exists())
+
+    def test_export_import_fk_order(self):
+        """Test if foreign key target is exported first, even if its change is recorded later."""
+        from synchro.transfer import Importer
+        try:
+            with override_settings(SYNCHRO_CAPTURE='state'):
+                reload(synchro_settings)
+                other = Node.objects.db_manager(REMOTE).create(name='Other')
+                parent = Node.objects.create(name='Parent')
+                self.assertEqual(other.pk, parent.pk)
+                Node.objects.create(name='Child', parent=parent)
+                parent.name = 'Parent 2'
+                parent.save()
+                self.transfer()
+                child = Node.objects.db_manager(REMOTE).get(name='Child')
+                self.assertEqual('Parent 2', child.parent.name)
+                self.assertRemoteCount(3, Node)
+        finally:
+            reload(synchro_settings)
+        # Target which was not imported is never assumed to have the same pk
+        record = {'action': 'save', 'model': 'synchro.node', 'pk': 77,
+                  'fields': {'name': 'Orphan', 'parent': 999}}
+        Node.objects.db_manager(REMOTE).create(pk=999, name='Unrelated')
+        self.assertRaises(ValueError, Importer(REMOTE).apply, [record])
+
+    def test_export_written_once(self):
+        """Test if dependency shared by several chunks is exported only once."""
+        from synchro.transfer import read_changeset
+        parent = Node.objects.create(name='Parent')
+        for i in range(3):
+            Node.objects.create(name='Child %d' % i, parent=parent)
+        call_command('synchro_export', self.path, chunk_size=1, verbosity=0)
+        records = [r for chunk in read_changeset(self.path) for r in chunk]
+        self.assertEqual(4, len(records))
+        self.assertEqual(1, len([r for r in records if r['fields']['name'] == 'Parent']))
+        call_command('synchro_import', self.path, database=REMOTE, verbosity=0)
+        self.assertRemoteCount(4, Node)
+
+    def test_import_batched_updates(self):
+        """Test if updates of imported objects don't take a query per object."""
+        for i in range(5):
+            TestModel.objects.create(name='James %d' % i, cash=i)
+        self.transfer()
+        self.wait()
+        TestModel.objects.update(cash=F('cash') + 10)
+        for obj in TestModel.objects.all():
+            obj.save()
+        call_command('synchro_export', self.path, verbosity=0)
+        with CaptureQueriesContext(connections[REMOTE]) as remote:
+            call_command('synchro_import', self.path, database=REMOTE, verbosity=0)
+        self.assertEqual(list(range(10, 15)), sorted(
+            TestModel.objects.db_manager(REMOTE).values_list('cash', flat=True)))
+        updates = [q for q in remote.captured_queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(1, len(updates))
+
+    def test_import_invalid_file(self):
+        """Test if file which is not a changeset is reported clearly."""
+        import gzip
+        from contextlib import closing
+        with closing(gzip.open(self.path, 'wb')) as f:
+            f.write(b'{"version": null}\n')
+        with six.assertRaisesRegex(self, CommandError, 'not a synchro changeset'):
+            call_command('synchro_import', self.path, database=REMOTE, verbosity=0)
+
+    def test_push(self):
+        """Test if changes are pushed over HTTP in signed batches and References are stored."""
+        import time
+        from synchro.transport import Pusher, TransportError, sign
+        path = reverse('receive')
+
+        def post(url, body, headers):
+            response = self.client.post(url, body, content_type=headers['Content-Type'],
+                                        HTTP_X_SYNCHRO_SIGNATURE=headers['X-Synchro-Signature'],
+                                        HTTP_X_SYNCHRO_TIMESTAMP=headers['X-Synchro-Timestamp'])
+            if response.status_code != 200:
+                raise TransportError(response.status_code)
+            return response.content
+
+        try:
+            with override_settings(SYNCHRO_TRANSPORT_KEY='secret', SYNCHRO_RECEIVE_DATABASE=REMOTE):
+                reload(synchro_settings)
+                a = TestModel.objects.create(name='James', cash=7)
+                TestModel.objects.create(name='Bond')
+                self.assertRaises(TransportError, Pusher(path, 'wrong', post).push_all)
+                self.assertRemoteCount(0, TestModel)
+                self.assertEqual(2, Pusher(path, 'secret', post).push_all(batch_size=1))
+                self.assertRemoteCount(2, TestModel)
+                remote = TestModel.objects.db_manager(REMOTE).get(name='James')
+                ct = ContentType.objects.get_for_model(TestModel)
+                self.assertEqual(str(remote.pk), Reference.objects.get(
+                    content_type=ct, local_object_id=a.pk).remote_object_id)
+                self.assertEqual(0, Pusher(path, 'secret', post).push_all())
+
+                self.wait()
+                a.delete()
+                self.assertEqual(1, Pusher(path, 'secret', post).push_all())
+                self.assertRemoteCount(1, TestModel)
+                self.assertFalse(Reference.objects.filter(content_type=ct).exclude(
+                    local_object_id=TestModel.objects.get().pk).exists())
+
+                timestamp = int(time.time())
+                response = self.client.post(
+                    path, b'garbage', content_type='application/x-synchro-changeset',
+                    HTTP_X_SYNCHRO_SIGNATURE=sign('secret', timestamp, b'garbage'),
+                    HTTP_X_SYNCHRO_TIMESTAMP=str(timestamp))
+                self.assertEqual(400, response.status_code)
+        finally:
+            reload(synchro_settings)
+
+
+class QueryBudgetTests(SynchroTests):
+    """
+    Numbers of queries issued on LOCAL and REMOTE by capture handlers and synchronization.
+    Budgets don't depend on the number of objects, unless the growth is stated explicitly.
+    Every synchronization run takes its lease, checks conflicting leases and releases it
+    (3 LOCAL queries), and checks whether shards were synchronized separately (1 LOCAL query).
+    """
+
+    def count_queries(self, func, *args, **kwargs):
+        """
+        Returns numbers of queries issued by func on LOCAL and REMOTE. Queries of dbsettings
+        (checkpoint and run statistics) are not counted, since their caching varies.
+        """
+        with CaptureQueriesContext(connections[LOCAL]) as local:
+            with CaptureQueriesContext(connections[REMOTE]) as remote:
+                func(*args, **kwargs)
+        return tuple(len([q for q in queries if 'dbsettings_setting' not in q['sql']])
+                     for queries in (local, remote))
+
+    def assertQueries(self, local, remote, func, *args, **kwargs):
+        self.assertEqual((local, remote), self.count_queries(func, *args, **kwargs))
+
+    def assertGrowth(self, build, base, per_object, sizes=(2, 4)):
+        """
+        Asserts that synchronizing objects created by build(n) takes base + n * per_object
+        queries (both are (LOCAL, REMOTE) pairs). Caches are warmed up first.
+        """
+        build(1)
+        self.synchronize()
+        self.wait()
+        for n in sizes:
+            build(n)
+            self.assertQueries(base[0] + n * per_object[0], base[1] + n * per_object[1],
+                               self.synchronize)
+            self.wait()
+
+    def test_capture(self):
+        """Test queries of capture handlers."""
+        TestModel.objects.create(name='Warm-up').delete()
+        a = TestModel(name='James')
+        self.assertQueries(2, 0, a.save)
+        a.name = 'Bond'
+        self.assertQueries(3, 0, a.save)
+        a.name = 'James Bond'
+        self.assertQueries(5, 0, a.save)  # previous change log is deleted
+        self.assertQueries(2, 0, a.delete)
+        m2m = M2mModelWithKey.objects.create()
+        another = M2mAnother.objects.create()
+        self.assertQueries(4, 0, m2m.r_m2m.add, another)
+
+    def test_add_change_delete(self):
+        """Test queries of synchronizing plain objects."""
+        objects = []
+
+        def add(n):
+            objects[:] = [TestModel.objects.create(name=str(i)) for i in range(n)]
+
+        def change(n):
+            add(n)
+            self.synchronize()
+            self.wait()
+            for obj in objects:
+                obj.cash += 1
+                obj.save()
+
+        def delete(n):
+            add(n)
+            self.synchronize()
+            self.wait()
+            for obj in objects:
+                obj.delete()
+        # Every object is read, created and referenced separately
+        self.assertGrowth(add, (9, 2), (6, 1))
+        # Every object is read, its remote counterpart (Reference is cached) is read and updated
+        self.assertGrowth(change, (9, 2), (2, 2))
+        # Deletions are performed in bulk
+        self.assertGrowth(delete, (12, 5), (0, 0))
+
+    def test_fk_chain(self):
+        """Test queries of synchronizing chain of n objects linked by foreign keys."""
+        def build(n):
+            parent = None
+            for i in range(n):
+                parent = Node.objects.create(name=str(i), parent=parent)
+        # Every object is added (and its parent is looked up)
+        self.assertGrowth(build, (8, 1), (7, 2))
+
+    def test_fk_chain_leaf(self):
+        """Test queries of synchronizing object whose n ancestors are synchronized on demand."""
+        def build(n):
+            with DisableSynchroLog():
+                parent = None
+                for i in range(n):
+                    parent = Node.objects.create(name=str(i), parent=parent)
+            Node.objects.create(name='leaf', parent=parent)
+        # Every ancestor is created on demand
+        self.assertGrowth(build, (15, 3), (8, 1))
+
+    def test_m2m(self):
+        """Test queries of synchronizing object with k m2m links (to already synchronized ones)."""
+        def build(k):
+            related = [M2mModelWithKey.objects.create(foo=i) for i in range(k)]
+            self.synchronize()
+            self.wait()
+            M2mAnother.objects.create().m2m.add(*related)
+        # Every related object is verified (its Reference is cached)
+        self.assertGrowth(build, (17, 7), (1, 1))
+
+    def test_intermediary_m2m(self):
+        """Test queries of synchronizing object with k links by custom intermediary model."""
+        def build(k):
+            related = [M2mModelWithKey.objects.create(foo=i) for i in range(k)]
+            extra = M2mNotExplicitlySynced.objects.create()
+            self.synchronize()
+            self.wait()
+            obj = M2mModelWithInter.objects.create()
+            for rel in related:
+                M2mIntermediate.objects.create(with_key=rel, with_inter=obj, extra=extra, cash=1)
+        # Every intermediary object is saved with its foreign keys ensured
+        self.assertGrowth(build, (24, 5), (8, 5))
+
+    def test_natural_key_deletion(self):
+        """Test queries of deleting k objects found by natural keys (without References)."""
+        def build(k):
+            objects = [ModelWithKey.objects.create(name='%d-%d' % (k, i)) for i in range(k)]
+            self.synchronize()
+            self.wait()
+            Reference.objects.all().delete()
+            for obj in objects:
+                obj.delete()
+        # Natural keys are resolved in bulk
+        self.assertGrowth(build, (11, 7), (0, 0))
+
+
+@override_settings(**SETTINGS)
+class AsyncSynchroTests(TransactionTestCase):
+    """Synchronization runs in an executor thread, so it needs committed data."""
+    multi_db = True
+
+    @classmethod
+    def setUpClass(cls):
+        super(AsyncSynchroTests, cls).setUpClass()
+        reload(synchro_settings)
+
+    @classmethod
+    def tearDownClass(cls):
+        super(AsyncSynchroTests, cls).tearDownClass()
+        reload(synchro_settings)
+
+    @skipUnless(six.PY3, 'asyncio is not available on Python 2')
+    def test_acall_synchronize(self):
+        """Test if acall_synchronize runs synchronization off the event loop."""
+        import asyncio
+        from synchro.aio import acall_synchronize
+        TestModel.objects.create(name='James')
+        TestModel.objects.create(name='Bond')
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)  # queue of Python < 3.10 binds to it
+        try:
+            queue = asyncio.Queue()
+            with override_settings(SYNCHRO_BATCH_SIZE=1):
+                reload(synchro_settings)
+                loop.run_until_complete(acall_synchronize(progress=queue))
+            loop.run_until_complete(asyncio.sleep(0))  # deliver queued events
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+            reload(synchro_settings)
+        events = []
+        while not queue.empty():
+            events.append(queue.get_nowait())
+        self.assertEqual([1, 2], [event['count'] for event in events])
+        remote = TestModel.objects.db_manager(REMOTE)
+        self.assertEqual(['Bond', 'James'], sorted(remote.values_list('name', flat=True)))
+
+
+class LeaseTests(TransactionTestCase):
+    """Leases are stored through a separate connection, outside transactions of LOCAL."""
+
+    def setUp(self):
+        super(LeaseTests, self).setUp()
+        connection = connections[LOCAL]
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db() and \
+                not connection.features.can_share_in_memory_db:
+            self.skipTest('In-memory database cannot be opened twice.')
+        self.addCleanup(reload, synchro_settings)
+        with override_settings(SYNCHRO_LEASE_DATABASE=None):
+            reload(synchro_settings)
+
+    def test_separate_connection(self):
+        """Test if lease taken inside a transaction is committed at once."""
+        from django.db import transaction
+        from synchro.lease import Lease, LeaseUnavailable
+        from synchro.models import SyncLease
+        lease = Lease('synchronize', 60, owner='first')
+        self.assertNotEqual(LOCAL, lease.using)
+        try:
+            with transaction.atomic():
+                lease.acquire()
+                raise ValueError('Rolled back')
+        except ValueError:
+            pass
+        self.assertEqual('first', SyncLease.objects.get(name='synchronize').owner)
+        self.assertRaises(LeaseUnavailable, Lease('synchronize', 60, owner='second').acquire)
+        lease.release()
+        self.assertEqual('', SyncLease.objects.get(name='synchronize').owner)
+
+
+class MigrationTests(TestCase):
+    """Cover migrations, applied to a separate in-memory database."""
+
+    alias = 'synchro_migrations'
+
+    def setUp(self):
+        super(MigrationTests, self).setUp()
+        connections.databases[self.alias] = dict(connections[LOCAL].settings_dict, NAME=':memory:')
+        self.connection = connections[self.alias]
+        self.addCleanup(self.drop_connection)
+
+    def drop_connection(self):
+        self.connection.close()
+        del connections[self.alias]
+        del connections.databases[self.alias]
+
+    def migrate(self, name):
+        from django.db.migrations.executor import MigrationExecutor
+        # Test settings disable migrations of synchro
+        with override_settings(MIGRATION_MODULES={}):
+            MigrationExecutor(self.connection).migrate([('synchro', name)])
+
+    def get_columns(self, table):
+        with self.connection.cursor() as cursor:
+            return [c.name for c in self.connection.introspection.get_table_description(
+                cursor, table)]
+
+    def test_upgrade(self):
+        """Test if schema of 0.7 is upgraded, keeping logs and their delete keys."""
+        self.migrate('0001_initial')
+        self.assertNotIn('key', self.get_columns('synchro_changelog'))
+        with self.connection.cursor() as cursor:
+            cursor.execute("INSERT INTO django_content_type (name, app_label, model) "
+                           "VALUES ('b', 'a', 'b')")
+            for i, key in enumerate([(u'James',), (datetime.datetime(2017, 11, 12),), None]):
+                cursor.execute("INSERT INTO synchro_changelog (content_type_id, object_id, date, "
+                               "action) VALUES (1, %s, '2017-11-12 00:00:00', 3)", [str(i + 1)])
+                cursor.execute('INSERT INTO synchro_deletekey (changelog_id, key) VALUES (%s, %s)',
+                               [i + 1, repr(key) if key else '<object>'])
+        # Keys cannot be converted before migration
+        self.assertRaises(CommandError, call_command, 'synchro_convert_keys', database=self.alias,
+                          verbosity=0)
+        self.migrate('0002_upgrade_0_8')
+        self.assertIn('key', self.get_columns('synchro_changelog'))
+        self.assertIn('fields', self.get_columns('synchro_changelog'))
+        self.assertIn('last_check_id', self.get_columns('synchro_channelstate'))
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT object_id, key, fields FROM synchro_changelog ORDER BY id')
+            self.assertEqual([('1', '["James"]', None),
+                              ('2', '[{"datetime":"2017-11-12T00:00:00"}]', None),
+                              ('3', None, None)], cursor.fetchall())
+            # Undecodable key is kept
+            cursor.execute('SELECT changelog_id, key FROM synchro_deletekey')
+            self.assertEqual([(3, '<object>')], cursor.fetchall())
+        call_command('synchro_convert_keys', database=self.alias, verbosity=0)
+        with self.connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM synchro_deletekey')
+            self.assertEqual((1,), cursor.fetchone())
+
+    def test_models_migrated(self):
+        """Test if migrations reflect models (except test models of this module)."""
+        from django.apps import apps
+        from django.db.migrations.autodetector import MigrationAutodetector
+        from django.db.migrations.loader import MigrationLoader
+        from django.db.migrations.state import ProjectState
+        with override_settings(MIGRATION_MODULES={}):
+            loader = MigrationLoader(None)
+        state = ProjectState.from_apps(apps)
+        for app_label, name in list(state.models):
+            if apps.get_model(app_label, name).__module__ == __name__:
+                del state.models[(app_label, name)]
+        changes = MigrationAutodetector(loader.project_state(), state).changes(loader.graph)
+        self.assertEqual({}, changes)
@@ -0,0 +1,559 @@
+"""
+Changesets: changes awaiting synchronization serialized into JSON records, so that they can be
+applied to a database which is not accessible directly.
+
+A changeset file is gzipped. Its first line is a header; each following line is a JSON list
+of records (a chunk). There are three kinds of records:
+
+- ``{"action": "save", "model": ..., "pk": ..., "fields": {...}, "key": [...], "fk_keys": {...}}``
+- ``{"action": "delete", "model": ..., "pk": ..., "key": [...]}``
+- ``{"action": "m2m", "model": ..., "pk": ..., "links": {...}, "rows": {...}}``
+
+Primary and foreign keys are always the source ones. When applied, they are translated with
+ImportReference, then by natural key (``key`` and ``fk_keys``) if possible. Objects referenced
+by foreign keys and m2m relations are exported before the referencing ones, so that they can
+always be translated; only primary keys which are not automatic are kept as they are.
+"""
+import gzip
+import json
+import zlib
+from collections import defaultdict
+from contextlib import closing
+from itertools import groupby
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ObjectDoesNotExist
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, transaction
+from django.utils import six
+from django.utils.encoding import force_text
+try:
+    from django.db.models import Case, Value, When
+except ImportError:
+    # Django < 1.8
+    Case = Value = When = None
+
+from synchro import settings
+from synchro.management.commands.synchronize import get_m2m_fields
+from synchro.models import ImportReference, DELETION, M2M_CHANGE
+from synchro.signals import DisableSynchroLog
+from synchro.utility import chunked
+
+HEADER = {'format': 'synchro-changeset', 'version': 1}
+QUERY_CHUNK = 500
+
+
+def get_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.model_name)
+
+
+def has_natural_key(model):
+    return (hasattr(model, 'natural_key') and
+            hasattr(model._default_manager, 'get_by_natural_key'))
+
+
+def get_pk(obj):
+    pk = obj.pk
+    return pk if isinstance(pk, six.integer_types) else force_text(pk)
+
+
+def get_fk_fields(model):
+    return [f for f in model._meta.fields if f.rel]
+
+
+# #### Export #####################################
+
+
+def serialize_fields(obj):
+    """Returns {field name: value} of obj concrete fields, omitting pk and SYNCHRO_SKIP fields."""
+    skip = getattr(obj, 'SYNCHRO_SKIP', ())
+    res = {}
+    for f in obj._meta.fields:
+        if f.primary_key or f.name in skip:
+            continue
+        value = f.value_from_object(obj)
+        if value is None or isinstance(value, (bool, float) + six.integer_types):
+            res[f.name] = value
+        else:
+            res[f.name] = f.value_to_string(obj)
+    return res
+
+
+def serialize_object(obj, fk_keys):
+    fields = serialize_fields(obj)
+    keys = {}
+    for f in get_fk_fields(obj.__class__):
+        key = fk_keys.get((f.rel.to, fields.get(f.name)))
+        if key is not None:
+            keys[f.name] = key
+    return {
+        'action': 'save',
+        'model': get_label(obj.__class__),
+        'pk': get_pk(obj),
+        'fields': fields,
+        'key': list(obj.natural_key()) if has_natural_key(obj.__class__) else None,
+        'fk_keys': keys,
+    }
+
+
+def serialize_m2m(obj, links, rows):
+    return {
+        'action': 'm2m',
+        'model': get_label(obj.__class__),
+        'pk': get_pk(obj),
+        'links': links,
+        'rows': dict((f, [serialize_fields(inter) for inter in inters])
+                     for f, inters in six.iteritems(rows)),
+    }
+
+
+def get_m2m_data(obj):
+    """
+    Returns ({m2m accessor: related pks}, {m2m accessor: intermediary objects}) for all obj
+    m2m relations (the latter for relations with explicit intermediary model).
+    """
+    links, rows = {}, {}
+    for f, (to, through, me, he_id) in six.iteritems(get_m2m_fields(obj.__class__)):
+        if through._meta.auto_created:
+            links[f] = list(getattr(obj, f).using(settings.LOCAL).values_list('pk', flat=True))
+        else:
+            rows[f] = list(through._base_manager.using(settings.LOCAL).filter(**{me: obj}))
+    return links, rows
+
+
+def fetch(model, pks):
+    """Returns {pk as text: object} of LOCAL objects, with one query per chunk."""
+    res = {}
+    for chunk in chunked(set(pks), QUERY_CHUNK):
+        for obj in model._base_manager.using(settings.LOCAL).filter(pk__in=chunk):
+            res[force_text(obj.pk)] = obj
+    return res
+
+
+def fetch_fk_keys(objs):
+    """Returns {(model, pk): natural key} of every naturally-keyed object referenced by objs."""
+    pks = defaultdict(set)
+    for obj in objs:
+        for f in get_fk_fields(obj.__class__):
+            value = f.value_from_object(obj)
+            if value is not None and has_natural_key(f.rel.to):
+                pks[f.rel.to].add(value)
+    res = {}
+    for model, ids in six.iteritems(pks):
+        for target in six.itervalues(fetch(model, ids)):
+            res[(model, target.pk)] = list(target.natural_key())
+    return res
+
+
+def get_referenced(objs):
+    """Returns {model: pks} of objects referenced by foreign keys of objs."""
+    res = defaultdict(set)
+    for obj in objs:
+        for f in get_fk_fields(obj.__class__):
+            value = f.value_from_object(obj)
+            if value is not None:
+                res[f.rel.to].add(force_text(value))
+    return res
+
+
+def get_dependencies(objects, m2m, written=frozenset()):
+    """
+    Returns objects referenced (directly or not) by objects and m2m data, targets first.
+    They are exported along with the referencing objects, so that they can be resolved on import:
+    objects of models not in SYNCHRO_MODELS are never logged, and logged ones may be exported
+    later (in 'state' capture mode, changes are ordered by the date of the latest one).
+    Objects already written, given as (model, pk as text), are skipped with their targets.
+    """
+    found = {}  # (model, pk as text): object
+    referenced = get_referenced(list(objects.values()) + [
+        inter for links, rows in six.itervalues(m2m) for inters in six.itervalues(rows)
+        for inter in inters])
+    for key, (links, rows) in six.iteritems(m2m):
+        m2m_fields = get_m2m_fields(objects[key].__class__)
+        for f, ids in six.iteritems(links):
+            referenced[m2m_fields[f][0]].update(force_text(i) for i in ids)
+    known = dict(((obj.__class__, force_text(obj.pk)), obj) for obj in six.itervalues(objects))
+    while referenced:
+        new = []
+        for model, ids in six.iteritems(referenced):
+            missing = set()
+            for i in ids:
+                if (model, i) in found or (model, i) in written:
+                    continue
+                obj = known.get((model, i))
+                if obj is None:
+                    missing.add(i)
+                else:
+                    found[(model, i)] = obj
+            for i, obj in six.iteritems(fetch(model, missing)):
+                found[(model, i)] = obj
+                new.append(obj)
+        referenced = get_referenced(new)
+
+    # Targets go before the objects referencing them (reference cycles are broken arbitrarily).
+    def targets(key):
+        obj = found[key]
+        for f in get_fk_fields(obj.__class__):
+            value = f.value_from_object(obj)
+            if value is not None and (f.rel.to, force_text(value)) in found:
+                yield f.rel.to, force_text(value)
+    res = []
+    visited = set()
+    for root in sorted(found, key=lambda k: (get_label(k[0]), k[1])):
+        if root in visited:
+            continue
+        visited.add(root)
+        stack = [(root, targets(root))]
+        while stack:
+            key, pending = stack[-1]
+            for target in pending:
+                if target not in visited:
+                    visited.add(target)
+                    stack.append((target, targets(target)))
+                    break
+            else:
+                stack.pop()
+                res.append(found[key])
+    return res
+
+
+def serialize_chunk(actions, written=None):
+    """
+    Turns list of (action, log) pairs into records.
+    written is set of (model, pk as text) of objects saved by records of previous chunks (of the
+    same changeset); they are not saved again. It is updated in place.
+    """
+    written = set() if written is None else written
+    pks = defaultdict(set)
+    for action, log in actions:
+        if action != DELETION:
+            pks[log.content_type].add(log.object_id)
+    objects = {}
+    for ct, ids in six.iteritems(pks):
+        for pk, obj in six.iteritems(fetch(ct.model_class(), ids)):
+            objects[(ct.pk, pk)] = obj
+    m2m = {}
+    for action, log in actions:
+        key = (log.content_type_id, log.object_id)
+        if action == M2M_CHANGE and key in objects and key not in m2m:
+            m2m[key] = get_m2m_data(objects[key])
+
+    dependencies = get_dependencies(objects, m2m, written)
+    fk_keys = fetch_fk_keys(dependencies + list(objects.values()))
+    records = [serialize_object(obj, fk_keys) for obj in dependencies]
+    saved = written
+    saved.update((obj.__class__, force_text(obj.pk)) for obj in dependencies)
+    for action, log in actions:
+        model = log.content_type.model_class()
+        label = get_label(model)
+        key = (log.content_type_id, log.object_id)
+        if action == DELETION:
+            key = log.get_delete_key()
+            records.append({'action': 'delete', 'model': label, 'pk': log.object_id,
+                            'key': list(key) if key else None})
+            saved.discard((model, force_text(log.object_id)))
+        elif key not in objects:
+            # Deleted in the meantime; its deletion is going to be exported later.
+            continue
+        elif action == M2M_CHANGE:
+            records.append(serialize_m2m(objects[key], *m2m[key]))
+        elif (model, force_text(log.object_id)) not in saved:
+            # Saved just once, even if exported as a dependency already.
+            records.append(serialize_object(objects[key], fk_keys))
+            saved.add((model, force_text(log.object_id)))
+    return records
+
+
+def write_header(f):
+    f.write((json.dumps(HEADER) + '\n').encode('utf-8'))
+
+
+def write_records(f, records):
+    f.write((json.dumps(records, cls=DjangoJSONEncoder) + '\n').encode('utf-8'))
+
+
+def write_changeset(path, actions, chunk_size=QUERY_CHUNK):
+    """
+    Writes (action, log) pairs into a gzipped changeset file, streaming chunk by chunk.
+    Returns the number of written records.
+    """
+    count = 0
+    written = set()
+    with closing(gzip.open(path, 'wb')) as f:
+        write_header(f)
+        for chunk in chunked(actions, chunk_size):
+            records = serialize_chunk(chunk, written)
+            if records:
+                write_records(f, records)
+                count += len(records)
+    return count
+
+
+def read_chunks(f, name):
+    """Yields chunks (lists of records) of opened changeset."""
+    header = json.loads(next(f).decode('utf-8'))
+    if not isinstance(header, dict) or header.get('format') != HEADER['format']:
+        raise ValueError('%s is not a synchro changeset.' % name)
+    version = header.get('version')
+    if not isinstance(version, six.integer_types) or version > HEADER['version']:
+        raise ValueError('%s is a changeset of unsupported version %s.' % (name, version))
+    for line in f:
+        yield json.loads(line.decode('utf-8'))
+
+
+def read_changeset(path):
+    """Yields chunks (lists of records) of changeset file."""
+    with closing(gzip.open(path, 'rb')) as f:
+        for records in read_chunks(f, path):
+            yield records
+
+
+def dump_chunk(records):
+    """Returns gzipped changeset of one chunk of records (sent by synchro.transport)."""
+    buf = six.BytesIO()
+    with closing(gzip.GzipFile(fileobj=buf, mode='wb')) as f:
+        write_header(f)
+        write_records(f, records)
+    return buf.getvalue()
+
+
+def load_chunk(data):
+    """Returns records of changeset created by dump_chunk. Raises ValueError."""
+    try:
+        with closing(gzip.GzipFile(fileobj=six.BytesIO(data), mode='rb')) as f:
+            chunks = list(read_chunks(f, 'Request body'))
+    except (IOError, EOFError, StopIteration, zlib.error) as e:
+        raise ValueError(str(e) or 'Empty changeset.')
+    return [r for records in chunks for r in records]
+
+
+# #### Import #####################################
+
+
+class Importer(object):
+    """Applies records to the database, keeping track of ImportReferences."""
+
+    def __init__(self, using=settings.LOCAL):
+        self.using = using
+        self._refs = {}
+
+    def apply(self, records):
+        """Applies chunk of records. Returns list of (model label, source pk, local pk) of saved objects."""
+        self.saved = []
+        with DisableSynchroLog():
+            with transaction.atomic(using=self.using):
+                for (action, label), group in groupby(records, lambda r: (r['action'], r['model'])):
+                    getattr(self, 'apply_%s' % action)(apps.get_model(label), list(group))
+        # Don't let cache grow with every chunk.
+        self._refs = {}
+        return self.saved
+
+    # References
+
+    def get_ct(self, model):
+        return ContentType.objects.db_manager(self.using).get_for_model(model)
+
+    def load_refs(self, model, source_ids):
+        """Caches references of given source objects (None for missing ones)."""
+        missing = set(force_text(i) for i in source_ids) - set(
+            src for m, src in self._refs if m is model)
+        qs = ImportReference.objects.using(self.using).filter(content_type=self.get_ct(model))
+        for chunk in chunked(missing, QUERY_CHUNK):
+            self._refs.update(((model, src), None) for src in chunk)
+            for src, loc in qs.filter(source_object_id__in=chunk).values_list(
+                    'source_object_id', 'local_object_id'):
+                self._refs[(model, src)] = loc
+
+    def load_fk_refs(self, model, fields_list):
+        """Caches references of objects referenced by foreign keys in fields_list."""
+        ids = defaultdict(list)
+        for fields in fields_list:
+            for f in get_fk_fields(model):
+                if fields.get(f.name) is not None:
+                    ids[f.rel.to].append(fields[f.name])
+        for target, source_ids in six.iteritems(ids):
+            self.load_refs(target, source_ids)
+
+    def save_refs(self, model, pairs):
+        """Stores references for (source pk, local pk) pairs."""
+        ct = self.get_ct(model)
+        label = get_label(model)
+        new = []
+        for src, loc in pairs:
+            src, loc = force_text(src), force_text(loc)
+            self.saved.append((label, src, loc))
+            old = self._refs.get((model, src))
+            if old is None:
+                new.append(ImportReference(content_type=ct, source_object_id=src,
+                                           local_object_id=loc))
+            elif old != loc:
+                ImportReference.objects.using(self.using).filter(
+                    content_type=ct, source_object_id=src).update(local_object_id=loc)
+            self._refs[(model, src)] = loc
+        ImportReference.objects.using(self.using).bulk_create(new)
+
+    def get_by_key(self, model, key):
+        if key is None or not has_natural_key(model):
+            return None
+        try:
+            return model._default_manager.db_manager(self.using).get_by_natural_key(*key)
+        except ObjectDoesNotExist:
+            return None
+
+    def resolve(self, model, source_id, key=None):
+        """
+        Returns local pk of object referenced by source pk (references must be loaded).
+        Raises ValueError if the object was not imported, since automatic pks of both databases
+        are unrelated.
+        """
+        ref = self._refs.get((model, force_text(source_id)))
+        if ref is not None:
+            return model._meta.pk.to_python(ref)
+        obj = self.get_by_key(model, key)
+        if obj is not None:
+            return obj.pk
+        if model._meta.has_auto_field:
+            raise ValueError('%s %s was not imported.' % (get_label(model), source_id))
+        return source_id
+
+    def build(self, model, fields, fk_keys=None):
+        """Returns {attname: value} for model instance, with foreign keys resolved."""
+        fk_keys = fk_keys or {}
+        res = {}
+        for name, value in six.iteritems(fields):
+            f = model._meta.get_field(name)
+            if f.rel and value is not None:
+                res[f.attname] = self.resolve(f.rel.to, value, fk_keys.get(name))
+            else:
+                res[f.attname] = f.to_python(value)
+        return res
+
+    # Actions
+
+    def apply_save(self, model, records):
+        if any(f.rel.to is model for f in get_fk_fields(model)):
+            # Object may reference object saved just before; resolve it one by one.
+            batches = [[r] for r in records]
+        else:
+            batches = [records]
+        for batch in batches:
+            self.save_batch(model, batch)
+
+    def find_existing(self, model, records):
+        """Returns {source pk: local object} of objects which already exist."""
+        self.load_refs(model, [r['pk'] for r in records])
+        pks = {}
+        for r in records:
+            src = force_text(r['pk'])
+            ref = self._refs.get((model, src))
+            if ref is not None:
+                pks[src] = ref
+            elif not model._meta.has_auto_field:
+                pks[src] = src
+        objs = {}
+        for chunk in chunked(set(pks.values()), QUERY_CHUNK):
+            for obj in model._base_manager.using(self.using).filter(pk__in=chunk):
+                objs[force_text(obj.pk)] = obj
+        res = {}
+        for r in records:
+            src = force_text(r['pk'])
+            obj = objs.get(pks.get(src)) or self.get_by_key(model, r.get('key'))
+            if obj is not None:
+                res[src] = obj
+        return res
+
+    def save_batch(self, model, records):
+        self.load_fk_refs(model, [r['fields'] for r in records])
+        existing = self.find_existing(model, records)
+        inserts = {}
+        updates = {}
+        names = set()
+        for r in records:
+            src = force_text(r['pk'])
+            values = self.build(model, r['fields'], r.get('fk_keys'))
+            obj = existing.get(src) or inserts.get(src)
+            if obj is None:
+                obj = inserts[src] = model(**values)
+                if not model._meta.has_auto_field:
+                    obj.pk = model._meta.pk.to_python(r['pk'])
+                continue
+            for attname, value in six.iteritems(values):
+                setattr(obj, attname, value)
+            if src not in inserts:
+                updates[src] = obj
+                names.update(r['fields'])
+        self.insert(model, list(inserts.values()))
+        self.update(model, list(updates.values()), names)
+        self.save_refs(model, [(src, obj.pk) for src, obj in six.iteritems(updates)] +
+                       [(src, obj.pk) for src, obj in six.iteritems(inserts)])
+
+    def insert(self, model, objs):
+        features = connections[self.using].features
+        if not objs:
+            return
+        if not model._meta.parents and (not model._meta.has_auto_field or
+                                        getattr(features, 'can_return_ids_from_bulk_insert', False)):
+            model._base_manager.using(self.using).bulk_create(objs)
+        else:
+            for obj in objs:
+                obj.save(using=self.using, force_insert=True)
+
+    def update(self, model, objs, names):
+        """Updates fields of given names of objs, with one query per batch of objects."""
+        if not objs:
+            return
+        if model._meta.parents or Case is None:
+            # Fields are spread over several tables (or Django < 1.8)
+            for obj in objs:
+                obj.save(using=self.using)
+            return
+        fields = [f for f in model._meta.concrete_fields if f.name in names]
+        if not fields:
+            return
+        ops = connections[self.using].ops
+        # Every object takes its pk and a value of each field as query parameters
+        size = min(QUERY_CHUNK, max(1, ops.bulk_batch_size([None] * (2 * len(fields) + 1), objs)))
+        manager = model._base_manager.using(self.using)
+        for chunk in chunked(objs, size):
+            values = dict((f.name, Case(*[When(pk=obj.pk, then=Value(getattr(obj, f.attname),
+                                                                     output_field=f))
+                                          for obj in chunk], output_field=f))
+                          for f in fields)
+            manager.filter(pk__in=[obj.pk for obj in chunk]).update(**values)
+
+    def apply_delete(self, model, records):
+        self.load_refs(model, [r['pk'] for r in records])
+        pks = []
+        for r in records:
+            ref = self._refs.get((model, force_text(r['pk'])))
+            obj = self.get_by_key(model, r.get('key')) if ref is None else None
+            if ref is not None:
+                pks.append(ref)
+            elif obj is not None:
+                pks.append(obj.pk)
+            elif not model._meta.has_auto_field:
+                pks.append(r['pk'])
+        for chunk in chunked(pks, QUERY_CHUNK):
+            model._base_manager.using(self.using).filter(pk__in=chunk).delete()
+        sources = [force_text(r['pk']) for r in records]
+        for chunk in chunked(sources, QUERY_CHUNK):
+            ImportReference.objects.using(self.using).filter(
+                content_type=self.get_ct(model), source_object_id__in=chunk).delete()
+        self._refs.update(((model, src), None) for src in sources)
+
+    def apply_m2m(self, model, records):
+        self.load_refs(model, [r['pk'] for r in records])
+        m2m = get_m2m_fields(model)
+        for r in records:
+            pk = self.resolve(model, r['pk'], r.get('key'))
+            obj = model._base_manager.using(self.using).get(pk=pk)
+            for f, ids in six.iteritems(r['links']):
+                to = m2m[f][0]
+                self.load_refs(to, ids)
+                setattr(obj, f, [self.resolve(to, i) for i in ids])
+            for f, rows in six.iteritems(r['rows']):
+                to, through, me, he_id = m2m[f]
+                through._base_manager.using(self.using).filter(**{me: obj}).delete()
+                self.load_fk_refs(through, rows)
+                self.insert(through, [through(**self.build(through, row)) for row in rows])
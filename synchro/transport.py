@@ -0,0 +1,174 @@
+"""
+Synchronization over HTTP (``synchro_push`` command and ``receive`` view).
+
+Changes awaiting synchronization are serialized into changeset records (see synchro.transfer)
+batch by batch. Every batch is POSTed gzipped to the receiving view of the other site, which applies
+it with Importer in one transaction and responds with primary keys of saved objects; References
+are stored from them. Requests are signed with HMAC-SHA256 using ``SYNCHRO_TRANSPORT_KEY``.
+"""
+from collections import defaultdict
+import hashlib
+import hmac
+import json
+import time
+
+from django.apps import apps
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.utils import six
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import force_text
+from django.utils.six.moves.urllib.request import Request, urlopen
+
+from synchro import settings
+from synchro.management.commands.synchronize import (
+    clear_pending, compact, get_pending_changes, get_pending_logs, set_checkpoint)
+from synchro.models import REFERENCE_CACHE, get_reference_model
+from synchro.seeding import get_references
+from synchro.transfer import Importer, dump_chunk, load_chunk, serialize_chunk
+from synchro.utility import chunked
+
+CONTENT_TYPE = 'application/x-synchro-changeset'
+SIGNATURE_HEADER = 'X-Synchro-Signature'
+TIMESTAMP_HEADER = 'X-Synchro-Timestamp'
+# Requests signed longer ago are rejected, so that they cannot be replayed later
+MAX_AGE = 300
+
+
+class TransportError(Exception):
+    """Raised when a batch is not accepted by the receiving site."""
+
+
+class InvalidSignature(Exception):
+    """Raised when a received batch is not signed properly."""
+
+
+def sign(key, timestamp, body):
+    if isinstance(key, six.text_type):
+        key = key.encode('utf-8')
+    message = str(timestamp).encode('ascii') + b'\n' + body
+    return hmac.new(key, message, hashlib.sha256).hexdigest()
+
+
+def verify(key, timestamp, signature, body):
+    """Returns whether body was signed with key recently."""
+    try:
+        age = abs(time.time() - int(timestamp))
+    except (TypeError, ValueError):
+        return False
+    return age <= MAX_AGE and constant_time_compare(signature or '', sign(key, timestamp, body))
+
+
+def post(url, body, headers, timeout=60):
+    """Sends POST request; returns response body. Raises TransportError."""
+    try:
+        return urlopen(Request(url, body, headers), timeout=timeout).read()
+    except IOError as e:
+        raise TransportError('%s: %s' % (url, e))
+
+
+def receive(body, timestamp, signature):
+    """
+    Applies batch of records signed by the sending site.
+    Returns list of [model label, source pk, local pk] of saved objects.
+    Raises InvalidSignature, or ValueError if body is not a valid changeset.
+    """
+    if not verify(settings.TRANSPORT_KEY, timestamp, signature, body):
+        raise InvalidSignature('Invalid signature.')
+    return Importer(settings.RECEIVE_DATABASE).apply(load_chunk(body))
+
+
+def store_references(saved):
+    """Stores References from [model label, local pk, remote pk] triples."""
+    ids = defaultdict(dict)
+    for label, local_id, remote_id in saved:
+        ids[label][force_text(local_id)] = force_text(remote_id)
+    for label, pairs in ids.items():
+        ct = ContentType.objects.get_for_model(apps.get_model(label))
+        Reference = get_reference_model(ct)
+        existing = get_references(ct, pairs)
+        for local_id, remote_id in pairs.items():
+            if local_id in existing and existing[local_id] != remote_id:
+                Reference.objects.filter(content_type=ct, local_object_id=local_id).update(
+                    remote_object_id=remote_id)
+            REFERENCE_CACHE.set(ct, local_id, remote_id)
+        Reference.objects.bulk_create(
+            [Reference(content_type=ct, local_object_id=local_id, remote_object_id=remote_id)
+             for local_id, remote_id in pairs.items() if local_id not in existing],
+            settings.BATCH_SIZE)
+
+
+def delete_references(records):
+    """Deletes References of objects deleted by records."""
+    ids = defaultdict(list)
+    for r in records:
+        if r['action'] == 'delete':
+            ids[r['model']].append(force_text(r['pk']))
+    for label, local_ids in ids.items():
+        ct = ContentType.objects.get_for_model(apps.get_model(label))
+        for chunk in chunked(local_ids, settings.BATCH_SIZE):
+            get_reference_model(ct).objects.filter(
+                content_type=ct, local_object_id__in=chunk).delete()
+        for local_id in local_ids:
+            REFERENCE_CACHE.forget(ct, local_id)
+
+
+class Pusher(object):
+    """Pushes changes awaiting synchronization to the receiving view at url."""
+
+    def __init__(self, url, key, post=post):
+        self.url = url
+        self.key = key
+        self.post = post
+        self.count = 0
+        # Objects saved by previous requests of push_all (see serialize_chunk)
+        self.written = set()
+
+    def push(self, actions):
+        """Sends (action, log) pairs as one request and stores References of saved objects."""
+        records = serialize_chunk(actions, self.written)
+        if not records:
+            return
+        body = dump_chunk(records)
+        timestamp = int(time.time())
+        response = self.post(self.url, body, {
+            'Content-Type': CONTENT_TYPE,
+            SIGNATURE_HEADER: sign(self.key, timestamp, body),
+            TIMESTAMP_HEADER: str(timestamp),
+        })
+        try:
+            saved = json.loads(response.decode('utf-8'))['saved']
+        except (ValueError, KeyError, TypeError):
+            raise TransportError('%s: invalid response.' % self.url)
+        delete_references(records)
+        store_references(saved)
+        self.count += len(records)
+
+    def push_all(self, batch_size=None):
+        """Pushes all channels. Every batch is marked as synchronized once it is applied."""
+        self.written = set()
+        for channel in settings.CHANNELS:
+            size = batch_size or channel.batch_size
+            if settings.CAPTURE == 'state':
+                self.push_changes(channel, size)
+            else:
+                self.push_logs(channel, size)
+        return self.count
+
+    def push_logs(self, channel, batch_size):
+        logs, last = get_pending_logs(channel)
+        for batch in chunked(compact(logs), batch_size):
+            with transaction.atomic():
+                self.push([(log.action, log) for log in batch])
+                set_checkpoint(batch[-1], channel)
+        if last is not None:
+            # Logs after the last batch may have been compacted away
+            set_checkpoint(last, channel)
+
+    def push_changes(self, channel, batch_size):
+        changes = get_pending_changes(channel).select_related().order_by('date', 'pk')
+        for batch in chunked(changes.iterator(), batch_size):
+            with transaction.atomic():
+                self.push([(action, change) for change in batch
+                           for action in change.get_actions()])
+                clear_pending([(change.pk, change.date) for change in batch])
@@ -1,9 +1,12 @@
 # flake8: noqa
 from django.conf.urls import url
 
-from views import synchro
+from synchro.views import backlog, metrics, receive, synchro
 
 
 urlpatterns = (
     url(r'^$', synchro, name='synchro'),
+    url(r'^backlog/$', backlog, name='backlog'),
+    url(r'^metrics/$', metrics, name='metrics'),
+    url(r'^receive/$', receive, name='receive'),
 )
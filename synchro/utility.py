@@ -1,8 +1,107 @@
-from datetime import datetime
+from ast import literal_eval
+import datetime as datetime_module
+from datetime import date, datetime, time
+from decimal import Decimal
+from functools import reduce
+import json
+import operator
+from uuid import UUID
 
 from django.core.exceptions import MultipleObjectsReturned, ValidationError
-from django.db.models import Manager, Model
+from django.db import connections, transaction
+from django.db.models import Manager, Model, Q
 from django.db.models.base import ModelBase
+from django.utils import six
+from django.utils.dateparse import parse_date, parse_datetime, parse_time
+
+
+def chunked(iterable, size):
+    """Yields lists of (at most) size consecutive items of iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def normalize_key(key):
+    """Returns hashable natural key, with model instances replaced by their primary keys."""
+    return tuple(v.pk if isinstance(v, Model) else v for v in key)
+
+
+# Natural key values which are not JSON types are stored as {type: string}.
+KEY_TYPES = (
+    ('datetime', datetime, lambda v: v.isoformat(), parse_datetime),
+    ('date', date, lambda v: v.isoformat(), parse_date),
+    ('time', time, lambda v: v.isoformat(), parse_time),
+    ('decimal', Decimal, str, Decimal),
+    ('uuid', UUID, lambda v: v.hex, UUID),
+)
+
+
+def _encode_value(value):
+    if isinstance(value, Model):
+        value = value.pk
+    if value is None or isinstance(value, (bool, float) + six.integer_types + six.string_types):
+        return value
+    if isinstance(value, (list, tuple)):
+        return [_encode_value(v) for v in value]
+    for name, cls, to_string, _ in KEY_TYPES:
+        if isinstance(value, cls):
+            return {name: to_string(value)}
+    raise TypeError('Cannot encode natural key value %r.' % (value,))
+
+
+def _decode_value(value):
+    if isinstance(value, list):
+        return tuple(_decode_value(v) for v in value)
+    if isinstance(value, dict):
+        (name, string), = value.items()
+        for type_name, _, _, from_string in KEY_TYPES:
+            if type_name == name:
+                return from_string(string)
+        raise ValueError('Unknown natural key value type: %s.' % name)
+    return value
+
+
+def encode_key(key):
+    """
+    Encodes natural key as compact JSON. Model instances are stored as their primary keys.
+    Raises TypeError if some value cannot be encoded.
+    """
+    return json.dumps(_encode_value(tuple(key)), separators=(',', ':'))
+
+
+def decode_key(raw):
+    """Decodes natural key encoded by encode_key (or stored as repr by older versions)."""
+    if raw is None:
+        return None
+    if raw.startswith('['):
+        return _decode_value(json.loads(raw))
+    return tuple(literal_eval(raw))
+
+
+# Names available to reprs of natural keys stored by versions prior to 0.8
+LEGACY_KEY_NAMES = {'datetime': datetime_module, 'Decimal': Decimal, 'UUID': UUID}
+
+
+def decode_legacy_key(raw):
+    """
+    Decodes natural key stored as its repr in DeleteKey by versions prior to 0.8.
+    Reprs which are not literals (e.g. containing datetimes) are evaluated, as those versions did;
+    the rows are trusted, since only synchro writes them. Raises ValueError if evaluation fails.
+    """
+    try:
+        return tuple(literal_eval(raw))
+    except (ValueError, SyntaxError):
+        pass
+    try:
+        return tuple(eval(raw, dict(LEGACY_KEY_NAMES, __builtins__={})))
+    except Exception as e:
+        raise ValueError('Cannot decode natural key %r: %s' % (raw, e))
 
 
 class NaturalManager(Manager):
@@ -22,12 +121,50 @@ class NaturalManager(Manager):
                 return self.filter(**lookups)[0]
             raise
 
+    def get_many_by_natural_keys(self, keys, batch_size=500):
+        """
+        Returns {natural key: object} for all found keys, resolving them in batches.
+        If allow_many is set, the first matching object is returned; otherwise
+        MultipleObjectsReturned is raised.
+        """
+        wanted = dict((normalize_key(key), tuple(key)) for key in keys)
+        res = {}
+        for batch in chunked(wanted, batch_size):
+            if len(self.fields) == 1:
+                q = Q(**{'%s__in' % self.fields[0]: [key[0] for key in batch]})
+            else:
+                q = reduce(operator.or_, (Q(**dict(zip(self.fields, key))) for key in batch))
+            qs = self.filter(q)
+            pks = {}
+            inexact = False
+            for row in qs.values_list('pk', *self.fields):
+                key = wanted.get(row[1:])
+                if key is None:
+                    # Matched by database, but not equal in Python (e.g. case insensitive)
+                    inexact = True
+                elif key not in pks:
+                    pks[key] = row[0]
+                elif not self.allow_many:
+                    raise self.model.MultipleObjectsReturned(
+                        'get_many_by_natural_keys() returned more than one %s for key %s.'
+                        % (self.model._meta.object_name, key))
+            objects = qs.in_bulk(list(pks.values()))
+            res.update((key, objects[pk]) for key, pk in six.iteritems(pks) if pk in objects)
+            if inexact:
+                for key in (wanted[k] for k in batch):
+                    if key not in res:
+                        try:
+                            res[key] = self.get_by_natural_key(*key)
+                        except self.model.DoesNotExist:
+                            pass
+        return res
+
     def __new__(cls, *fields, **options):
         """
         Creates actual manager, which can be further subclassed and instantiated without arguments.
         """
         if ((not fields and hasattr(cls, 'fields') and hasattr(cls, 'allow_many')) or
-            fields and not isinstance(fields[0], basestring)):
+            fields and not isinstance(fields[0], six.string_types)):
             # Class was already prepared.
             return super(NaturalManager, cls).__new__(cls)
 
@@ -63,8 +200,7 @@ class _NaturalKeyModelBase(ModelBase):
         return super(_NaturalKeyModelBase, cls).__new__(cls, name, bases, attrs)
 
 
-class NaturalKeyModel(Model):
-    __metaclass__ = _NaturalKeyModelBase
+class NaturalKeyModel(six.with_metaclass(_NaturalKeyModelBase, Model)):
     _natural_key = ()
 
     def natural_key(self):
@@ -74,8 +210,56 @@ class NaturalKeyModel(Model):
         abstract = True
 
 
-def reset_synchro():
-    from models import ChangeLog, Reference, options
-    options.last_check = datetime.now()
-    ChangeLog.objects.all().delete()
-    Reference.objects.all().delete()
+def _truncate(models, using):
+    """Empties tables of all models with one statement. Returns number of removed rows."""
+    connection = connections[using]
+    removed = sum(m._base_manager.using(using).count() for m in models)
+    tables = ', '.join(connection.ops.quote_name(m._meta.db_table) for m in models)
+    with connection.cursor() as cursor:
+        cursor.execute('TRUNCATE %s' % tables)
+    return removed
+
+
+def _chunked_delete(model, using, chunk_size):
+    """
+    Deletes all model rows with raw SQL, chunk by chunk of primary keys (walked by keyset,
+    so sparse keys cost no empty statements).
+    Django deletion collector is bypassed, so dependent rows must be removed earlier.
+    Returns number of removed rows.
+    """
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    sql = 'DELETE FROM %s WHERE %s <= %%s' % (qn(model._meta.db_table), qn(model._meta.pk.column))
+    pks = model._base_manager.using(using).order_by('pk').values_list('pk', flat=True)
+    removed, end = 0, None
+    with connection.cursor() as cursor:
+        while True:
+            rest = pks if end is None else pks.filter(pk__gt=end)
+            # The last primary key of the next chunk (or of the table)
+            end = rest[chunk_size - 1:chunk_size].first()
+            if end is None:
+                end = rest.last()
+                if end is None:
+                    return removed
+            cursor.execute(sql, [end])
+            removed += cursor.rowcount
+
+
+def reset_synchro(chunk_size=10000):
+    """
+    Sets checkpoint to now and forgets all logs and references.
+    Returns number of removed rows.
+    """
+    from synchro.models import (ChangeLog, ChannelState, DeleteKey, PendingChange,
+                                QuarantinedChange, REFERENCE_CACHE, REFERENCE_MODELS, options)
+    from synchro.settings import LOCAL
+    # Order matters: DeleteKey depends on ChangeLog.
+    models = ((DeleteKey, ChangeLog, PendingChange, QuarantinedChange, ChannelState) +
+              REFERENCE_MODELS)
+    REFERENCE_CACHE.clear()
+    with transaction.atomic(using=LOCAL):
+        options.last_check = datetime.now()
+        options.last_check_id = 0
+        if connections[LOCAL].vendor == 'postgresql':
+            return _truncate(models, LOCAL)
+        return sum(_chunked_delete(m, LOCAL, chunk_size) for m in models)
@@ -0,0 +1,238 @@
+"""
+Drift detection between LOCAL and REMOTE (``synchro_verify`` command).
+
+Objects of every synchronized model are compared in chunks of primary key ranges. Both databases
+compute a checksum of every range (sum of hashes of rows, with primary and foreign keys of LOCAL
+translated by References); ranges with differing checksums are bisected and only rows of the
+smallest ones are fetched and compared. Checksums need both databases to be of the same vendor
+(SQLite, PostgreSQL or MySQL); otherwise (and for multi-table inheritance) every row is compared.
+Only field values are read (not model instances); m2m relations are not compared.
+Differing objects can be repaired with the synchronization engine, without touching logs or
+the checkpoint.
+"""
+from zlib import crc32
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connections
+from django.utils import six
+
+from synchro import settings
+from synchro.management.commands.synchronize import NATURAL_CACHE, perform_chg
+from synchro.models import REFERENCE_CACHE, get_reference_model
+from synchro.seeding import get_models, get_references
+from synchro.settings import LOCAL, REMOTE
+from synchro.utility import chunked
+
+MISSING = object()
+# Ranges with differing checksums are bisected until they have at most that many objects
+LEAF_SIZE = 16
+
+
+def get_compared_fields(model):
+    """Returns concrete fields of model compared between databases."""
+    skip = getattr(model, 'SYNCHRO_SKIP', ())
+    return [f for f in model._meta.concrete_fields if not f.primary_key and f.name not in skip]
+
+
+def sqlite_hash(value):
+    if value is None:
+        return None
+    return crc32(value.encode('utf-8') if isinstance(value, six.text_type) else value) & 0xffffffff
+
+
+def get_hash_function(using):
+    """Returns SQL template of a function hashing a string into an integer (or None)."""
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        connection.ensure_connection()
+        connection.connection.create_function('synchro_hash', 1, sqlite_hash)
+        return 'synchro_hash(%s)'
+    if connection.vendor == 'postgresql':
+        return "('x' || substr(md5(%s), 1, 8))::bit(32)::bigint"
+    if connection.vendor == 'mysql':
+        return 'CRC32(%s)'
+    return None
+
+
+def concat(using, *parts):
+    if connections[using].vendor == 'mysql':
+        return 'CONCAT(%s)' % ', '.join(parts)
+    return '(%s)' % ' || '.join(parts)
+
+
+def as_text(using, sql):
+    return 'CAST(%s AS %s)' % (sql, 'CHAR' if connections[using].vendor == 'mysql' else 'TEXT')
+
+
+class Checksum(object):
+    """
+    Computes (count, sum of row hashes) of objects of model on LOCAL (with keys translated to
+    REMOTE ones by References) and on REMOTE, so that equal ranges have equal checksums.
+    """
+    def __init__(self, ct, model, fields):
+        self.ct = ct
+        self.model = model
+        self.fields = fields
+        self.local = self.get_sql(LOCAL, self.translate)
+        self.remote = self.get_sql(REMOTE, lambda field, column: column)
+
+    @classmethod
+    def is_supported(cls, model):
+        return (not model._meta.parents and connections[LOCAL].vendor == connections[REMOTE].vendor
+                and get_hash_function(LOCAL) is not None and get_hash_function(REMOTE) is not None)
+
+    def get_sql(self, using, translate):
+        qn = connections[using].ops.quote_name
+        table = qn(self.model._meta.db_table)
+        pk = '%s.%s' % (table, qn(self.model._meta.pk.column))
+        values = [translate(self.model._meta.pk, pk)]
+        for field in self.fields:
+            column = '%s.%s' % (table, qn(field.column))
+            values.append(translate(field, column) if field.rel else column)
+        # NULL is distinguished from an empty string
+        values = ["COALESCE(%s, '-')" % concat(using, "'+'", as_text(using, value))
+                  for value in values]
+        row = concat(using, *[part for value in values for part in (value, "'|'")][:-1])
+        return 'SELECT COUNT(*), SUM(%s) FROM %s WHERE %s ' % (
+            get_hash_function(using) % row, table, pk)
+
+    def translate(self, field, column):
+        """Returns SQL of remote id referenced by LOCAL column (primary or foreign key)."""
+        model = self.model if field.primary_key else field.rel.to
+        ref_model = get_reference_model(model)
+        qn = connections[LOCAL].ops.quote_name
+        ref_table = qn(ref_model._meta.db_table)
+        if ref_model._meta.get_field('local_object_id').get_internal_type() == 'CharField':
+            column = as_text(LOCAL, column)
+        return '(SELECT %s.%s FROM %s WHERE %s.%s = %d AND %s.%s = %s)' % (
+            ref_table, qn('remote_object_id'), ref_table, ref_table, qn('content_type_id'),
+            ContentType.objects.get_for_model(model).pk, ref_table, qn('local_object_id'), column)
+
+    def prepare(self, using, values):
+        pk, connection = self.model._meta.pk, connections[using]
+        return [pk.get_db_prep_value(pk.to_python(value), connection) for value in values]
+
+    def get_local(self, start, end):
+        with connections[LOCAL].cursor() as cursor:
+            cursor.execute(self.local + 'BETWEEN %s AND %s', self.prepare(LOCAL, [start, end]))
+            return tuple(cursor.fetchone())
+
+    def get_remote(self, ids):
+        if not ids:
+            return (0, None)
+        with connections[REMOTE].cursor() as cursor:
+            cursor.execute(self.remote + 'IN (%s)' % ', '.join(['%s'] * len(ids)),
+                           self.prepare(REMOTE, ids))
+            return tuple(cursor.fetchone())
+
+
+class Verifier(object):
+    def __init__(self, chunk_size, repair=False):
+        self.chunk_size = chunk_size
+        self.repair = repair
+        self.results = []  # (model, checked, differing, missing, extra)
+
+    def verify(self):
+        for model in get_models():
+            if model._meta.proxy:
+                continue
+            try:
+                self.verify_model(model)
+            finally:
+                NATURAL_CACHE.clear()
+        return self.results
+
+    def verify_model(self, model):
+        ct = ContentType.objects.get_for_model(model)
+        fields = get_compared_fields(model)
+        names = [f.attname for f in fields]
+        fks = [(i, ContentType.objects.get_for_model(f.rel.to))
+               for i, f in enumerate(fields) if f.rel]
+        checksum = Checksum(ct, model, fields) if Checksum.is_supported(model) else None
+        checked = 0
+        differing, missing = [], []
+        qs = model._base_manager.using(LOCAL).order_by('pk').values_list('pk', flat=True)
+        pks = list(qs[:self.chunk_size])
+        while pks:
+            checked += len(pks)
+            refs = get_references(ct, [six.text_type(pk) for pk in pks])
+            diff, miss = self.compare_range(ct, model, names, fks, pks, refs, checksum)
+            differing.extend(diff)
+            missing.extend(miss)
+            pks = list(qs.filter(pk__gt=pks[-1])[:self.chunk_size])
+        extra = self.find_extra(ct, model)
+        if self.repair:
+            for id in missing + differing:
+                perform_chg(ct, id)
+            self.delete_extra(ct, model, extra)
+        self.results.append((model, checked, len(differing), len(missing), len(extra)))
+
+    def compare_range(self, ct, model, names, fks, pks, refs, checksum):
+        """
+        Returns (ids of differing objects, ids of objects missing on REMOTE) of the range of
+        ordered pks. Rows are fetched only if checksums of the range differ and it is small.
+        """
+        if checksum is not None:
+            remote_ids = [refs[six.text_type(pk)] for pk in pks if six.text_type(pk) in refs]
+            if checksum.get_local(pks[0], pks[-1]) == checksum.get_remote(remote_ids):
+                return [], []
+            if len(pks) > LEAF_SIZE:
+                half = len(pks) // 2
+                first = self.compare_range(ct, model, names, fks, pks[:half], refs, checksum)
+                second = self.compare_range(ct, model, names, fks, pks[half:], refs, checksum)
+                return first[0] + second[0], first[1] + second[1]
+        rows = model._base_manager.using(LOCAL).filter(pk__in=pks).values_list('pk', *names)
+        return self.compare_chunk(ct, model, names, fks, rows, refs)
+
+    def compare_chunk(self, ct, model, names, fks, rows, refs):
+        """Returns (ids of differing objects, ids of objects missing on REMOTE)."""
+        local = {}
+        for row in rows:
+            local[six.text_type(row[0])] = list(row[1:])
+        for i, fk_ct in fks:
+            fk_refs = get_references(fk_ct, [six.text_type(values[i])
+                                             for values in six.itervalues(local)
+                                             if values[i] is not None])
+            for values in six.itervalues(local):
+                if values[i] is not None:
+                    values[i] = fk_refs.get(six.text_type(values[i]), MISSING)
+        positions = set(i for i, _ in fks)
+        remote = {}
+        remote_ids = [refs[id] for id in local if id in refs]
+        for row in (model._base_manager.using(REMOTE).filter(pk__in=remote_ids)
+                    .values_list('pk', *names)):
+            remote[six.text_type(row[0])] = [
+                six.text_type(v) if i in positions and v is not None else v
+                for i, v in enumerate(row[1:])]
+        missing = sorted(id for id in local if refs.get(id) not in remote)
+        differing = sorted(id for id in local
+                           if refs.get(id) in remote and local[id] != remote[refs[id]])
+        return differing, missing
+
+    def find_extra(self, ct, model):
+        """Returns References of objects deleted from LOCAL, but still present on REMOTE."""
+        extra = []
+        refs = get_reference_model(ct).objects.filter(content_type=ct).order_by('pk').values_list(
+            'pk', 'local_object_id', 'remote_object_id')
+        chunk = list(refs[:self.chunk_size])
+        while chunk:
+            chunk = [(pk, six.text_type(local_id), six.text_type(remote_id))
+                     for pk, local_id, remote_id in chunk]
+            existing = set(six.text_type(pk) for pk in model._base_manager.using(LOCAL)
+                           .filter(pk__in=[local_id for _, local_id, _ in chunk])
+                           .values_list('pk', flat=True))
+            deleted = [row for row in chunk if row[1] not in existing]
+            remaining = set(six.text_type(pk) for pk in model._base_manager.using(REMOTE)
+                            .filter(pk__in=[remote_id for _, _, remote_id in deleted])
+                            .values_list('pk', flat=True))
+            extra.extend(row for row in deleted if row[2] in remaining)
+            chunk = list(refs.filter(pk__gt=chunk[-1][0])[:self.chunk_size])
+        return extra
+
+    def delete_extra(self, ct, model, extra):
+        for chunk in chunked(extra, settings.BATCH_SIZE):
+            model._base_manager.using(REMOTE).filter(
+                pk__in=[remote_id for _, _, remote_id in chunk]).delete()
+            get_reference_model(ct).objects.filter(pk__in=[pk for pk, _, _ in chunk]).delete()
+            for _, local_id, _ in chunk:
+                REFERENCE_CACHE.forget(ct, local_id)
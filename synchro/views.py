@@ -1,11 +1,18 @@
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
+from django.http import HttpResponse, JsonResponse
+from django.utils.crypto import constant_time_compare
 from django.template.response import TemplateResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from django.utils.translation import ugettext_lazy as _
 
+from synchro.backlog import count_models, filter_action, get_backlog, get_page
 from synchro.core import call_synchronize, reset_synchro
-from synchro.models import options
+from synchro.metrics import get_metrics, render_metrics
+from synchro.models import ACTIONS, options
 from synchro import settings
+from synchro import transport
 
 
 @staff_member_required
@@ -21,8 +28,70 @@ def synchro(request):
                                                                'type': e.__class__.__name__}
             messages.add_message(request, messages.ERROR, msg)
     elif 'reset' in request.POST and settings.ALLOW_RESET:
-        reset_synchro()
-        msg = _('Synchronization has been reset.')
+        removed = reset_synchro()
+        msg = u'%s %s' % (_('Synchronization has been reset.'),
+                          _('%(count)d records removed.') % {'count': removed})
         messages.add_message(request, messages.INFO, msg)
     return TemplateResponse(request, 'synchro.html', {'last': options.last_check,
                                                       'reset_allowed': settings.ALLOW_RESET})
+
+
+@staff_member_required
+def backlog(request):
+    """Changes awaiting synchronization, optionally filtered by model (ct) and action."""
+    qs = get_backlog()
+    action = request.GET.get('action')
+    if action and action.isdigit() and int(action) in dict(ACTIONS):
+        action = int(action)
+        qs = filter_action(qs, action)
+    else:
+        action = None
+    counts = count_models(qs)
+    ct = request.GET.get('ct')
+    if ct and ct.isdigit():
+        ct = int(ct)
+        qs = qs.filter(content_type=ct)
+    else:
+        ct = None
+    after = request.GET.get('after')
+    rows, last = get_page(qs, int(after) if after and after.isdigit() else None)
+    return TemplateResponse(request, 'synchro_backlog.html', {
+        'rows': rows, 'last': last, 'counts': counts, 'total': sum(c for _, c in counts),
+        'actions': ACTIONS, 'action': action, 'ct': ct})
+
+
+def render_metrics_response(request):
+    return HttpResponse(render_metrics(get_metrics()),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+def metrics(request):
+    """
+    Synchronization metrics in Prometheus text format.
+    Requires staff user, or the SYNCHRO_METRICS_TOKEN bearer token if it is set.
+    """
+    if settings.METRICS_TOKEN is None:
+        return staff_member_required(render_metrics_response)(request)
+    auth = request.META.get('HTTP_AUTHORIZATION', '')
+    if not constant_time_compare(auth, 'Bearer %s' % settings.METRICS_TOKEN):
+        return HttpResponse('Invalid token.', status=403, content_type='text/plain')
+    return render_metrics_response(request)
+
+
+@csrf_exempt
+@require_POST
+def receive(request):
+    """
+    Applies batch of changes pushed by synchro_push (see synchro.transport).
+    Requires SYNCHRO_TRANSPORT_KEY to be set; requests have to be signed with it.
+    """
+    if settings.TRANSPORT_KEY is None:
+        return HttpResponse('Receiving is disabled.', status=404, content_type='text/plain')
+    try:
+        saved = transport.receive(request.body, request.META.get('HTTP_X_SYNCHRO_TIMESTAMP'),
+                                  request.META.get('HTTP_X_SYNCHRO_SIGNATURE'))
+    except transport.InvalidSignature as e:
+        return HttpResponse(str(e), status=403, content_type='text/plain')
+    except ValueError as e:
+        return HttpResponse(str(e), status=400, content_type='text/plain')
+    return JsonResponse({'saved': saved})